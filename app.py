@@ -1,117 +1,115 @@
-import moondream as md
-from PIL import Image
-from pathlib import Path
+import argparse
 import json
 import os
+import sys
+import time
 
-def analyze_receipts():
+from batch import (DATA_DIR, SPLITS, list_split_images, run_batch, add_batch_arguments, report_throughput,
+                   new_profile_dir, report_profile)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from receipt import RECEIPT_PROMPT, Receipt
+from assessment import assess_reply, is_confident
+
+# Structured prompt shared with the backends
+PROMPT = RECEIPT_PROMPT
+
+def parse_receipt(idx, image_path, response):
+    try:
+        # Parse and coerce the reply into the canonical receipt shape
+        receipt_data = Receipt.from_text(response).to_dict()
+        receipt_data["receipt_id"] = idx
+        receipt_data["image_path"] = str(image_path)
+        
+        print("\nStructured data extracted successfully")
+        print(json.dumps(receipt_data, indent=2))
+        
+    except ValueError as e:
+        print(f"\nFailed to parse JSON: {str(e)}")
+        # Create fallback structure
+        receipt_data = {
+            "receipt_id": idx,
+            "image_path": str(image_path),
+            **Receipt.empty().to_dict(),
+            "raw_response": response
+        }
+        print("\nFallback data created:")
+        print(json.dumps(receipt_data, indent=2))
+
+    return receipt_data
+
+def analyze_receipts(splits=SPLITS, limit=None, batch_size=4, workers=None, decode_threads=2,
+                     output_file="receipt_analysis.json", escalate_model=None, data_dir=DATA_DIR,
+                     profile=False):
     # Paths
     model_path = "./moondream-0_5b-int8.mf"
-    image_dir = "images.cv_4javrql7ppkcofef7pzky/data/train/receipt"
-    num_images = 10  # Set to analyze first 10 images
     
     # Verify paths exist
     if not os.path.exists(model_path):
         print(f"Error: Model not found at {model_path}")
         return
-    if not os.path.exists(image_dir):
-        print(f"Error: Image directory not found at {image_dir}")
+    if not os.path.exists(data_dir):
+        print(f"Error: Image directory not found at {data_dir}")
+        return
+    if escalate_model and not os.path.exists(escalate_model):
+        print(f"Error: Escalation model not found at {escalate_model}")
         return
 
     try:
-        # Initialize model
-        print("Loading model...")
-        model = md.vl(model=model_path)
-        
         # Get list of image files
-        image_files = sorted(Path(image_dir).glob('*.[jp][pn][g]'))[:num_images]
-        all_receipts = []
+        image_files = list_split_images(splits, data_dir, limit)
+        num_images = len(image_files)
+        responses = {}
+        profile_dir = new_profile_dir("app") if profile else None
 
-        # Process each image
-        for idx, image_path in enumerate(image_files, 1):
+        # Process the images on a pool of model workers
+        print(f"Loading model and analyzing {num_images} receipts...")
+        start_time = time.perf_counter()
+        for idx, image_path, response, error, seconds in run_batch(
+                model_path, PROMPT, image_files, batch_size, workers, decode_threads, profile_dir):
             print(f"\n{'='*50}")
-            print(f"Processing receipt {idx}/{num_images}: {image_path}")
+            print(f"Processed receipt {idx}/{num_images} in {seconds:.2f}s: {image_path}")
             print(f"{'='*50}")
-            
-            try:
-                # Load and encode image
-                image = Image.open(image_path)
-                encoded_image = model.encode_image(image)
-                
-                # Structured prompt
-                prompt = """
-                Analyze this receipt and respond ONLY with these exact details in this format:
-                {
-                    "store_name": "name of store/restaurant",
-                    "currency": "$" or any other,
-                    "items": [
-                        {
-                            "name": "item name",
-                            "quantity": number,
-                            "price_per_item": price,
-                            "total_price": quantity × price
-                        }
-                    ],
-                    "number_of_items": total count of unique items,
-                    "subtotal": subtotal amount,
-                    "tax": tax amount or "NA" if none,
-                    "tip": tip amount or "NA" if none,
-                    "additional_charges": additional charges or "NA" if none,
-                    "total": final total amount
-                }
-                
-                Only include information you can clearly see. Use "NA" for missing values.
-                Format all prices as decimal numbers without currency symbols.
-                Keep item names exactly as written on receipt. and give back json
 
-                """
-                
-                # Get model's response
-                print("Analyzing receipt...")
-                response = model.query(encoded_image, prompt)["answer"]
-                print("\nRaw model response:")
-                print(response)
-                
-                try:
-                    # Try to parse as JSON
-                    receipt_data = json.loads(response)
-                    receipt_data["receipt_id"] = idx
-                    receipt_data["image_path"] = str(image_path)
-                    all_receipts.append(receipt_data)
-                    
-                    print("\nStructured data extracted successfully")
-                    print(json.dumps(receipt_data, indent=2))
-                    
-                except json.JSONDecodeError as e:
-                    print(f"\nFailed to parse JSON: {str(e)}")
-                    # Create fallback structure
-                    fallback_data = {
-                        "receipt_id": idx,
-                        "image_path": str(image_path),
-                        "store_name": "NA",
-                        "items": [],
-                        "number_of_items": 0,
-                        "subtotal": "NA",
-                        "tax": "NA",
-                        "tip": "NA",
-                        "total": "NA",
-                        "raw_response": response
-                    }
-                    all_receipts.append(fallback_data)
-                    print("\nFallback data created:")
-                    print(json.dumps(fallback_data, indent=2))
-                    
-            except Exception as e:
-                print(f"Error processing image: {str(e)}")
+            if error is not None:
+                print(f"Error processing image: {error}")
                 continue
 
+            print("\nRaw model response:")
+            print(response)
+            responses[idx] = response
+
+        # Cascade: only receipts the small model got doubtful or wrong go to the bigger one
+        escalated = 0
+        if escalate_model:
+            doubtful = [idx for idx in range(1, num_images + 1)
+                        if idx not in responses or not is_confident(assess_reply(responses[idx]))]
+            escalated = len(doubtful)
+            print(f"\nEscalating {escalated}/{num_images} receipts to {escalate_model}...")
+            retry_files = [image_files[idx - 1] for idx in doubtful]
+            for position, image_path, response, error, seconds in run_batch(
+                    escalate_model, PROMPT, retry_files, batch_size, workers, decode_threads, profile_dir):
+                if error is not None:
+                    print(f"Error processing image on {escalate_model}: {error}")
+                    continue
+                responses[doubtful[position - 1]] = response
+
+        all_receipts = [parse_receipt(idx, image_files[idx - 1], response)
+                        for idx, response in sorted(responses.items())]
+        elapsed = time.perf_counter() - start_time
+
         # Save all results to JSON file
-        output_file = "receipt_analysis.json"
         with open(output_file, "w") as f:
             json.dump(all_receipts, f, indent=2)
         
         print(f"\n{'='*50}")
         print(f"Analysis complete. Processed {len(all_receipts)} receipts")
+        report_throughput(num_images, elapsed)
+        if escalate_model:
+            rate = escalated / num_images if num_images else 0.0
+            print(f"Escalation rate: {escalated}/{num_images} ({rate:.1%})")
+        if profile_dir is not None:
+            report_profile(profile_dir)
         print(f"Results saved to: {output_file}")
         print(f"{'='*50}")
         
@@ -122,4 +120,10 @@ def analyze_receipts():
         return None
 
 if __name__ == "__main__":
-    receipts = analyze_receipts()
\ No newline at end of file
+    parser = add_batch_arguments(argparse.ArgumentParser(description="Analyze receipts with moondream 0.5B"))
+    parser.add_argument("--escalate-model", default=None,
+                        help="Re-run low confidence receipts on this model, e.g. ./moondream-2b-int8.mf "
+                             "(thresholds: CASCADE_MAX_ISSUES, CASCADE_MIN_COMPLETENESS)")
+    args = parser.parse_args()
+    receipts = analyze_receipts(args.split or SPLITS, args.limit, args.batch_size, args.workers,
+                                args.decode_threads, args.output, args.escalate_model, args.data_dir, args.profile)
@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from cache import cache_from_env, make_cache_key
+from providers import ProviderError, providers_from_env
+from router import Router
+from json_extract import extract_json
+from consistency import reconcile
+from warmup import warm_up
+from metrics import (CONTENT_TYPE, PARSE_FAILURES, REGISTRY, REQUEST_SECONDS, current_trace, end_trace,
+                     stage, start_trace, wants_trace)
+
+# Load environment variables
+load_dotenv()
+
+# Configure allowed extensions
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+
+# Requests allowed in flight per process before answering 503
+MAX_IN_FLIGHT = int(os.getenv('ASGI_MAX_IN_FLIGHT', '256'))
+RETRY_AFTER = os.getenv('ASGI_RETRY_AFTER', '2')
+
+PROVIDER_NAMES = [name.strip() for name in os.getenv('ROUTER_PROVIDERS', 'groq,gemini').split(',') if name.strip()]
+HEDGE_AFTER = os.getenv('ROUTER_HEDGE_AFTER')
+
+# Route requests over all configured providers
+router = Router(
+    providers_from_env(PROVIDER_NAMES),
+    hedge_after=float(HEDGE_AFTER) if HEDGE_AFTER else None,
+    max_error_rate=float(os.getenv('ROUTER_MAX_ERROR_RATE', '0.5'))
+)
+MODEL_NAME = 'router:' + ','.join(PROVIDER_NAMES)
+
+# Cache parsed results of previously seen uploads
+result_cache = cache_from_env(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_cache.sqlite3'))
+
+# Every provider asks the same prompt(s), which key the cache
+initial_prompt = next(iter(router.providers.values())).prompt
+
+# Load the providers on a thread, so /health answers at once and /ready
+# reports when requests can be served
+warmup = warm_up(router.providers.values())
+
+in_flight = 0
+
+# Function to check allowed file extensions
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+async def read_upload(request):
+    """Return (image bytes, None) for a usable upload, else (None, error response)."""
+    form = await request.form()
+    file = form.get('image')
+
+    # Check if image file is present in request
+    if file is None or isinstance(file, str):
+        return None, JSONResponse({'error': 'No image file provided'}, status_code=400)
+
+    # Check if file is empty
+    if file.filename == '':
+        return None, JSONResponse({'error': 'No selected file'}, status_code=400)
+
+    # Check if file type is allowed
+    if not allowed_file(file.filename):
+        return None, JSONResponse({'error': 'File type not allowed'}, status_code=400)
+
+    return await file.read(), None
+
+async def health_check(request):
+    return JSONResponse({
+        'status': 'healthy',
+        'cache': result_cache.stats(),
+        'providers': router.snapshot(),
+        'in_flight': in_flight
+    })
+
+async def ready(request):
+    # A lazy or failed warm-up is (re)started by the probe itself
+    warmup.start()
+    return JSONResponse(warmup.status(), status_code=200 if warmup.ready else 503)
+
+async def metrics(request):
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+async def analyze_receipt(request):
+    # Time the request and list its stages in Server-Timing when traced
+    started = time.perf_counter()
+    token = start_trace()
+    try:
+        response = await handle_receipt(request)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint='analyze_receipt',
+                                status=response.status_code)
+        trace = current_trace()
+        if trace.stages and wants_trace(request.headers):
+            response.headers['Server-Timing'] = trace.server_timing()
+        return response
+    finally:
+        end_trace(token)
+
+async def handle_receipt(request):
+    global in_flight
+
+    # Shed load instead of queueing without bound
+    if in_flight >= MAX_IN_FLIGHT:
+        return JSONResponse({'error': 'Server is busy, try again later'}, status_code=503,
+                            headers={'Retry-After': RETRY_AFTER})
+
+    in_flight += 1
+    try:
+        with stage('read'):
+            image_data, error = await read_upload(request)
+        if error is not None:
+            return error
+
+        # Serve repeated uploads straight from the cache
+        cache_key = make_cache_key(image_data, initial_prompt, MODEL_NAME)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return JSONResponse(cached)
+
+        # Await the fastest healthy provider without tying up a thread
+        try:
+            with stage('model'):
+                provider_name, model_response = await router.acomplete(image_data)
+        except ProviderError as e:
+            return JSONResponse({'error': str(e)}, status_code=e.status_code)
+
+        try:
+            # Check the arithmetic, repairing or re-querying off the event loop
+            json_response, _ = await asyncio.to_thread(
+                reconcile, extract_json(model_response), image_data, router.providers[provider_name]
+            )
+            result_cache.set(cache_key, json_response)
+            with stage('serialize'):
+                return JSONResponse(json_response)
+        except ValueError:
+            PARSE_FAILURES.inc()
+            return JSONResponse({
+                'error': 'Failed to parse model response as JSON',
+                'provider': provider_name,
+                'raw_response': model_response
+            }, status_code=500)
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        return JSONResponse({'error': f'Error processing image: {str(e)}'}, status_code=500)
+    finally:
+        in_flight -= 1
+
+app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/ready', ready, methods=['GET']),
+        Route('/analyze_receipt', analyze_receipt, methods=['POST']),
+        Route('/metrics', metrics, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+    ],
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run('asgi:app', host='127.0.0.1', port=5000, workers=int(os.getenv('ASGI_WORKERS', '1')))
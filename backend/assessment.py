@@ -0,0 +1,52 @@
+import os
+
+from receipt import Receipt
+from consistency import check_receipt, repair_receipt
+
+# A reply is good enough when it parses, has at most this many arithmetic
+# issues left after repair and fills at least this share of the key fields
+CASCADE_MAX_ISSUES = int(os.getenv('CASCADE_MAX_ISSUES', '0'))
+CASCADE_MIN_COMPLETENESS = float(os.getenv('CASCADE_MIN_COMPLETENESS', '0.75'))
+
+KEY_FIELDS = ('name_of_establishment', 'currency', 'items', 'number_of_items', 'subtotal', 'total')
+
+
+def requested_fields(prompt):
+    """The key fields a prompt asks for, e.g. only subtotal and total for the totals re-query."""
+    return tuple(name for name in KEY_FIELDS if f'"{name}"' in prompt)
+
+
+def assess_reply(text, fields=KEY_FIELDS):
+    """
+    Score a model reply without knowing the right answer.
+
+    Args:
+        text (str): Model reply
+        fields (tuple): Key fields the reply was asked for; completeness
+            is measured against these only
+
+    Returns:
+        dict: parsed (bool), issues (arithmetic issues left after repair)
+        and completeness (share of `fields` present, 0..1)
+    """
+    try:
+        receipt = Receipt.from_text(text)
+    except ValueError:
+        return {'parsed': False, 'issues': None, 'completeness': 0.0}
+
+    repair_receipt(receipt)
+    present = sum(bool(receipt.items) if name == 'items' else getattr(receipt, name) is not None
+                  for name in fields)
+    return {
+        'parsed': True,
+        'issues': len(check_receipt(receipt)),
+        # A prompt asking for none of the key fields is judged on parsing alone
+        'completeness': round(present / len(fields), 4) if fields else 1.0,
+    }
+
+
+def is_confident(assessment, max_issues=CASCADE_MAX_ISSUES, min_completeness=CASCADE_MIN_COMPLETENESS):
+    """True if a reply scored by assess_reply() needs no escalation."""
+    return (assessment['parsed']
+            and assessment['issues'] <= max_issues
+            and assessment['completeness'] >= min_completeness)
@@ -0,0 +1,138 @@
+import ssl
+import json
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from http_client import HostConfig, configure_host, get_client, get_async_client, close_clients, aclose_clients
+from router import percentile
+
+COMPLETION = json.dumps({
+    "choices": [{"message": {"role": "assistant", "content": '{"name_of_establishment": "Mock", "total": 1.0}'}}]
+}).encode('utf-8')
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answers every POST like the Groq chat completions endpoint."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(delay, certfile=None, keyfile=None):
+    """Start the mock API on a free local port and return its URL."""
+    MockHandler.delay = delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+    server.daemon_threads = True
+    scheme = 'http'
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'{scheme}://127.0.0.1:{server.server_address[1]}/openai/v1/chat/completions'
+
+
+def payload(size):
+    return {"model": "mock", "messages": [{"role": "user", "content": "x" * size}]}
+
+
+def run_threads(send, requests_count, concurrency):
+    latencies = []
+
+    def timed(_):
+        started = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(timed, range(requests_count)))
+    return time.perf_counter() - started, latencies
+
+
+async def run_async(url, body, requests_count, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    client = get_async_client(url)
+
+    async def timed():
+        async with semaphore:
+            started = time.perf_counter()
+            (await client.post(url, json=body)).raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests_count)))
+    elapsed = time.perf_counter() - started
+    await aclose_clients()
+    return elapsed, latencies
+
+
+def report(name, elapsed, latencies):
+    result = {
+        'mode': name,
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+    }
+    print(json.dumps(result))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare per-request connections with the pooled HTTP client")
+    parser.add_argument('--requests', type=int, default=500, help="Requests per mode")
+    parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight")
+    parser.add_argument('--delay', type=float, default=0.0, help="Simulated model time per request in seconds")
+    parser.add_argument('--payload-kb', type=int, default=100, help="Size of the request body (a base64 image)")
+    parser.add_argument('--certfile', help="Serve the mock over TLS with this certificate")
+    parser.add_argument('--keyfile', help="Private key of --certfile")
+    args = parser.parse_args()
+
+    server, url = start_mock_server(args.delay, args.certfile, args.keyfile)
+    body = payload(args.payload_kb * 1024)
+    # A self-signed benchmark certificate cannot be verified
+    verify = not args.certfile
+    if not verify:
+        requests.packages.urllib3.disable_warnings()
+
+    # Current behaviour: a fresh connection (and TLS handshake) per request
+    report('requests.post', *run_threads(
+        lambda: requests.post(url, json=body, verify=verify).raise_for_status(),
+        args.requests, args.concurrency
+    ))
+
+    # Shared keep-alive pool used by the providers
+    configure_host(url, HostConfig(max_connections=args.concurrency, max_keepalive=args.concurrency, verify=verify))
+    pooled = get_client(url)
+    report('pooled', *run_threads(
+        lambda: pooled.post(url, json=body).raise_for_status(),
+        args.requests, args.concurrency
+    ))
+    close_clients()
+
+    # Async client as used by the ASGI server and dataset builder
+    report('pooled-async', *asyncio.run(run_async(url, body, args.requests, args.concurrency)))
+
+    server.shutdown()
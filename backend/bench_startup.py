@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+import requests
+
+from router import percentile
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Serves one of the Flask server modules, or the ASGI app, on the given port
+LAUNCHER = """
+import sys
+module, port = sys.argv[1], int(sys.argv[2])
+if module == 'asgi':
+    import uvicorn
+    uvicorn.run('asgi:app', host='127.0.0.1', port=port, log_level='warning')
+else:
+    __import__(module).app.run(host='127.0.0.1', port=port, threaded=True)
+"""
+
+# Prints how long importing a module takes in a fresh interpreter
+IMPORT_TIMER = """
+import sys, time
+started = time.perf_counter()
+__import__(sys.argv[1])
+print(time.perf_counter() - started)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, started, deadline):
+    """Poll `url` until it answers 200; returns the seconds since `started`, or None on timeout."""
+    while time.perf_counter() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def time_import(module, env):
+    """Seconds a fresh interpreter spends importing a server module."""
+    result = subprocess.run([sys.executable, '-c', IMPORT_TIMER, module], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def time_startup(module, env, timeout):
+    """
+    Start a server and time how long it takes to become live and ready.
+
+    Returns:
+        tuple: Seconds from launch until /health and until /ready answered
+        200, None for a probe that did not within `timeout`
+    """
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', LAUNCHER, module, str(port)], cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        live = wait_for(base + '/health', started, deadline)
+        ready = wait_for(base + '/ready', started, deadline) if live is not None else None
+    finally:
+        process.terminate()
+        process.wait()
+    return live, ready
+
+
+def report(name, values):
+    measured = [value for value in values if value is not None]
+    result = {
+        'measure': name,
+        'runs': len(values),
+        'timeouts': len(values) - len(measured),
+        'p50_ms': round(percentile(measured, 0.50) * 1000, 1) if measured else None,
+        'max_ms': round(max(measured) * 1000, 1) if measured else None,
+    }
+    print(json.dumps(result))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time how fast a server starts answering /health and /ready")
+    parser.add_argument('--server', default='serverr', help="Server module to start: server, serverg, serverl, "
+                                                             "serverr or asgi")
+    parser.add_argument('--runs', type=int, default=5, help="Cold starts to time")
+    parser.add_argument('--providers', default='stub', help="ROUTER_PROVIDERS for serverr and asgi")
+    parser.add_argument('--load-seconds', type=float, default=1.0,
+                        help="Simulated model load time of the stub provider")
+    parser.add_argument('--warm-up', choices=('background', 'lazy'), default='background',
+                        help="WARM_UP mode of the server")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Seconds to wait for a probe to pass")
+    parser.add_argument('--max-live-ms', type=float, default=None,
+                        help="Exit with an error when the median time to /health is above this")
+    args = parser.parse_args()
+
+    env = dict(os.environ, ROUTER_PROVIDERS=args.providers, STUB_LOAD_SECONDS=str(args.load_seconds),
+               WARM_UP=args.warm_up, RESULT_CACHE_PATH='')
+
+    imports = [time_import(args.server, env) for _ in range(args.runs)]
+    starts = [time_startup(args.server, env, args.timeout) for _ in range(args.runs)]
+
+    report('import', imports)
+    live = report('health', [live for live, _ in starts])
+    report('ready', [ready for _, ready in starts])
+
+    if args.max_live_ms is not None and (live['p50_ms'] is None or live['p50_ms'] > args.max_live_ms):
+        print(f"Median time to /health is above {args.max_live_ms:.0f} ms")
+        sys.exit(1)
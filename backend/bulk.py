@@ -0,0 +1,150 @@
+import io
+import os
+import json
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from flask import Response, stream_with_context
+
+# Limits of one bulk upload
+BULK_MAX_FILES = int(os.getenv('BULK_MAX_FILES', '100'))
+BULK_MAX_BYTES = int(float(os.getenv('BULK_MAX_MB', '200')) * 1024 * 1024)
+# Receipts of one upload analyzed at the same time
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', '4'))
+
+# One pool per process shared by every bulk request, so decoding,
+# preprocessing and the pooled provider connections are reused across
+# batches instead of spinning up per upload
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BULK_WORKERS', '16')))
+
+
+class UploadError(Exception):
+    """A bulk upload that cannot be processed; `status_code` is the HTTP status."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def collect_uploads(files, allowed_extensions):
+    """
+    Gather the images of a bulk upload.
+
+    Images may be sent as any number of `images` (or `image`) files and/or
+    as zip archives, whose images are extracted in memory. Files of other
+    types are skipped.
+
+    Args:
+        files: The request's uploaded files (request.files)
+        allowed_extensions (set): Image extensions to accept
+
+    Returns:
+        list: (filename, image bytes) pairs in upload order
+
+    Raises:
+        UploadError: If nothing usable was sent or the upload is too large
+    """
+    uploads = []
+    total = 0
+
+    def add(filename, data):
+        nonlocal total
+        total += len(data)
+        if len(uploads) >= BULK_MAX_FILES:
+            raise UploadError(f'Too many images, the limit is {BULK_MAX_FILES}', 413)
+        if total > BULK_MAX_BYTES:
+            raise UploadError('Upload too large', 413)
+        uploads.append((filename, data))
+
+    for file in files.getlist('images') + files.getlist('image'):
+        if not file.filename:
+            continue
+        extension = _extension(file.filename)
+        if extension == 'zip':
+            _extract_zip(file.read(), allowed_extensions, add)
+        elif extension in allowed_extensions:
+            add(file.filename, file.read())
+
+    if not uploads:
+        raise UploadError('No image files provided')
+    return uploads
+
+
+def _extract_zip(data, allowed_extensions, add):
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        raise UploadError('Invalid zip archive')
+
+    with archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or name.startswith('__MACOSX/') or _extension(name) not in allowed_extensions:
+                continue
+            # Check the declared size before inflating anything
+            if info.file_size > BULK_MAX_BYTES:
+                raise UploadError('Upload too large', 413)
+            add(name, archive.read(info))
+
+
+def analyze_many(uploads, analyze, concurrency=BULK_CONCURRENCY):
+    """
+    Analyze the receipts of a bulk upload with bounded concurrency.
+
+    At most `concurrency` receipts of the upload are in flight at once;
+    results are yielded as soon as each one finishes, not in upload order.
+
+    Args:
+        uploads (list): (filename, image bytes) pairs
+        analyze (callable): Takes image bytes, returns (response body, status code)
+        concurrency (int): Receipts analyzed at the same time
+
+    Yields:
+        dict: index, filename, status and either `result` or `error`
+    """
+    queue = list(enumerate(uploads))
+    queue.reverse()
+    running = {}
+
+    def start_next():
+        index, (filename, image_data) = queue.pop()
+        running[_executor.submit(analyze, image_data)] = (index, filename)
+
+    while queue and len(running) < concurrency:
+        start_next()
+
+    try:
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, filename = running.pop(future)
+                line = {'index': index, 'filename': filename}
+                try:
+                    body, status = future.result()
+                except Exception as e:
+                    body, status = {'error': f'Error processing image: {str(e)}'}, 500
+                line['status'] = status
+                if status == 200:
+                    line['result'] = body
+                else:
+                    line.update(body)
+                yield line
+                if queue:
+                    start_next()
+    finally:
+        # The client went away, drop the receipts that have not started
+        for future in running:
+            future.cancel()
+
+
+def ndjson_response(lines):
+    """Stream dicts as newline delimited JSON, one line per finished receipt."""
+    return Response(
+        stream_with_context(json.dumps(line) + '\n' for line in lines),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS
+
+
+def make_cache_key(image_data, prompt, model_name):
+    """
+    Build a content-addressed key for a model call.
+
+    Args:
+        image_data (bytes): Raw bytes of the uploaded image
+        prompt (str): Prompt sent to the model
+        model_name (str): Name of the model answering the prompt
+
+    Returns:
+        str: Hex sha256 digest identifying the (image, prompt, model) triple
+    """
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(image_data).digest())
+    digest.update(hashlib.sha256(prompt.encode('utf-8')).digest())
+    digest.update(model_name.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two tier cache for parsed receipt results.
+
+    The first tier is an in-memory LRU holding the most recent entries,
+    the second is a SQLite file shared by every process pointing at the
+    same path. Entries expire after `ttl` seconds and the disk tier is
+    trimmed back under `max_disk_bytes` by least recent access.
+    """
+
+    def __init__(self, path, max_items=256, max_disk_bytes=64 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = {'memory': 0, 'disk': 0}
+        self._misses = 0
+        self._evictions = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' key TEXT PRIMARY KEY,'
+                ' value TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' created REAL NOT NULL,'
+                ' accessed REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            self._db.commit()
+
+    def get(self, key):
+        """Return the cached value for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    self._hits['memory'] += 1
+                    CACHE_LOOKUPS.inc(cache='result', result='hit')
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value, created FROM results WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created = json.loads(row[0]), row[1]
+                    if now - created < self.ttl:
+                        self._db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+                        self._db.commit()
+                        self._remember(key, created, value)
+                        self._hits['disk'] += 1
+                        CACHE_LOOKUPS.inc(cache='result', result='hit')
+                        return value
+                    self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                    self._db.commit()
+
+            self._misses += 1
+            CACHE_LOOKUPS.inc(cache='result', result='miss')
+            return None
+
+    def set(self, key, value):
+        """Store a JSON serialisable `value` under `key` in both tiers."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+
+            if self._db is not None:
+                payload = json.dumps(value, separators=(',', ':'))
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                    (key, payload, len(payload), now, now)
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def stats(self):
+        """Return hit/miss counters suitable for the /health endpoint."""
+        with self._lock:
+            hits = self._hits['memory'] + self._hits['disk']
+            lookups = hits + self._misses
+            return {
+                'hits': hits,
+                'memory_hits': self._hits['memory'],
+                'disk_hits': self._hits['disk'],
+                'misses': self._misses,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'memory_entries': len(self._memory),
+            }
+
+    def _remember(self, key, created, value):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self._evictions += 1
+
+    def _evict_disk(self, now):
+        # Drop expired rows first, then the least recently used ones until
+        # the table fits the size budget again
+        cursor = self._db.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,))
+        self._evictions += max(cursor.rowcount, 0)
+
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        for key, size in self._db.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+            if total <= self.max_disk_bytes:
+                break
+            self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+            self._evictions += 1
+
+
+def cache_from_env(default_path):
+    """
+    Create a ResultCache configured from environment variables.
+
+    RESULT_CACHE_PATH        SQLite file for the disk tier ("" disables it)
+    RESULT_CACHE_ITEMS       Number of entries kept in memory
+    RESULT_CACHE_DISK_MB     Size budget of the disk tier in megabytes
+    RESULT_CACHE_TTL         Lifetime of an entry in seconds
+    """
+    return ResultCache(
+        os.getenv('RESULT_CACHE_PATH', default_path),
+        max_items=int(os.getenv('RESULT_CACHE_ITEMS', '256')),
+        max_disk_bytes=int(float(os.getenv('RESULT_CACHE_DISK_MB', '64')) * 1024 * 1024),
+        ttl=float(os.getenv('RESULT_CACHE_TTL', str(7 * 24 * 3600))),
+    )
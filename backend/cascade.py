@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import Counter
+
+from assessment import CASCADE_MAX_ISSUES, CASCADE_MIN_COMPLETENESS, assess_reply, is_confident, requested_fields
+from providers import Cancelled, Provider, providers_from_env
+
+
+class CascadeProvider(Provider):
+    """
+    Tries the cheapest provider first and escalates only doubtful replies.
+
+    Tiers are ordered from cheapest to most expensive, e.g. moondream 0.5B,
+    moondream 2B, then a remote model. Each reply is scored on parse
+    success, arithmetic consistency and field completeness; the first one
+    that passes the thresholds is returned, otherwise the last tier's. A
+    tier that fails outright also escalates. Completeness only counts the
+    fields the prompt asks for, so a totals re-query or a part prompt of
+    the fields mode is not escalated for leaving out the rest.
+    """
+
+    name = 'cascade'
+
+    def __init__(self, tiers, max_issues=CASCADE_MAX_ISSUES, min_completeness=CASCADE_MIN_COMPLETENESS):
+        super().__init__(tiers[0].prompt)
+        self.tiers = tiers
+        self.model_name = 'cascade:' + ','.join(tier.model_name for tier in tiers)
+        self.max_issues = max_issues
+        self.min_completeness = min_completeness
+        self.fields = requested_fields(self.prompt)
+        self._served = Counter()
+        self._lock = threading.Lock()
+
+    def with_prompt(self, prompt):
+        provider = super().with_prompt(prompt)
+        provider.tiers = [tier.with_prompt(prompt) for tier in self.tiers]
+        provider.fields = requested_fields(prompt)
+        return provider
+
+    def load(self):
+        for tier in self.tiers:
+            tier.load()
+        return self
+
+    def _accept(self, index, text):
+        # The last tier's answer is final whatever its score
+        return index == len(self.tiers) - 1 or is_confident(
+            assess_reply(text, self.fields), self.max_issues, self.min_completeness)
+
+    def _count(self, index):
+        with self._lock:
+            self._served[self.tiers[index].name] += 1
+
+    def complete(self, image_data, cancel=None):
+        for index, tier in enumerate(self.tiers):
+            # A lost hedge must not start the next, more expensive tier
+            if cancel is not None and cancel.is_set():
+                raise Cancelled(self.name)
+            try:
+                text = tier.complete(image_data, cancel)
+            except Cancelled:
+                raise
+            except Exception:
+                if index == len(self.tiers) - 1:
+                    raise
+                continue
+            if self._accept(index, text):
+                self._count(index)
+                return text
+
+    async def acomplete(self, image_data):
+        for index, tier in enumerate(self.tiers):
+            try:
+                text = await tier.acomplete(image_data)
+            except Exception:
+                if index == len(self.tiers) - 1:
+                    raise
+                continue
+            if self._accept(index, text):
+                self._count(index)
+                return text
+
+    def stream(self, image_data):
+        # Cheap tiers are judged on their whole reply, only the last one streams
+        for index, tier in enumerate(self.tiers[:-1]):
+            try:
+                text = tier.complete(image_data)
+            except Cancelled:
+                raise
+            except Exception:
+                continue
+            if self._accept(index, text):
+                self._count(index)
+                yield text
+                return
+        self._count(len(self.tiers) - 1)
+        yield from self.tiers[-1].stream(image_data)
+
+    def stats(self):
+        """Replies served per tier and the share that needed escalation."""
+        with self._lock:
+            served = dict(self._served)
+        total = sum(served.values())
+        first = served.get(self.tiers[0].name, 0)
+        return {
+            'served': served,
+            'escalation_rate': round(1 - first / total, 4) if total else 0.0,
+        }
+
+
+def cascade_from_env():
+    """
+    Create the cascade described by environment variables.
+
+    CASCADE_TIERS             Provider names from cheapest to most expensive, e.g.
+                              "local:./moondream-0_5b-int8.mf,local:./moondream-2b-int8.mf,groq"
+    CASCADE_MAX_ISSUES        Arithmetic issues tolerated before escalating
+    CASCADE_MIN_COMPLETENESS  Share of key fields a reply must fill (0..1)
+    """
+    names = [name.strip() for name in os.getenv(
+        'CASCADE_TIERS', 'local:./moondream-0_5b-int8.mf,local:./moondream-2b-int8.mf').split(',') if name.strip()]
+    if 'cascade' in names:
+        raise ValueError('A cascade cannot contain itself')
+    return CascadeProvider(providers_from_env(names))
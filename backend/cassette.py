@@ -0,0 +1,149 @@
+import os
+import time
+import zlib
+import sqlite3
+import asyncio
+import threading
+
+from cache import make_cache_key
+
+MODES = ('auto', 'record', 'replay')
+
+
+class CassetteMiss(LookupError):
+    """Raised in replay mode when no reply was recorded for a call."""
+
+
+class Cassette:
+    """
+    Recorded model replies keyed by (image hash, prompt, model).
+
+    Replies live zlib-compressed in a single SQLite file so a whole split
+    fits in a few hundred kilobytes and lookups are one indexed read.
+
+    Modes:
+        auto     replay recorded replies, call the model and record on a miss
+        record   always call the model and overwrite the recording
+        replay   never call the model, a miss raises CassetteMiss
+
+    `latency` simulates the model while replaying: None replays instantly,
+    "recorded" sleeps for as long as the original call took and a number
+    sleeps that many seconds.
+    """
+
+    def __init__(self, path, mode='auto', latency=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode '{mode}', expected one of {', '.join(MODES)}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS replies ('
+            ' key TEXT PRIMARY KEY,'
+            ' model TEXT NOT NULL,'
+            ' response BLOB NOT NULL,'
+            ' seconds REAL NOT NULL,'
+            ' recorded REAL NOT NULL)'
+        )
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM replies').fetchone()[0]
+
+    def get(self, key):
+        """Return (reply text, original seconds) for `key`, or None."""
+        with self._lock:
+            row = self._db.execute('SELECT response, seconds FROM replies WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode('utf-8'), row[1]
+
+    def put(self, key, model_name, response, seconds):
+        """Record the reply of one model call."""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO replies (key, model, response, seconds, recorded) VALUES (?, ?, ?, ?, ?)',
+                (key, model_name, zlib.compress(response.encode('utf-8'), 9), seconds, time.time())
+            )
+            self._db.commit()
+
+    def delay(self, seconds):
+        """Seconds to wait before handing out a replayed reply."""
+        if self.latency is None:
+            return 0.0
+        if self.latency == 'recorded':
+            return seconds
+        return float(self.latency)
+
+    def lookup(self, image_data, prompt, model_name):
+        """
+        Find the recorded reply of a call, honouring the cassette mode.
+
+        Returns:
+            tuple: (key, reply text or None, original seconds or None)
+
+        Raises:
+            CassetteMiss: In replay mode when nothing was recorded
+        """
+        key = make_cache_key(image_data, prompt, model_name)
+        if self.mode != 'record':
+            hit = self.get(key)
+            if hit is not None:
+                return (key,) + hit
+        if self.mode == 'replay':
+            raise CassetteMiss(f'No recorded reply from {model_name} for this image')
+        return key, None, None
+
+    def call(self, image_data, prompt, model_name, call):
+        """
+        Replay a recorded reply or run `call()` and record what it returns.
+
+        Args:
+            image_data (bytes): Raw bytes of the image sent to the model
+            prompt (str): Prompt sent with the image
+            model_name (str): Model answering the prompt
+            call (callable): Performs the real model call, returns the reply text
+
+        Returns:
+            str: The reply text
+        """
+        key, response, seconds = self.lookup(image_data, prompt, model_name)
+        if response is not None:
+            time.sleep(self.delay(seconds))
+            return response
+
+        started = time.perf_counter()
+        response = call()
+        self.put(key, model_name, response, time.perf_counter() - started)
+        return response
+
+    async def acall(self, image_data, prompt, model_name, call):
+        """Async variant of call(), `call()` returns an awaitable."""
+        key, response, seconds = self.lookup(image_data, prompt, model_name)
+        if response is not None:
+            await asyncio.sleep(self.delay(seconds))
+            return response
+
+        started = time.perf_counter()
+        response = await call()
+        self.put(key, model_name, response, time.perf_counter() - started)
+        return response
+
+
+def cassette_from_env():
+    """
+    Create the Cassette configured by environment variables, or None.
+
+    MODEL_CASSETTE           SQLite file holding the recorded replies (unset disables it)
+    MODEL_CASSETTE_MODE      auto, record or replay
+    MODEL_CASSETTE_LATENCY   "recorded", a number of seconds, or unset to replay instantly
+    """
+    path = os.getenv('MODEL_CASSETTE')
+    if not path:
+        return None
+    latency = os.getenv('MODEL_CASSETTE_LATENCY') or None
+    return Cassette(path, os.getenv('MODEL_CASSETTE_MODE', 'auto'), latency)
@@ -0,0 +1,240 @@
+import os
+import copy
+from decimal import Decimal
+
+from receipt import Receipt
+from preprocess import crop_band_bytes
+from metrics import timed
+
+TOLERANCE = Decimal(os.getenv('CONSISTENCY_TOLERANCE', '0.02'))
+# Re-ask the model about receipts that are still inconsistent after repair
+REQUERY = os.getenv('CONSISTENCY_REQUERY', '1') == '1'
+# Part of the receipt (as fractions of its height) holding the totals
+TOTALS_BAND = (float(os.getenv('CONSISTENCY_TOTALS_TOP', '0.5')), 1.0)
+
+# A dropped decimal point multiplies an amount by one of these
+_SLIP_FACTORS = (Decimal(100), Decimal(10), Decimal(1000))
+_CENT = Decimal('0.01')
+_AMOUNT_FIELDS = ('subtotal', 'tax', 'tip', 'additional_charges', 'total')
+
+TOTALS_PROMPT = """
+Read only the totals at the bottom of this receipt and respond ONLY with:
+{
+    "subtotal": subtotal amount,
+    "tax": tax amount or "NA" if none,
+    "tip": tip amount or "NA" if none,
+    "additional_charges": additional charges or "NA" if none,
+    "total": final total amount
+}
+Format all amounts as decimal numbers without currency symbols.
+Respond with only the JSON object, nothing else.
+"""
+
+
+def _close(value, expected, tolerance):
+    return abs(value - expected) <= tolerance
+
+
+def _unslip(value, factor):
+    """
+    Undo a dropped decimal point, or None if `value` cannot be one.
+
+    A dropped point leaves a whole number ("1389" for 13.89), and undoing it
+    must give at most two decimals, so 13.89 or 28 -> 0.028 are left alone.
+    """
+    if value != value.to_integral_value():
+        return None
+    fixed = value / factor
+    if fixed != fixed.quantize(_CENT):
+        return None
+    return fixed
+
+
+def _slip(value, expected, tolerance):
+    """Return `value` with a dropped decimal point restored if that makes it match `expected`."""
+    if not expected:
+        return None
+    for factor in _SLIP_FACTORS:
+        fixed = _unslip(value, factor)
+        if fixed is not None and _close(fixed, expected, tolerance):
+            return fixed
+    return None
+
+
+def _items_sum(receipt):
+    totals = [item.total_price for item in receipt.items]
+    if not totals or any(total is None for total in totals):
+        return None
+    return sum(totals, Decimal(0))
+
+
+def _extras(receipt):
+    return sum((value for value in (receipt.tax, receipt.tip, receipt.additional_charges) if value is not None),
+               Decimal(0))
+
+
+def check_receipt(receipt, tolerance=TOLERANCE):
+    """
+    List the arithmetic the receipt gets wrong.
+
+    Checks quantity * price_per_item == total_price for every item, that
+    the items add up to the subtotal and that subtotal + tax + tip +
+    additional charges add up to the total. Missing values are skipped.
+
+    Returns:
+        list: Human readable issues, empty when the receipt is consistent
+    """
+    issues = []
+    for index, item in enumerate(receipt.items):
+        if None not in (item.quantity, item.price_per_item, item.total_price):
+            if not _close(item.quantity * item.price_per_item, item.total_price, tolerance):
+                issues.append(f'item {index}: {item.quantity} x {item.price_per_item} != {item.total_price}')
+
+    items_sum = _items_sum(receipt)
+    if items_sum is not None and receipt.subtotal is not None:
+        # Rounding adds up over many lines
+        if not _close(items_sum, receipt.subtotal, tolerance * max(1, len(receipt.items))):
+            issues.append(f'items sum to {items_sum}, subtotal is {receipt.subtotal}')
+
+    if receipt.subtotal is not None and receipt.total is not None:
+        expected = receipt.subtotal + _extras(receipt)
+        if not _close(expected, receipt.total, tolerance):
+            issues.append(f'subtotal + charges = {expected}, total is {receipt.total}')
+    return issues
+
+
+def repair_receipt(receipt, tolerance=TOLERANCE):
+    """
+    Fix obvious slips in place: dropped decimal points and values that follow from the others.
+
+    Returns:
+        list: Descriptions of the fixes applied
+    """
+    fixes = []
+
+    for index, item in enumerate(receipt.items):
+        quantity, price, total = item.quantity, item.price_per_item, item.total_price
+        if None not in (quantity, price, total) and not _close(quantity * price, total, tolerance):
+            if (fixed := _slip(total, quantity * price, tolerance)) is not None:
+                item.total_price = fixed
+                fixes.append(f'item {index}: total_price {total} -> {fixed}')
+            elif quantity and (fixed := _slip(price, total / quantity, tolerance)) is not None:
+                item.price_per_item = fixed
+                fixes.append(f'item {index}: price_per_item {price} -> {fixed}')
+        elif total is None and None not in (quantity, price):
+            item.total_price = (quantity * price).quantize(_CENT)
+            fixes.append(f'item {index}: total_price filled in as {item.total_price}')
+        elif price is None and None not in (quantity, total) and quantity:
+            item.price_per_item = (total / quantity).quantize(_CENT)
+            fixes.append(f'item {index}: price_per_item filled in as {item.price_per_item}')
+
+    items_sum = _items_sum(receipt)
+    if items_sum is not None:
+        item_tolerance = tolerance * max(1, len(receipt.items))
+        if receipt.subtotal is None:
+            receipt.subtotal = items_sum
+            fixes.append(f'subtotal filled in as {items_sum}')
+        elif not _close(items_sum, receipt.subtotal, item_tolerance):
+            if (fixed := _slip(receipt.subtotal, items_sum, item_tolerance)) is not None:
+                fixes.append(f'subtotal {receipt.subtotal} -> {fixed}')
+                receipt.subtotal = fixed
+            else:
+                # A single line item with a dropped decimal point
+                for index, item in enumerate(receipt.items):
+                    fixed = _slip(item.total_price, receipt.subtotal - items_sum + item.total_price, tolerance)
+                    if fixed is not None:
+                        fixes.append(f'item {index}: total_price {item.total_price} -> {fixed}')
+                        item.total_price = fixed
+                        if item.price_per_item is not None and item.quantity:
+                            item.price_per_item = (fixed / item.quantity).quantize(_CENT)
+                        break
+
+    if receipt.subtotal is not None:
+        expected = receipt.subtotal + _extras(receipt)
+        if receipt.total is None:
+            receipt.total = expected
+            fixes.append(f'total filled in as {expected}')
+        elif not _close(expected, receipt.total, tolerance):
+            if (fixed := _slip(receipt.total, expected, tolerance)) is not None:
+                fixes.append(f'total {receipt.total} -> {fixed}')
+                receipt.total = fixed
+            else:
+                # One of the parts of the total lost its decimal point
+                for name in _AMOUNT_FIELDS[:-1]:
+                    value = getattr(receipt, name)
+                    if value is None:
+                        continue
+                    fixed = _slip(value, receipt.total - expected + value, tolerance)
+                    if fixed is not None:
+                        setattr(receipt, name, fixed)
+                        fixes.append(f'{name} {value} -> {fixed}')
+                        break
+    return fixes
+
+
+def requery_totals(receipt, image_data, provider, tolerance=TOLERANCE):
+    """
+    Re-read the totals of an inconsistent receipt from a crop of its bottom.
+
+    The targeted prompt is much shorter than the full one and the image
+    much smaller, so this costs a fraction of a second full call. Providers
+    that cache encoded images get the whole image instead, whose encoding
+    they already hold. The new totals are kept only if they leave fewer
+    issues than the old ones.
+
+    Returns:
+        bool: True if the re-read totals were applied
+    """
+    if getattr(provider, 'caches_encodings', False):
+        band = image_data
+    else:
+        band = crop_band_bytes(image_data, *TOTALS_BAND)
+    reply = provider.with_prompt(TOTALS_PROMPT).complete(band)
+    try:
+        totals = Receipt.from_text(reply)
+    except ValueError:
+        return False
+
+    candidate = copy.deepcopy(receipt)
+    for name in _AMOUNT_FIELDS:
+        value = getattr(totals, name)
+        if value is not None:
+            setattr(candidate, name, value)
+    repair_receipt(candidate, tolerance)
+
+    if len(check_receipt(candidate, tolerance)) >= len(check_receipt(receipt, tolerance)):
+        return False
+    for name in _AMOUNT_FIELDS:
+        setattr(receipt, name, getattr(candidate, name))
+    return True
+
+
+@timed('reconcile')
+def reconcile(data, image_data=None, provider=None, requery=REQUERY, tolerance=TOLERANCE):
+    """
+    Validate a parsed receipt, repair it and re-query it only if still needed.
+
+    Args:
+        data (dict): Receipt as parsed from the model reply
+        image_data (bytes): Original upload, needed for re-querying
+        provider (Provider): Provider used to re-read the totals
+        requery (bool): Allow a re-query when repairs were not enough
+
+    Returns:
+        tuple: (receipt dict in the frontend's format, report dict with the
+        fixes applied, remaining issues and whether a re-query happened)
+    """
+    receipt = Receipt.from_dict(data)
+    fixes = repair_receipt(receipt, tolerance)
+    issues = check_receipt(receipt, tolerance)
+
+    requeried = False
+    if issues and requery and provider is not None and image_data is not None:
+        try:
+            requeried = requery_totals(receipt, image_data, provider, tolerance)
+        except Exception as e:
+            print(f"Totals re-query failed: {e}")
+        if requeried:
+            issues = check_receipt(receipt, tolerance)
+
+    return receipt.to_dict(), {'fixes': fixes, 'issues': issues, 'requeried': requeried}
@@ -0,0 +1,132 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS, stage
+
+# Memory budget of the encoded images kept per process
+EMBEDDING_CACHE_BYTES = int(float(os.getenv('EMBEDDING_CACHE_MB', '512')) * 1024 * 1024)
+# Size assumed for an encoded image whose tensors cannot be measured
+EMBEDDING_FALLBACK_BYTES = int(float(os.getenv('EMBEDDING_FALLBACK_MB', '8')) * 1024 * 1024)
+
+
+def image_hash(image_data):
+    """Key of an image in the cache: the sha256 of its raw bytes."""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def measure(value, depth=0, seen=None):
+    """
+    Estimate the bytes held by an encoded image.
+
+    Sums the buffers of the numpy arrays / torch tensors it contains,
+    looking through containers, dataclasses and plain objects a few levels
+    deep. Returns 0 when nothing measurable is found.
+    """
+    if value is None or depth > 4:
+        return 0
+    seen = seen if seen is not None else set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if hasattr(value, 'element_size') and hasattr(value, 'nelement'):
+        return value.element_size() * value.nelement()
+
+    if isinstance(value, dict):
+        children = value.values()
+    elif isinstance(value, (list, tuple)):
+        children = value
+    elif hasattr(value, '__dict__'):
+        children = vars(value).values()
+    elif hasattr(value, '__slots__'):
+        children = [getattr(value, name, None) for name in value.__slots__]
+    else:
+        return 0
+    return sum(measure(child, depth + 1, seen) for child in children)
+
+
+class EncodedImageCache:
+    """
+    LRU cache of vision encoder outputs under a memory budget.
+
+    Encoding dominates the cost of a moondream call on CPU, while the
+    query on an encoded image is cheap, so every further prompt about the
+    same image (per-field questions, re-queries after a failed check,
+    follow-up questions) skips the encoder.
+    """
+
+    def __init__(self, max_bytes=EMBEDDING_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def set(self, key, encoded):
+        size = measure(encoded) or EMBEDDING_FALLBACK_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (encoded, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self._evictions += 1
+
+    def encode(self, model, key, load_image):
+        """
+        Return the encoded image for `key`, running the encoder only on a miss.
+
+        Args:
+            model: moondream model with an encode_image() method
+            key: Cache key, e.g. (model name, image_hash(image_data))
+            load_image (callable): Returns the decoded image to encode
+
+        Returns:
+            The model's encoded image
+        """
+        encoded = self.get(key)
+        CACHE_LOOKUPS.inc(cache='embedding', result='miss' if encoded is None else 'hit')
+        if encoded is None:
+            image = load_image()
+            with stage('encode_image'):
+                encoded = model.encode_image(image)
+            self.set(key, encoded)
+        return encoded
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+            }
+
+
+# One cache per process; forked workers each start with an empty one
+encoded_images = EncodedImageCache()
@@ -0,0 +1,161 @@
+import os
+import json
+import threading
+from collections import Counter
+
+from json_extract import extract_json
+from receipt import Receipt
+from consistency import TOTALS_PROMPT
+from providers import Cancelled, Provider
+
+# "single" asks for the whole receipt in one prompt, "fields" splits it
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'single')
+
+HEADER_PROMPT = """
+Read the top of this receipt and respond ONLY with:
+{
+    "name_of_establishment": "name of store/restaurant",
+    "currency": "$" or "rupees" any other
+}
+Use "NA" for values you cannot clearly see.
+Respond with only the JSON object, nothing else.
+"""
+
+ITEMS_PROMPT = """
+List the purchased items of this receipt and respond ONLY with:
+{
+    "items": [
+        {
+            "name": "item name",
+            "quantity": number,
+            "price_per_item": price,
+            "total_price": quantity * price
+        }
+    ],
+    "number_of_items": total count of unique items
+}
+Keep item names exactly as written on receipt.
+Format all prices as decimal numbers without currency symbols.
+Respond with only the JSON object, nothing else.
+"""
+
+# Part name -> (prompt, receipt fields taken from its reply)
+FIELD_PARTS = {
+    'header': (HEADER_PROMPT, ('name_of_establishment', 'currency')),
+    'items': (ITEMS_PROMPT, ('items', 'number_of_items')),
+    'totals': (TOTALS_PROMPT, ('subtotal', 'tax', 'tip', 'additional_charges', 'total')),
+}
+
+
+def merge_replies(replies, parts=FIELD_PARTS):
+    """
+    Combine the replies of the part prompts into one receipt dict.
+
+    Args:
+        replies (dict): Part name -> reply text, or the exception it raised
+        parts (dict): Part name -> (prompt, fields), as FIELD_PARTS
+
+    Returns:
+        tuple: (receipt dict in the frontend's format, or None if no part
+        parsed, and the names of the parts that failed)
+    """
+    merged = {}
+    failed = []
+    for part, (_, names) in parts.items():
+        reply = replies.get(part)
+        try:
+            if isinstance(reply, Exception) or reply is None:
+                raise ValueError(part)
+            data = extract_json(reply)
+            if not isinstance(data, dict):
+                raise ValueError(part)
+        except ValueError:
+            failed.append(part)
+            continue
+        merged.update({name: data[name] for name in names if name in data})
+    if len(failed) == len(parts):
+        return None, failed
+    # Fields of failed parts come out as "NA"
+    return Receipt.from_dict(merged).to_dict(), failed
+
+
+class FieldsProvider(Provider):
+    """
+    Extracts a receipt with short per-part prompts instead of one long one.
+
+    Header fields, line items and totals are asked for separately and at
+    the same time, and the replies are merged into the usual receipt JSON.
+    Each reply is short, so the slowest part decides the latency rather
+    than the whole generation, and a part that breaks its JSON only loses
+    its own fields. Moondream answers all parts from one encoded image.
+    """
+
+    def __init__(self, provider, parts=FIELD_PARTS):
+        # The part prompts stand in for the single prompt, e.g. in cache keys
+        super().__init__(''.join(prompt for prompt, _ in parts.values()))
+        self.provider = provider
+        self.parts = parts
+        self.name = provider.name
+        self.model_name = provider.model_name
+        self.caches_encodings = provider.caches_encodings
+        self._failures = Counter()
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def with_prompt(self, prompt):
+        # A custom prompt, e.g. a totals re-query, is asked as it is
+        return self.provider.with_prompt(prompt)
+
+    def load(self):
+        self.provider.load()
+        return self
+
+    def _merge(self, replies):
+        replies = dict(zip(self.parts, replies))
+        receipt, failed = merge_replies(replies, self.parts)
+        with self._lock:
+            self._calls += 1
+            self._failures.update(failed)
+        if receipt is None:
+            errors = [reply for reply in replies.values() if isinstance(reply, Exception)]
+            if len(errors) == len(replies):
+                raise errors[0]
+            # Nothing parsed: hand back the raw replies so the caller reports them
+            return '\n'.join(reply for reply in replies.values() if isinstance(reply, str))
+        return json.dumps(receipt)
+
+    def complete(self, image_data, cancel=None):
+        # A lost hedge stops its parts at their next chunk and is not merged
+        if cancel is not None and cancel.is_set():
+            raise Cancelled(self.name)
+        replies = self.provider.complete_many(image_data, [prompt for prompt, _ in self.parts.values()], cancel)
+        if cancel is not None and cancel.is_set():
+            raise Cancelled(self.name)
+        return self._merge(replies)
+
+    async def acomplete(self, image_data):
+        return self._merge(await self.provider.acomplete_many(
+            image_data, [prompt for prompt, _ in self.parts.values()]))
+
+    def stream(self, image_data):
+        # The receipt only exists once every part has answered
+        yield self.complete(image_data)
+
+    def stats(self):
+        """Calls made and the share of them each part failed to parse."""
+        with self._lock:
+            calls = self._calls
+            failures = dict(self._failures)
+        return {
+            'calls': calls,
+            'part_failure_rate': {part: round(failures.get(part, 0) / calls, 4) if calls else 0.0
+                                  for part in self.parts},
+        }
+
+
+def with_fields(provider, mode=None):
+    """Wrap `provider` in a FieldsProvider when the extraction mode (EXTRACTION_MODE) is "fields"."""
+    mode = mode or EXTRACTION_MODE
+    if mode not in ('single', 'fields'):
+        raise ValueError(f"Unknown extraction mode '{mode}', expected 'single' or 'fields'")
+    return FieldsProvider(provider) if mode == 'fields' else provider
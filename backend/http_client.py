@@ -0,0 +1,135 @@
+import os
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2 = os.getenv('HTTP_CLIENT_HTTP2', '1') == '1'
+except ImportError:
+    HTTP2 = False
+
+
+class HostConfig:
+    """Connection pool limits and timeouts for one remote host."""
+
+    def __init__(self, max_connections=20, max_keepalive=10, keepalive_expiry=60.0,
+                 connect_timeout=5.0, read_timeout=120.0, write_timeout=30.0, pool_timeout=10.0,
+                 verify=True):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.pool_timeout = pool_timeout
+        self.verify = verify
+
+    def limits(self):
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def timeout(self):
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.write_timeout,
+            pool=self.pool_timeout,
+        )
+
+
+DEFAULT_CONFIG = HostConfig(
+    max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', '20')),
+    max_keepalive=int(os.getenv('HTTP_MAX_KEEPALIVE', '10')),
+    connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', '5')),
+    read_timeout=float(os.getenv('HTTP_READ_TIMEOUT', '120')),
+)
+
+_host_configs = {}
+_clients = {}
+_async_clients = {}
+_lock = threading.Lock()
+
+
+def _host(url):
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+def configure_host(url, config):
+    """
+    Set the pool limits and timeouts used for the host of `url`.
+
+    Must be called before the first request to that host.
+    """
+    with _lock:
+        _host_configs[_host(url)] = config
+
+
+def get_client(url):
+    """
+    Return the shared keep-alive client for the host of `url`.
+
+    One client (and so one connection pool) exists per host and process,
+    so repeated calls reuse open TCP/TLS connections.
+    """
+    host = _host(url)
+    client = _clients.get(host)
+    if client is None:
+        with _lock:
+            client = _clients.get(host)
+            if client is None:
+                config = _host_configs.get(host, DEFAULT_CONFIG)
+                client = httpx.Client(http2=HTTP2, limits=config.limits(), timeout=config.timeout(),
+                                      verify=config.verify)
+                _clients[host] = client
+    return client
+
+
+def get_async_client(url):
+    """
+    Return the shared async keep-alive client for the host of `url`.
+
+    Async clients are bound to the event loop that created them, so one is
+    kept per host and running loop.
+    """
+    host = _host(url)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    key = (host, id(loop))
+    client = _async_clients.get(key)
+    if client is None:
+        with _lock:
+            client = _async_clients.get(key)
+            if client is None:
+                config = _host_configs.get(host, DEFAULT_CONFIG)
+                client = httpx.AsyncClient(http2=HTTP2, limits=config.limits(), timeout=config.timeout(),
+                                           verify=config.verify)
+                _async_clients[key] = client
+    return client
+
+
+def close_clients():
+    """Close every shared synchronous client, e.g. at shutdown or after fork."""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+async def aclose_clients():
+    """Close the async clients of the running event loop."""
+    loop_id = id(asyncio.get_running_loop())
+    with _lock:
+        keys = [key for key in _async_clients if key[1] == loop_id]
+        clients = [_async_clients.pop(key) for key in keys]
+    for client in clients:
+        await client.aclose()
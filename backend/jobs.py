@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import socket
+import sqlite3
+import ipaddress
+import argparse
+import importlib
+import threading
+import multiprocessing
+from urllib.parse import urlsplit
+
+JOBS_PATH = os.getenv('JOBS_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3'))
+# Seconds a worker may hold a job before another worker takes it over
+JOBS_LEASE = float(os.getenv('JOBS_LEASE', '300'))
+JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', '3'))
+JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', '0.5'))
+WEBHOOK_ATTEMPTS = 3
+# Hosts webhooks may be sent to, e.g. "hooks.example.com,api.example.org";
+# when unset any host is allowed except loopback, private and link-local ones
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv('WEBHOOK_ALLOWED_HOSTS', '').split(',')
+                         if host.strip()}
+
+
+class JobStore:
+    """
+    Persistent job queue in a SQLite file.
+
+    Jobs are keyed for idempotency by the (image, prompt, model) hash, so a
+    client retrying an upload gets the existing job back instead of a
+    duplicate. Workers lease jobs; a job whose worker died is picked up
+    again once its lease expires, so the queue survives restarts.
+    """
+
+    def __init__(self, path=JOBS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id TEXT PRIMARY KEY,'
+            ' key TEXT NOT NULL UNIQUE,'
+            ' model TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' image BLOB,'
+            ' webhook TEXT,'
+            ' result TEXT,'
+            ' error TEXT,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' lease_until REAL,'
+            ' created REAL NOT NULL,'
+            ' updated REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (model, status, created)')
+
+    def submit(self, key, model_name, image_data, webhook=None):
+        """
+        Queue an image for analysis unless the same job already exists.
+
+        A job that failed before is queued again; queued, running and
+        finished jobs are returned unchanged.
+
+        Returns:
+            tuple: (job dict, True if a new job was queued)
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute('SELECT id, status FROM jobs WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    job_id = uuid.uuid4().hex
+                    self._db.execute(
+                        'INSERT INTO jobs (id, key, model, status, image, webhook, created, updated)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (job_id, key, model_name, 'queued', image_data, webhook, now, now)
+                    )
+                    created = True
+                elif row[1] == 'failed':
+                    job_id = row[0]
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'queued', image = ?, webhook = COALESCE(?, webhook),"
+                        ' error = NULL, attempts = 0, lease_until = NULL, updated = ? WHERE id = ?',
+                        (image_data, webhook, now, job_id)
+                    )
+                    created = True
+                else:
+                    job_id, created = row[0], False
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return self.get(job_id), created
+
+    def get(self, job_id):
+        """Return the public view of a job, or None if it does not exist."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT id, status, result, error, attempts, created, updated FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = {'id': row[0], 'status': row[1], 'attempts': row[4], 'created': row[5], 'updated': row[6]}
+        if row[2] is not None:
+            job['result'] = json.loads(row[2])
+        if row[3] is not None:
+            # Failed jobs carry the same error body /analyze_receipt would return
+            job.update(json.loads(row[3]))
+        return job
+
+    def claim(self, model_name, lease=JOBS_LEASE, max_attempts=JOBS_MAX_ATTEMPTS):
+        """
+        Lease the oldest runnable job of a model.
+
+        A job whose lease expired `max_attempts` times is failed instead of
+        leased again: its worker died on it every time (e.g. killed for
+        running out of memory), so retry() never got to count it.
+
+        Returns:
+            tuple: (job id, image bytes, webhook) or None if the queue is empty
+        """
+        now = time.time()
+        error = json.dumps({'error': f'Worker died while processing the image ({max_attempts} attempts)'})
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, image = NULL, lease_until = NULL, updated = ?"
+                    " WHERE model = ? AND status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (error, now, model_name, now, max_attempts)
+                )
+                row = self._db.execute(
+                    'SELECT id, image, webhook FROM jobs WHERE model = ?'
+                    " AND (status = 'queued' OR (status = 'running' AND lease_until < ? AND attempts < ?))"
+                    ' ORDER BY created LIMIT 1',
+                    (model_name, now, max_attempts)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?,"
+                        ' updated = ? WHERE id = ?',
+                        (now + lease, now, row[0])
+                    )
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return row
+
+    def finish(self, job_id, body, status_code):
+        """Store the outcome of a job as returned by analyze_image(); the image is dropped."""
+        status = 'done' if status_code == 200 else 'failed'
+        column = 'result' if status == 'done' else 'error'
+        with self._lock:
+            self._db.execute(
+                f'UPDATE jobs SET status = ?, {column} = ?, image = NULL, lease_until = NULL, updated = ?'
+                ' WHERE id = ?',
+                (status, json.dumps(body), time.time(), job_id)
+            )
+
+    def retry(self, job_id, error, max_attempts=JOBS_MAX_ATTEMPTS):
+        """Put a job that crashed back in the queue, or fail it after `max_attempts`."""
+        with self._lock:
+            attempts = self._db.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+        if attempts >= max_attempts:
+            self.finish(job_id, {'error': error}, 500)
+            return
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL, updated = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+
+    def stats(self):
+        """Number of jobs per status."""
+        with self._lock:
+            return dict(self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+
+def validate_webhook(url, allowed_hosts=WEBHOOK_ALLOWED_HOSTS):
+    """
+    Check that a client supplied webhook URL is safe for the server to call.
+
+    Without an allowlist, hosts resolving to loopback, private, link-local
+    or otherwise reserved addresses are refused, so a webhook cannot be
+    used to reach services inside our network.
+
+    Raises:
+        ValueError: With the reason the URL is refused
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError('Webhook must be an http(s) URL')
+    host = parts.hostname.lower()
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise ValueError('Webhook host is not allowed')
+        return
+
+    try:
+        infos = socket.getaddrinfo(host, parts.port or (443 if parts.scheme == 'https' else 80),
+                                   proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError('Webhook host does not resolve')
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError('Webhook host must be a public address')
+
+
+def send_webhook(url, job):
+    """POST the finished job to the client's webhook, retrying a few times."""
+    from http_client import get_client
+
+    # Checked again at send time, the host may resolve elsewhere by now
+    try:
+        validate_webhook(url)
+    except ValueError as e:
+        print(f"Webhook for job {job['id']} refused: {e}")
+        return False
+
+    for attempt in range(WEBHOOK_ATTEMPTS):
+        try:
+            response = get_client(url).post(url, json=job)
+            if response.status_code < 500:
+                return True
+        except Exception as e:
+            print(f"Webhook for job {job['id']} failed: {e}")
+        time.sleep(2 ** attempt)
+    return False
+
+
+def work(server_module, path=JOBS_PATH, poll_interval=JOBS_POLL_INTERVAL):
+    """
+    Worker loop: run queued jobs through a server's analyze_image().
+
+    Args:
+        server_module (str): Backend module whose jobs to run, e.g. "serverg"
+        path (str): SQLite file of the queue
+        poll_interval (float): Seconds to wait when the queue is empty
+    """
+    # Importing the server sets up its provider, prompt and result cache
+    server = importlib.import_module(server_module)
+    store = JobStore(path)
+
+    while True:
+        claimed = store.claim(server.MODEL_NAME)
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+
+        job_id, image_data, webhook = claimed
+        try:
+            body, status_code = server.analyze_image(image_data)
+        except Exception as e:
+            store.retry(job_id, f'Error processing image: {str(e)}')
+            continue
+
+        store.finish(job_id, body, status_code)
+        if webhook:
+            send_webhook(webhook, store.get(job_id))
+
+
+def serve(server_module, workers, path=JOBS_PATH):
+    """Run `workers` worker processes and restart any that exit."""
+    def start():
+        process = multiprocessing.Process(target=work, args=(server_module, path), daemon=True)
+        process.start()
+        return process
+
+    # Stop the workers too when the supervisor is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    processes = [start() for _ in range(workers)]
+    print(f"Job workers ({workers}) for {server_module} on {path}")
+
+    try:
+        while True:
+            for slot, process in enumerate(processes):
+                if not process.is_alive():
+                    print(f"Job worker {slot} exited with code {process.exitcode}, restarting")
+                    processes[slot] = start()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Worker processes for the /jobs queue")
+    parser.add_argument('--server', default='serverg', choices=('server', 'serverg', 'serverl', 'serverr'),
+                        help="Backend whose analyze logic runs the jobs")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('JOBS_WORKERS', '2')),
+                        help="Number of worker processes")
+    parser.add_argument('--path', default=JOBS_PATH, help="SQLite file of the queue")
+    args = parser.parse_args()
+
+    serve(args.server, args.workers, args.path)
@@ -0,0 +1,218 @@
+import re
+import json
+
+from metrics import timed
+
+# Characters that change the scanner state outside and inside strings
+_STRUCTURE = re.compile(r'[{}\[\],"]')
+_STRING = re.compile(r'["\\]')
+
+
+class JSONStreamExtractor:
+    """
+    Incrementally recover the first JSON object from model output.
+
+    Text is fed in chunks as it arrives from the provider. The scanner
+    balances braces and brackets while skipping over string contents, so
+    markdown fences, leading chatter and trailing prose are ignored. As soon
+    as the top-level object closes and parses, `done` becomes True and the
+    caller can stop reading (and generating) further tokens.
+
+    When `on_event` is given it is called as parts of the object complete:
+    `on_event('field', key, value)` for every top-level member and
+    `on_event('item', key, value)` for every object inside a top-level
+    array, e.g. each entry of "items".
+    """
+
+    def __init__(self, opening='{', on_event=None):
+        self.opening = opening
+        self.on_event = on_event
+        self.done = False
+        self._text = ''
+        self._pos = 0
+        self._start = None
+        self._stack = []
+        self._in_string = False
+        self._value = None
+        self._member_start = None
+        self._array_key = None
+        self._item_start = None
+
+    @property
+    def text(self):
+        """All text fed so far."""
+        return self._text
+
+    @property
+    def json_text(self):
+        """Text of the extracted JSON value, or None while incomplete."""
+        if not self.done:
+            return None
+        return self._text[self._start:self._pos]
+
+    def value(self):
+        """Return the parsed JSON value, raising ValueError if none was found."""
+        if not self.done:
+            raise ValueError("No JSON object found in response")
+        return self._value
+
+    def feed(self, chunk):
+        """
+        Consume the next chunk of text.
+
+        Args:
+            chunk (str): Newly received text
+
+        Returns:
+            bool: True once a complete JSON value has been extracted
+        """
+        if self.done:
+            return True
+        self._text += chunk
+        text = self._text
+
+        while True:
+            if self._start is None:
+                # Look for the opening of the top-level value
+                start = min(
+                    (index for index in (text.find(char, self._pos) for char in self.opening) if index != -1),
+                    default=-1
+                )
+                if start == -1:
+                    self._pos = len(text)
+                    return False
+                self._start = start
+                self._pos = start + 1
+                self._stack = [text[start]]
+                self._member_start = self._pos
+                continue
+
+            if self._in_string:
+                match = _STRING.search(text, self._pos)
+                if match is None:
+                    self._pos = len(text)
+                    return False
+                if match.group() == '\\':
+                    # Wait for the escaped character before moving past it
+                    if match.end() >= len(text):
+                        self._pos = match.start()
+                        return False
+                    self._pos = match.end() + 1
+                    continue
+                self._in_string = False
+                self._pos = match.end()
+                continue
+
+            match = _STRUCTURE.search(text, self._pos)
+            if match is None:
+                self._pos = len(text)
+                return False
+            self._pos = match.end()
+            char = match.group()
+            if char == '"':
+                self._in_string = True
+            elif char == ',':
+                if len(self._stack) == 1:
+                    self._emit_member(match.start())
+            elif char in '{[':
+                self._stack.append(char)
+                if self.on_event is not None:
+                    self._track_open(char, match.start())
+            else:
+                if self.on_event is not None:
+                    self._track_close(char)
+                self._stack.pop()
+                if not self._stack:
+                    try:
+                        self._value = json.loads(text[self._start:self._pos])
+                    except ValueError:
+                        # Balanced but not JSON (e.g. braces in prose), try
+                        # again from the next opening character
+                        self._pos = self._start + 1
+                        self._start = None
+                        continue
+                    self.done = True
+                    return True
+
+    def _track_open(self, char, position):
+        if len(self._stack) == 2 and char == '[':
+            key = self._text[self._member_start:position].strip().rstrip(':').strip()
+            try:
+                self._array_key = json.loads(key)
+            except ValueError:
+                self._array_key = None
+        elif len(self._stack) == 3 and char == '{' and self._stack[1] == '[':
+            self._item_start = position
+
+    def _track_close(self, char):
+        if len(self._stack) == 3 and char == '}' and self._item_start is not None:
+            try:
+                item = json.loads(self._text[self._item_start:self._pos])
+            except ValueError:
+                item = None
+            self._item_start = None
+            if item is not None:
+                self.on_event('item', self._array_key, item)
+        elif len(self._stack) == 1:
+            self._emit_member(self._pos - 1)
+
+    def _emit_member(self, end):
+        start, self._member_start = self._member_start, end + 1
+        if self.on_event is None or self._stack[0] != '{':
+            return
+        member = self._text[start:end].strip()
+        if not member:
+            return
+        try:
+            parsed = json.loads('{' + member + '}')
+        except ValueError:
+            return
+        for key, value in parsed.items():
+            self.on_event('field', key, value)
+
+
+@timed('extract')
+def extract_json(text, opening='{'):
+    """
+    Extract the first JSON object from a complete model reply.
+
+    Args:
+        text (str): Model reply, possibly wrapped in fences or prose
+        opening (str): Characters that may open the top-level value
+
+    Returns:
+        The parsed JSON value
+
+    Raises:
+        ValueError: If the reply contains no valid JSON value
+    """
+    extractor = JSONStreamExtractor(opening)
+    extractor.feed(text)
+    return extractor.value()
+
+
+def read_json_stream(chunks, opening='{'):
+    """
+    Read streamed model output until the top-level JSON value closes.
+
+    The chunk iterator is closed as soon as the value is complete so the
+    provider can stop generating tokens nobody will read.
+
+    Args:
+        chunks (iterable): Text chunks as produced by a streaming model call
+        opening (str): Characters that may open the top-level value
+
+    Returns:
+        JSONStreamExtractor: The extractor holding the text read so far
+    """
+    extractor = JSONStreamExtractor(opening)
+    iterator = iter(chunks)
+    try:
+        for chunk in iterator:
+            if extractor.feed(chunk):
+                break
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+    return extractor
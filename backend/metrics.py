@@ -0,0 +1,237 @@
+import os
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets, from a PIL resize to a slow model call
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Requests carrying this header get a Server-Timing header with their stages
+TRACE_HEADER = os.getenv('METRICS_TRACE_HEADER', 'X-Trace')
+# Add Server-Timing to every response, not only to traced requests
+TRACE_ALL = os.getenv('METRICS_TRACE_ALL', '0') == '1'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """A monotonically increasing count, one series per label combination."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, with their sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", le)])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}'
+
+
+class Registry:
+    """The metrics of this process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'bill_read_stage_seconds', 'Seconds spent in each stage of handling a receipt', ('stage',))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'bill_read_request_seconds', 'Seconds until the response (or its first byte) was ready',
+    ('endpoint', 'status'))
+PARSE_FAILURES = REGISTRY.counter(
+    'bill_read_parse_failures_total', 'Model replies that held no JSON receipt')
+PROVIDER_ERRORS = REGISTRY.counter(
+    'bill_read_provider_errors_total', 'Provider calls that failed', ('provider',))
+CACHE_LOOKUPS = REGISTRY.counter(
+    'bill_read_cache_lookups_total', 'Cache lookups by cache and outcome', ('cache', 'result'))
+
+
+class Trace:
+    """Stage timings of one request, in the order they finished."""
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name, seconds):
+        self.stages.append((name, seconds))
+
+    def server_timing(self):
+        """Format the stages as a Server-Timing header value (durations in ms)."""
+        return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.stages)
+
+
+_current_trace = contextvars.ContextVar('bill_read_trace', default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def start_trace():
+    """Start collecting the stages of the current request; returns a token for end_trace()."""
+    return _current_trace.set(Trace())
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def record(name, seconds):
+    """Count `seconds` spent in stage `name`, in the histogram and the current trace."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """Decorator timing every call of a function as stage `name`."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def wants_trace(headers):
+    return TRACE_ALL or bool(headers.get(TRACE_HEADER))
+
+
+def instrument(app):
+    """
+    Add request timing, the optional Server-Timing trace and GET /metrics to a Flask app.
+
+    Request durations are recorded per endpoint and status. Requests sent
+    with the trace header (X-Trace: 1) get a Server-Timing header listing
+    the time spent in every stage, e.g. "read;dur=0.41, model;dur=812.30".
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start():
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = start_trace()
+
+    @app.after_request
+    def _finish(response):
+        started = g.pop('metrics_started', None)
+        if started is not None and request.endpoint != 'metrics':
+            REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                    endpoint=request.endpoint or 'unknown', status=response.status_code)
+        trace = current_trace()
+        if trace is not None and trace.stages and wants_trace(request.headers):
+            response.headers['Server-Timing'] = trace.server_timing()
+        return response
+
+    @app.teardown_request
+    def _end(exc=None):
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            try:
+                end_trace(token)
+            except ValueError:
+                # Streamed responses finish in another context
+                pass
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    return app
@@ -0,0 +1,244 @@
+import os
+import io
+import time
+import argparse
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from PIL import Image
+from dotenv import load_dotenv
+from preprocess import preprocess_image
+from embeddings import encoded_images, image_hash
+from json_extract import read_json_stream
+from metrics import current_trace, end_trace, record, stage, start_trace
+from receipt import RECEIPT_PROMPT
+from warmup import read_warm_up_image
+
+# Load environment variables
+load_dotenv()
+
+# Address and shared secret of the inference socket
+MODEL_SOCKET = os.getenv('MODEL_SOCKET', '/tmp/bill_read_model.sock')
+MODEL_AUTHKEY = os.getenv('MODEL_AUTHKEY', 'bill_read').encode('utf-8')
+MODEL_TIMEOUT = float(os.getenv('MODEL_TIMEOUT', '120'))
+
+
+def load_model():
+    """
+    Build the moondream model used by an inference worker.
+
+    A local .mf file given by MOONDREAM_MODEL_PATH takes precedence over
+    the hosted model reached with MOONDREAM_API_KEY.
+    """
+    import moondream as md
+
+    model_path = os.getenv('MOONDREAM_MODEL_PATH')
+    if model_path:
+        return md.vl(model=model_path)
+
+    api_key = os.getenv('MOONDREAM_API_KEY')
+    if not api_key:
+        raise ValueError("MOONDREAM_API_KEY or MOONDREAM_MODEL_PATH environment variable must be set")
+    return md.vl(api_key=api_key)
+
+
+def answer_chunks(model, job):
+    """Encode the uploaded image, or reuse its cached encoding, and stream the answer."""
+    encoded_image = encoded_images.encode(
+        model, image_hash(job['image']),
+        lambda: preprocess_image(Image.open(io.BytesIO(job['image']))))
+    with stage('query'):
+        yield from model.query(encoded_image, job['prompt'], stream=True)['answer']
+
+
+def run_job(model, job):
+    # Stop generating once the JSON object closes
+    return read_json_stream(answer_chunks(model, job)).text
+
+
+def run_prompts(model, job):
+    """Answer every prompt of a job from a single encoding of its image."""
+    replies = []
+    for prompt in job['prompts']:
+        try:
+            replies.append(('ok', run_job(model, {'image': job['image'], 'prompt': prompt})))
+        except Exception as e:
+            replies.append(('error', str(e)))
+    return replies
+
+
+def worker_loop(listener, worker_id):
+    # Every worker loads its own copy of the model once, then competes with
+    # its siblings for connections on the shared listening socket
+    model = load_model()
+    warm_up_image = read_warm_up_image()
+    if warm_up_image is not None:
+        # Run one receipt through the model before taking real jobs
+        started = time.perf_counter()
+        try:
+            run_job(model, {'image': warm_up_image, 'prompt': RECEIPT_PROMPT})
+            print(f"Worker {worker_id} warmed up in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            print(f"Worker {worker_id} failed to warm up: {e}")
+    print(f"Inference worker {worker_id} ready (pid {os.getpid()})")
+
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            print(f"Worker {worker_id} failed to accept a connection: {e}")
+            continue
+
+        with conn:
+            try:
+                job = conn.recv()
+            except EOFError:
+                continue
+            # Stage timings go back to the HTTP process ahead of the answer
+            token = start_trace()
+            try:
+                if job.get('ping'):
+                    conn.send(('ok', None))
+                elif job.get('stream'):
+                    # Forward chunks as they are generated; a client that
+                    # hangs up early makes send() fail and stops generation
+                    for chunk in answer_chunks(model, job):
+                        conn.send(('chunk', chunk))
+                    conn.send(('timings', current_trace().stages))
+                    conn.send(('done', None))
+                else:
+                    replies = run_prompts(model, job)
+                    conn.send(('timings', current_trace().stages))
+                    conn.send(('ok', replies))
+            except (BrokenPipeError, ConnectionResetError):
+                continue
+            except Exception as e:
+                try:
+                    conn.send(('error', str(e)))
+                except OSError:
+                    pass
+            finally:
+                end_trace(token)
+
+
+def serve(workers, address=MODEL_SOCKET, authkey=MODEL_AUTHKEY):
+    """
+    Start `workers` inference processes behind a Unix socket and keep them alive.
+
+    The listening socket is created once and inherited by forked workers, so
+    the kernel hands each incoming request to whichever worker is idle.
+    """
+    if os.path.exists(address):
+        os.unlink(address)
+    listener = Listener(address, 'AF_UNIX', authkey=authkey)
+    context = multiprocessing.get_context('fork')
+
+    def start(worker_id):
+        process = context.Process(target=worker_loop, args=(listener, worker_id), daemon=True)
+        process.start()
+        return process
+
+    processes = [start(worker_id) for worker_id in range(workers)]
+    print(f"Model server listening on {address} with {workers} workers")
+
+    try:
+        while True:
+            # Replace workers that crashed or were killed
+            for worker_id, process in enumerate(processes):
+                if not process.is_alive():
+                    print(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+                    processes[worker_id] = start(worker_id)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        listener.close()
+        if os.path.exists(address):
+            os.unlink(address)
+
+
+def _receive(conn, timeout):
+    """Receive the next reply of a worker, recording the stage timings it reports on the way."""
+    while True:
+        if not conn.poll(timeout):
+            raise TimeoutError(f"Model server did not answer within {timeout}s")
+        status, payload = conn.recv()
+        if status != 'timings':
+            return status, payload
+        for name, seconds in payload:
+            record(name, seconds)
+
+
+class ModelClient:
+    """Dispatches inference jobs from the HTTP layer to the model server."""
+
+    def __init__(self, address=MODEL_SOCKET, authkey=MODEL_AUTHKEY, timeout=MODEL_TIMEOUT):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+
+    def ping(self, timeout=5):
+        """
+        Wait for an inference worker to answer.
+
+        Workers only accept jobs once their model is loaded (and warmed),
+        so an answer means the model server can take requests.
+
+        Raises:
+            OSError: If the model server is not listening yet
+            TimeoutError: If no worker answered within `timeout` seconds
+        """
+        with Client(self.address, 'AF_UNIX', authkey=self.authkey) as conn:
+            conn.send({'ping': True})
+            _receive(conn, timeout)
+
+    def query_many(self, image_data, prompts):
+        """
+        Run several prompts against an image on the same inference worker.
+
+        The worker encodes the image once, so every prompt after the first
+        only pays for generating its answer.
+
+        Returns:
+            list: One answer per prompt, or a RuntimeError for prompts that failed
+        """
+        with Client(self.address, 'AF_UNIX', authkey=self.authkey) as conn:
+            conn.send({'image': image_data, 'prompts': list(prompts)})
+            status, payload = _receive(conn, self.timeout * max(1, len(prompts)))
+
+        if status == 'error':
+            raise RuntimeError(payload)
+        return [answer if status == 'ok' else RuntimeError(answer) for status, answer in payload]
+
+    def stream(self, image_data, prompt):
+        """
+        Stream the model's answer for an image chunk by chunk.
+
+        Closing the generator early hangs up on the worker, which stops it
+        from generating the rest of the answer.
+
+        Yields:
+            str: Text chunks as the model produces them
+        """
+        with Client(self.address, 'AF_UNIX', authkey=self.authkey) as conn:
+            conn.send({'image': image_data, 'prompt': prompt, 'stream': True})
+            while True:
+                status, payload = _receive(conn, self.timeout)
+                if status == 'chunk':
+                    yield payload
+                elif status == 'error':
+                    raise RuntimeError(payload)
+                else:
+                    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Moondream inference worker pool")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('MODEL_WORKERS', os.cpu_count() or 1)),
+                        help="Number of inference processes (default: CPU count)")
+    parser.add_argument('--socket', default=MODEL_SOCKET, help="Unix socket to listen on")
+    args = parser.parse_args()
+
+    serve(args.workers, args.socket)
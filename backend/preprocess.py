@@ -0,0 +1,188 @@
+import os
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from metrics import CACHE_LOOKUPS, stage
+
+# Preprocessing settings, tuned for receipts read by vision models
+TARGET_LONG_EDGE = int(os.getenv('PREPROCESS_LONG_EDGE', '1280'))
+JPEG_QUALITY = int(os.getenv('PREPROCESS_JPEG_QUALITY', '80'))
+GRAYSCALE = os.getenv('PREPROCESS_GRAYSCALE', '0') == '1'
+CROP = os.getenv('PREPROCESS_CROP', '1') == '1'
+CACHE_BYTES = int(float(os.getenv('PREPROCESS_CACHE_MB', '32')) * 1024 * 1024)
+
+# Size of the thumbnail used to find the receipt and the brightness above
+# which a pixel counts as paper
+_DETECT_SIZE = 256
+_PAPER_THRESHOLD = 150
+_CROP_MARGIN = 0.02
+
+
+class _BytesLRU:
+    """Thread-safe LRU of byte strings bounded by their total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+_cache = _BytesLRU(CACHE_BYTES)
+
+
+def crop_to_receipt(image):
+    """
+    Crop away the background around a receipt.
+
+    The receipt is found as the bounding box of bright (paper) pixels on a
+    small grayscale thumbnail. The crop is skipped when the box is tiny or
+    already covers nearly the whole image.
+    """
+    ratio = _DETECT_SIZE / float(max(image.size))
+    if ratio < 1:
+        size = (max(1, int(image.width * ratio)), max(1, int(image.height * ratio)))
+        thumbnail = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    else:
+        thumbnail = image
+    thumbnail = ImageOps.grayscale(thumbnail)
+    mask = thumbnail.point(lambda value: 255 if value > _PAPER_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return image
+
+    width, height = thumbnail.size
+    left, top, right, bottom = bbox
+    coverage = (right - left) * (bottom - top) / float(width * height)
+    if coverage < 0.2 or coverage > 0.95:
+        return image
+
+    # Scale the box back to the full image and keep a small margin
+    scale_x = image.width / float(width)
+    scale_y = image.height / float(height)
+    margin_x = image.width * _CROP_MARGIN
+    margin_y = image.height * _CROP_MARGIN
+    return image.crop((
+        max(0, int(left * scale_x - margin_x)),
+        max(0, int(top * scale_y - margin_y)),
+        min(image.width, int(right * scale_x + margin_x)),
+        min(image.height, int(bottom * scale_y + margin_y)),
+    ))
+
+
+def preprocess_image(image, long_edge=TARGET_LONG_EDGE, grayscale=GRAYSCALE, crop=CROP):
+    """
+    Prepare a decoded image for a vision model.
+
+    Args:
+        image (PIL.Image.Image): Opened image, ideally not loaded yet
+        long_edge (int): Maximum size of the longest side in pixels
+        grayscale (bool): Convert to single channel grayscale
+        crop (bool): Crop to the receipt bounds
+
+    Returns:
+        PIL.Image.Image: Oriented, cropped and downscaled image
+    """
+    with stage('decode'):
+        # Let the JPEG decoder downscale by DCT scaling while decoding
+        if image.format == 'JPEG':
+            image.draft('L' if grayscale else 'RGB', (long_edge, long_edge))
+        image.load()
+
+    with stage('preprocess'):
+        return _prepare(image, long_edge, grayscale, crop)
+
+
+def _prepare(image, long_edge, grayscale, crop):
+    image = ImageOps.exif_transpose(image)
+    if grayscale:
+        image = ImageOps.grayscale(image)
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    if crop:
+        image = crop_to_receipt(image)
+
+    if max(image.size) > long_edge:
+        image.thumbnail((long_edge, long_edge), Image.LANCZOS)
+    return image
+
+
+def preprocess_bytes(image_data, long_edge=TARGET_LONG_EDGE, grayscale=GRAYSCALE, crop=CROP,
+                     quality=JPEG_QUALITY):
+    """
+    Preprocess raw upload bytes and re-encode them as a compact JPEG.
+
+    Results are cached by the hash of the input and the settings, so the
+    same upload is only processed once.
+
+    Args:
+        image_data (bytes): Raw bytes of the uploaded image
+        long_edge (int): Maximum size of the longest side in pixels
+        grayscale (bool): Convert to single channel grayscale
+        crop (bool): Crop to the receipt bounds
+        quality (int): JPEG quality of the output
+
+    Returns:
+        bytes: JPEG encoded image
+    """
+    key = hashlib.sha256(image_data).hexdigest() + f':{long_edge}:{int(grayscale)}:{int(crop)}:{quality}'
+    cached = _cache.get(key)
+    CACHE_LOOKUPS.inc(cache='preprocess', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        return cached
+
+    image = preprocess_image(Image.open(io.BytesIO(image_data)), long_edge, grayscale, crop)
+    with stage('recompress'):
+        buffered = io.BytesIO()
+        image.save(buffered, format='JPEG', quality=quality, optimize=True)
+        result = buffered.getvalue()
+
+    _cache.set(key, result)
+    return result
+
+
+def crop_band_bytes(image_data, top=0.5, bottom=1.0, long_edge=TARGET_LONG_EDGE, quality=JPEG_QUALITY):
+    """
+    Cut a horizontal band out of the preprocessed receipt, e.g. its totals.
+
+    Args:
+        image_data (bytes): Raw bytes of the uploaded image
+        top (float): Upper edge of the band as a fraction of the height
+        bottom (float): Lower edge of the band as a fraction of the height
+
+    Returns:
+        bytes: JPEG encoded band
+    """
+    image = preprocess_image(Image.open(io.BytesIO(image_data)), long_edge * 2)
+    width, height = image.size
+    band = image.crop((0, int(height * top), width, int(height * bottom)))
+    if max(band.size) > long_edge:
+        band.thumbnail((long_edge, long_edge), Image.LANCZOS)
+    buffered = io.BytesIO()
+    band.save(buffered, format='JPEG', quality=quality, optimize=True)
+    return buffered.getvalue()
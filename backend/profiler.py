@@ -0,0 +1,224 @@
+import os
+import sys
+import hmac
+import time
+import random
+import threading
+from collections import Counter
+
+# Fraction of requests profiled without being asked to, e.g. 0.01
+PROFILE_RATE = float(os.getenv('PROFILE_RATE', '0'))
+# Requests carrying this header are always profiled ("" ignores the header)
+PROFILE_HEADER = os.getenv('PROFILE_HEADER', 'X-Profile')
+# Value the profile header must carry; the header is ignored while unset, so
+# anonymous clients cannot make the server profile and write files
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+# Profiles kept in PROFILE_DIR at most, further requests are not profiled
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '1000'))
+# Where profiles are written, one folded stack file per request or batch run
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# Seconds between two samples
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', '5')) / 1000
+# Profile the batch scripts without passing --profile
+PROFILE_BATCH = os.getenv('PROFILE_BATCH', '0') == '1'
+
+# Frame labels by code object, so a sample costs a dict lookup per frame
+_labels = {}
+
+
+def frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+    return label
+
+
+def is_idle(frame):
+    """True for a thread pool thread waiting for its next task, which only pads a profile."""
+    code = frame.f_code
+    return code.co_name == '_worker' and code.co_filename.endswith(os.path.join('concurrent', 'futures', 'thread.py'))
+
+
+def fold(frame):
+    """Return the stack of `frame` in the folded format, outermost call first."""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of running threads from a background thread.
+
+    Every `interval` seconds the current stack of each watched thread is
+    counted, which costs the profiled code nothing between samples. The
+    samples are wall-clock: a thread blocked on a model call or a lock is
+    counted where it waits, which is usually what a slow request is doing.
+    Idle thread pool threads are left out.
+
+    Args:
+        thread_ids (set): Threads to sample, all but the sampler's own by default
+        interval (float): Seconds between two samples
+    """
+
+    def __init__(self, thread_ids=None, interval=PROFILE_INTERVAL):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and return the sampled stacks as {folded stack: count}."""
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._started
+        return self.stacks
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                if is_idle(frame):
+                    continue
+                self.stacks[fold(frame)] += 1
+            self.samples += 1
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def write_folded(stacks, path):
+    """
+    Write sampled stacks as "frame;frame;frame count" lines.
+
+    This is the input of flamegraph.pl and speedscope, e.g.
+    `flamegraph.pl profiles/x.folded > x.svg`. Returns the path written.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f'{stack} {count}\n')
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_folded(path):
+    stacks = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(count)
+    return stacks
+
+
+def merge_folded(paths):
+    """Add up the stacks of several folded files, e.g. those of every batch worker."""
+    stacks = Counter()
+    for path in paths:
+        stacks.update(read_folded(path))
+    return stacks
+
+
+def summarize(stacks, top=15):
+    """
+    Rank the functions of a profile.
+
+    Returns:
+        list: (frame, self samples, total samples) of the `top` functions by
+        self samples, where self counts the samples a function was running
+        in and total those it was anywhere on the stack
+    """
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    return [(frame, count, total[frame]) for frame, count in own.most_common(top)]
+
+
+def format_summary(stacks, top=15):
+    samples = sum(stacks.values())
+    lines = [f'{samples} samples']
+    if samples:
+        lines.append(f"{'self':>7} {'total':>7}  function")
+        for frame, own, total in summarize(stacks, top):
+            lines.append(f'{own / samples:>7.1%} {total / samples:>7.1%}  {frame}')
+    return '\n'.join(lines)
+
+
+def profile_path(name, directory=PROFILE_DIR):
+    """A new, unique file name for a profile, e.g. profiles/20240101-120000-analyze_receipt-1a2b3c.folded."""
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    return os.path.join(directory, f'{stamp}-{name}-{os.getpid():x}{random.getrandbits(24):06x}.folded')
+
+
+def wants_profile(headers, rate=PROFILE_RATE, token=PROFILE_TOKEN):
+    if PROFILE_HEADER and token and hmac.compare_digest(headers.get(PROFILE_HEADER, ''), token):
+        return True
+    return rate > 0 and random.random() < rate
+
+
+def count_profiles(directory=PROFILE_DIR):
+    """Number of request profiles in `directory`."""
+    try:
+        return sum(1 for name in os.listdir(directory) if name.endswith('.folded'))
+    except FileNotFoundError:
+        return 0
+
+
+def profile_requests(app, directory=PROFILE_DIR, rate=PROFILE_RATE, max_files=PROFILE_MAX_FILES):
+    """
+    Profile a fraction of a Flask app's requests, and those asking for it.
+
+    A request sent with the profile header set to PROFILE_TOKEN
+    (X-Profile: <token>), or picked at random with probability `rate`, has
+    the thread handling it sampled until its response is ready. The profile
+    is written to `directory` and its file name returned in the
+    X-Profile-File response header. Work the request hands to other threads
+    shows up as the wait for it. Once `directory` holds `max_files`
+    profiles no more are taken.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _start_profile():
+        if wants_profile(request.headers, rate) and count_profiles(directory) < max_files:
+            g.profiler = SamplingProfiler({threading.get_ident()}).start()
+
+    @app.after_request
+    def _stop_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            path = write_folded(profiler.stop(), profile_path(request.endpoint or 'request', directory))
+            response.headers['X-Profile-File'] = os.path.basename(path)
+        return response
+
+    @app.teardown_request
+    def _drop_profile(exc=None):
+        # A request that failed before its response never reaches _stop_profile
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+
+    return app
@@ -0,0 +1,602 @@
+import io
+import os
+import copy
+import json
+import asyncio
+import threading
+import time
+import random
+import base64
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from http_client import get_client, get_async_client
+from preprocess import preprocess_bytes, preprocess_image
+from json_extract import JSONStreamExtractor
+from cassette import CassetteMiss, cassette_from_env
+from receipt import RECEIPT_PROMPT
+from embeddings import encoded_images, image_hash
+from metrics import PROVIDER_ERRORS, stage
+
+GROQ_URL = os.getenv('GROQ_API_URL', 'https://api.groq.com/openai/v1/chat/completions')
+
+
+class ProviderError(Exception):
+    """A provider failed to answer; `status_code` is the HTTP status to report."""
+
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Cancelled(Exception):
+    """Raised inside a provider call that lost a hedged race."""
+
+
+@contextmanager
+def counting_errors(provider):
+    """Count the exceptions raised in the block as errors of `provider`, lost hedges aside."""
+    try:
+        yield
+    except Cancelled:
+        raise
+    except Exception:
+        PROVIDER_ERRORS.inc(provider=provider.name)
+        raise
+
+
+class Provider:
+    """
+    A model that can read a receipt image.
+
+    Subclasses implement `stream()`, yielding the reply text in chunks.
+    `complete()` reads the stream until the JSON object closes and can be
+    cancelled between chunks through a threading.Event.
+    """
+
+    name = 'provider'
+    model_name = 'unknown'
+    # True if follow-up prompts about an image reuse its encoding, which
+    # makes asking about the whole image as cheap as asking about a crop
+    caches_encodings = False
+
+    def __init__(self, prompt=RECEIPT_PROMPT):
+        self.prompt = prompt
+
+    def stream(self, image_data):
+        raise NotImplementedError
+
+    def load(self):
+        """
+        Load the SDK or model behind this provider ahead of the first request.
+
+        Heavy imports and model files are deferred to here, so servers start
+        answering /health at once; see warmup.py. Providers with nothing to
+        load do nothing.
+        """
+        return self
+
+    def with_prompt(self, prompt):
+        """Return a copy of this provider that sends `prompt` instead."""
+        provider = copy.copy(self)
+        provider.prompt = prompt
+        return provider
+
+    def complete(self, image_data, cancel=None):
+        """
+        Return the model's reply for an image.
+
+        Args:
+            image_data (bytes): Raw bytes of the uploaded image
+            cancel (threading.Event): Optional flag that aborts the call
+
+        Returns:
+            str: Reply text up to the end of the JSON object
+        """
+        extractor = JSONStreamExtractor()
+        chunks = self.stream(image_data)
+        try:
+            with counting_errors(self):
+                for chunk in chunks:
+                    if cancel is not None and cancel.is_set():
+                        raise Cancelled(self.name)
+                    if extractor.feed(chunk):
+                        break
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        return extractor.text
+
+    async def acomplete(self, image_data):
+        """
+        Async variant of complete() for the ASGI server.
+
+        Providers without a native async client run the blocking call on a
+        worker thread; cancelling the task stops it at the next chunk.
+        """
+        cancel = threading.Event()
+        try:
+            return await asyncio.to_thread(self.complete, image_data, cancel)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+
+    def complete_many(self, image_data, prompts, cancel=None):
+        """
+        Ask several prompts about one image at once.
+
+        Args:
+            image_data (bytes): Raw bytes of the uploaded image
+            prompts (list): Prompts to send instead of this provider's own
+            cancel (threading.Event): Optional flag that aborts the calls
+
+        Returns:
+            list: One reply per prompt, or the exception that prompt raised
+        """
+        def ask(prompt):
+            try:
+                return self.with_prompt(prompt).complete(image_data, cancel)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, len(prompts))) as executor:
+            # Each part runs in a copy of the caller's context, keeping its request trace
+            futures = [executor.submit(contextvars.copy_context().run, ask, prompt) for prompt in prompts]
+            return [future.result() for future in futures]
+
+    async def acomplete_many(self, image_data, prompts):
+        """Async variant of complete_many()."""
+        return await asyncio.gather(*(self.with_prompt(prompt).acomplete(image_data) for prompt in prompts),
+                                    return_exceptions=True)
+
+
+class MoondreamProvider(Provider):
+    """Moondream served by the inference workers of model_server.py."""
+
+    name = 'moondream'
+    caches_encodings = True
+
+    def __init__(self, prompt=RECEIPT_PROMPT, client=None):
+        super().__init__(prompt)
+        from model_server import ModelClient
+
+        self.client = client or ModelClient()
+        self.model_name = os.getenv('MOONDREAM_MODEL_PATH') or 'moondream-cloud'
+
+    def load(self):
+        # The workers load the model before they accept jobs, so an answer means it is loaded
+        try:
+            self.client.ping()
+        except OSError as e:
+            raise ProviderError(f'Model server at {self.client.address} is not up: {e}', 503)
+        return self
+
+    def stream(self, image_data):
+        # Closing this generator hangs up on the worker and stops generation
+        yield from self.client.stream(image_data, self.prompt)
+
+    def complete_many(self, image_data, prompts, cancel=None):
+        # One worker encodes the image once and answers every prompt from it;
+        # once submitted the job runs to the end, so a lost hedge stops here
+        if cancel is not None and cancel.is_set():
+            return [Cancelled(self.name)] * len(prompts)
+        try:
+            return self.client.query_many(image_data, prompts)
+        except Exception as e:
+            return [e] * len(prompts)
+
+
+# Models loaded by LocalMoondreamProvider, by path, with the lock
+# serializing calls to each; shared by every provider using the same file
+_local_models = {}
+_local_models_lock = threading.Lock()
+
+
+def _local_model_slot(model_path):
+    with _local_models_lock:
+        slot = _local_models.get(model_path)
+        if slot is None:
+            slot = _local_models[model_path] = {'model': None, 'lock': threading.RLock()}
+        return slot
+
+
+class LocalMoondreamProvider(Provider):
+    """
+    Moondream loaded in this process from a .mf file.
+
+    Lets several model sizes run side by side, e.g. as tiers of a cascade.
+    The model is loaded on first use or by load(), once per file, and calls
+    are serialized. Copies made by with_prompt(), e.g. for per-part prompts
+    or totals re-queries, share the model and its encoded images.
+    """
+
+    caches_encodings = True
+
+    def __init__(self, model_path, prompt=RECEIPT_PROMPT):
+        super().__init__(prompt)
+        self.model_path = model_path
+        self.model_name = model_path
+        self.name = 'moondream:' + os.path.splitext(os.path.basename(model_path))[0]
+        self._slot = _local_model_slot(model_path)
+        self._lock = self._slot['lock']
+
+    def load(self):
+        with self._lock:
+            if self._slot['model'] is None:
+                import moondream as md
+
+                self._slot['model'] = md.vl(model=self.model_path)
+        return self._slot['model']
+
+    def stream(self, image_data):
+        key = (self.model_path, image_hash(image_data))
+        with self._lock:
+            model = self.load()
+            encoded_image = encoded_images.encode(
+                model, key, lambda: preprocess_image(Image.open(io.BytesIO(image_data))))
+            with stage('query'):
+                yield from model.query(encoded_image, self.prompt, stream=True)['answer']
+
+
+class GeminiProvider(Provider):
+    """Google Gemini through the google-generativeai SDK."""
+
+    name = 'gemini'
+
+    def __init__(self, api_key, model_name='gemini-1.5-flash', prompt=RECEIPT_PROMPT):
+        super().__init__(prompt)
+        self.api_key = api_key
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        # The SDK takes seconds to import, so it is imported on first use
+        with self._lock:
+            if self._model is None:
+                if not self.api_key:
+                    raise ProviderError('GEMINI_API_KEY environment variable is not set', 503)
+                import google.generativeai as genai
+
+                # Configure the Gemini API client
+                genai.configure(api_key=self.api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    def stream(self, image_data):
+        image = preprocess_image(Image.open(io.BytesIO(image_data)))
+        response = self.load().generate_content([
+            self.prompt,
+            image
+        ], stream=True)
+        for chunk in response:
+            yield chunk.text
+
+    async def acomplete(self, image_data):
+        with counting_errors(self):
+            image = await asyncio.to_thread(preprocess_image, Image.open(io.BytesIO(image_data)))
+            model = await asyncio.to_thread(self.load)
+            response = await model.generate_content_async([
+                self.prompt,
+                image
+            ])
+            return response.text
+
+
+class GroqProvider(Provider):
+    """Llama vision models on Groq's OpenAI compatible API."""
+
+    name = 'groq'
+
+    def __init__(self, api_key, model_name='llama-3.2-90b-vision-preview', prompt=RECEIPT_PROMPT):
+        super().__init__(prompt)
+        self.api_key = api_key
+        self.model_name = model_name
+
+    def build_payload(self, image_data, stream=False):
+        """Prepare the payload for Groq API."""
+        # Downscale and recompress, then convert image to base64
+        img_str = base64.b64encode(preprocess_bytes(image_data)).decode('utf-8')
+        payload = {
+            "model": self.model_name,
+            "messages": [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": self.prompt},
+                {"role": "user", "content": f"![receipt](data:image/jpeg;base64,{img_str})"}
+            ]
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def load(self):
+        if not self.api_key:
+            raise ProviderError('GROQ_API_KEY environment variable is not set', 503)
+        # Set up the pooled keep-alive client ahead of the first request
+        get_client(GROQ_URL)
+        return self
+
+    def headers(self):
+        return {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+
+    def complete(self, image_data, cancel=None):
+        if cancel is not None:
+            return super().complete(image_data, cancel)
+
+        # A single non-streamed request is cheapest when nobody may cancel it,
+        # sent over the pooled keep-alive connection to Groq
+        with counting_errors(self):
+            response = get_client(GROQ_URL).post(GROQ_URL, headers=self.headers(),
+                                                 json=self.build_payload(image_data))
+            return self.reply_text(response)
+
+    def reply_text(self, response):
+        """Return the reply of a non-streamed Groq response, raising ProviderError if it has none."""
+        if response.status_code != 200:
+            raise ProviderError('Failed to get response from Groq API', response.status_code)
+
+        response_data = response.json()
+        if 'choices' in response_data and len(response_data['choices']) > 0:
+            return response_data['choices'][0]['message']['content']
+        raise ProviderError('Invalid response from Groq API', 500)
+
+    async def acomplete(self, image_data):
+        # Preprocessing is CPU bound, keep it off the event loop
+        with counting_errors(self):
+            payload = await asyncio.to_thread(self.build_payload, image_data)
+            response = await get_async_client(GROQ_URL).post(GROQ_URL, headers=self.headers(), json=payload)
+            return self.reply_text(response)
+
+    def stream(self, image_data):
+        payload = self.build_payload(image_data, stream=True)
+        with get_client(GROQ_URL).stream('POST', GROQ_URL, headers=self.headers(), json=payload) as response:
+            if response.status_code != 200:
+                raise ProviderError('Failed to get response from Groq API', response.status_code)
+            for line in response.iter_lines():
+                if not line.startswith('data: '):
+                    continue
+                data = line[len('data: '):]
+                if data == '[DONE]':
+                    return
+                choices = json.loads(data).get('choices') or []
+                if choices:
+                    content = choices[0].get('delta', {}).get('content')
+                    if content:
+                        yield content
+
+
+class StubProvider(Provider):
+    """
+    Offline provider returning a canned receipt.
+
+    Latency, jitter, error rate and load time are configurable so routing,
+    hedging, warm-up and benchmarks can be exercised without any model or
+    network.
+    """
+
+    def __init__(self, name='stub', response=None, latency=0.05, jitter=0.0, error_rate=0.0,
+                 chunk_size=32, prompt=RECEIPT_PROMPT, seed=None, load_seconds=0.0):
+        super().__init__(prompt)
+        self.name = name
+        self.model_name = name
+        self.response = response or json.dumps({
+            "name_of_establishment": "Stub Diner",
+            "currency": "$",
+            "items": [
+                {"name": "Coffee", "quantity": 2, "price_per_item": 2.5, "total_price": 5.0},
+                {"name": "Bagel", "quantity": 1, "price_per_item": 3.25, "total_price": 3.25}
+            ],
+            "number_of_items": 2,
+            "subtotal": 8.25,
+            "tax": 0.66,
+            "tip": "NA",
+            "additional_charges": "NA",
+            "total": 8.91
+        })
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.load_seconds = load_seconds
+        self._loaded = False
+        self._random = random.Random(seed)
+
+    def load(self):
+        # Stands in for loading a model once, e.g. in the startup benchmark
+        if not self._loaded:
+            time.sleep(self.load_seconds)
+            self._loaded = True
+        return self
+
+    def reply_for(self, image_data):
+        """Return the reply text for an image; override for per-image answers."""
+        return self.response
+
+    def stream(self, image_data):
+        if self._random.random() < self.error_rate:
+            raise ProviderError(f'{self.name} failed', 503)
+        text = self.reply_for(image_data)
+        chunk_count = max(1, -(-len(text) // self.chunk_size))
+        delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)) / chunk_count
+        for start in range(0, len(text), self.chunk_size):
+            time.sleep(delay)
+            yield text[start:start + self.chunk_size]
+
+    async def acomplete(self, image_data):
+        if self._random.random() < self.error_rate:
+            PROVIDER_ERRORS.inc(provider=self.name)
+            raise ProviderError(f'{self.name} failed', 503)
+        await asyncio.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+        return self.reply_for(image_data)
+
+
+class CassetteProvider(Provider):
+    """
+    Wraps a provider with a Cassette that records and replays its replies.
+
+    Replays are chunked like a live stream, so the streaming endpoints and
+    hedged routing behave the same with and without the network.
+    """
+
+    def __init__(self, provider, cassette, chunk_size=32):
+        super().__init__(provider.prompt)
+        self.provider = provider
+        self.cassette = cassette
+        self.name = provider.name
+        self.model_name = provider.model_name
+        self.caches_encodings = provider.caches_encodings
+        self.chunk_size = chunk_size
+
+    def with_prompt(self, prompt):
+        provider = super().with_prompt(prompt)
+        provider.provider = self.provider.with_prompt(prompt)
+        return provider
+
+    def load(self):
+        self.provider.load()
+        return self
+
+    def _lookup(self, image_data):
+        try:
+            return self.cassette.lookup(image_data, self.prompt, self.model_name)
+        except CassetteMiss as e:
+            raise ProviderError(str(e), 404)
+
+    def complete(self, image_data, cancel=None):
+        key, response, seconds = self._lookup(image_data)
+        if response is not None:
+            time.sleep(self.cassette.delay(seconds))
+            return response
+
+        started = time.perf_counter()
+        response = self.provider.complete(image_data, cancel)
+        self.cassette.put(key, self.model_name, response, time.perf_counter() - started)
+        return response
+
+    def complete_many(self, image_data, prompts, cancel=None):
+        # Recorded prompts are replayed, the rest go to the wrapped provider
+        # together, so it can still answer them from one encoded image
+        replies = [None] * len(prompts)
+        missing = {}
+        delay = 0.0
+        for index, prompt in enumerate(prompts):
+            try:
+                key, response, seconds = self.cassette.lookup(image_data, prompt, self.model_name)
+            except CassetteMiss as e:
+                replies[index] = ProviderError(str(e), 404)
+                continue
+            if response is None:
+                missing[index] = key
+            else:
+                replies[index] = response
+                delay = max(delay, self.cassette.delay(seconds))
+
+        started = time.perf_counter()
+        if missing:
+            answers = self.provider.complete_many(image_data, [prompts[index] for index in missing], cancel)
+            seconds = time.perf_counter() - started
+            for (index, key), answer in zip(missing.items(), answers):
+                if isinstance(answer, str):
+                    self.cassette.put(key, self.model_name, answer, seconds)
+                replies[index] = answer
+        # Replayed prompts answer in parallel with the live ones
+        time.sleep(max(0.0, delay - (time.perf_counter() - started)))
+        return replies
+
+    async def acomplete(self, image_data):
+        key, response, seconds = self._lookup(image_data)
+        if response is not None:
+            await asyncio.sleep(self.cassette.delay(seconds))
+            return response
+
+        started = time.perf_counter()
+        response = await self.provider.acomplete(image_data)
+        self.cassette.put(key, self.model_name, response, time.perf_counter() - started)
+        return response
+
+    def stream(self, image_data):
+        key, response, seconds = self._lookup(image_data)
+        if response is not None:
+            chunk_count = max(1, -(-len(response) // self.chunk_size))
+            delay = self.cassette.delay(seconds) / chunk_count
+            for start in range(0, len(response), self.chunk_size):
+                time.sleep(delay)
+                yield response[start:start + self.chunk_size]
+            return
+
+        # A reply is recorded once it is complete: streamed to the end, or up
+        # to the closing brace where read_json_stream() and the SSE endpoints
+        # stop reading and close this generator
+        started = time.perf_counter()
+        chunks = []
+        extractor = JSONStreamExtractor()
+        finished = False
+        stream = self.provider.stream(image_data)
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                extractor.feed(chunk)
+                yield chunk
+            finished = True
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+            if finished or extractor.done:
+                self.cassette.put(key, self.model_name, ''.join(chunks), time.perf_counter() - started)
+
+
+def with_cassette(provider, cassette=None):
+    """Wrap `provider` in the cassette given or configured by MODEL_CASSETTE, if any."""
+    if cassette is None:
+        cassette = cassette_from_env()
+    if cassette is None:
+        return provider
+    return CassetteProvider(provider, cassette)
+
+
+def providers_from_env(names):
+    """
+    Create providers by name, reading their settings from the environment.
+
+    "stub" needs nothing and works offline, "groq" and "gemini" need their
+    API keys and "moondream" needs a running model_server.py; what is
+    missing is reported when the provider is loaded, see warmup.py.
+    "local:<path>" loads a moondream .mf file in this process and
+    "cascade" chains the providers listed in CASCADE_TIERS. With
+    MODEL_CASSETTE set every provider records to and replays from it, and
+    with EXTRACTION_MODE=fields every provider asks per-part prompts.
+    """
+    from fields import with_fields
+
+    cassette = cassette_from_env()
+    providers = []
+    for name in names:
+        if name == 'cascade':
+            from cascade import cascade_from_env
+
+            # Its tiers are created (and recorded) individually
+            providers.append(cascade_from_env())
+            continue
+        if name == 'stub':
+            providers.append(StubProvider(latency=float(os.getenv('STUB_LATENCY', '0.05')),
+                                          load_seconds=float(os.getenv('STUB_LOAD_SECONDS', '0'))))
+        elif name == 'groq':
+            providers.append(GroqProvider(os.getenv('GROQ_API_KEY')))
+        elif name == 'gemini':
+            providers.append(GeminiProvider(os.getenv('GEMINI_API_KEY')))
+        elif name == 'moondream':
+            providers.append(MoondreamProvider())
+        elif name.startswith('local:'):
+            providers.append(LocalMoondreamProvider(name[len('local:'):]))
+        else:
+            raise ValueError(f"Unknown provider '{name}' in ROUTER_PROVIDERS")
+        providers[-1] = with_fields(with_cassette(providers[-1], cassette))
+    return providers
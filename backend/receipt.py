@@ -0,0 +1,208 @@
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from json_extract import extract_json
+
+RECEIPT_PROMPT = """
+Analyze this receipt and respond ONLY with these exact details in this format:
+{
+    "name_of_establishment": "name of store/restaurant",
+    "currency": "$" or "rupees" any other,
+    "items": [
+        {
+            "name": "item name",
+            "quantity": number,
+            "price_per_item": price,
+            "total_price": quantity * price
+        }
+    ],
+    "number_of_items": total count of unique items,
+    "subtotal": subtotal amount,
+    "tax": tax amount or "NA" if none,
+    "tip": tip amount or "NA" if none,
+    "additional_charges": additional charges or "NA" if none,
+    "total": final total amount
+}
+
+Only include information you can clearly see.
+Use "NA" for missing values.
+Format all prices as decimal numbers without currency symbols.
+Keep item names exactly as written on receipt.
+If a value does not exist or cannot be parsed, return "NA" for it.
+Maintain the exact order of fields in the JSON structure.
+Ensure that the total amount matches the sum of subtotal, tax, tip, and additional charges.
+Respond with only the JSON object, nothing else.
+"""
+
+NA = 'NA'
+NA_STRINGS = frozenset(('', 'na', 'n/a', 'none', 'null', '-'))
+
+# Characters models put around amounts: currency symbols, thousands separators, spaces
+_STRIP_AMOUNT = str.maketrans('', '', '$€£¥₹,  ')
+
+
+def is_na(value):
+    """True for None and the placeholders models use for a missing value."""
+    return value is None or (isinstance(value, str) and value.strip().lower() in NA_STRINGS)
+
+
+def to_number(value):
+    """
+    Coerce a model value to a Decimal, or None when it is missing.
+
+    Numbers are converted exactly, strings such as "12.50", "$1,234.5" or
+    "Rs 40" lose their currency marks, and "NA", "na" or anything that is
+    not a number becomes None.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        # repr() keeps 2.99 as 2.99 instead of its binary expansion
+        return Decimal(repr(value)) if value == value and value not in (float('inf'), float('-inf')) else None
+    if isinstance(value, Decimal):
+        return value if value.is_finite() else None
+    if isinstance(value, str):
+        text = value.translate(_STRIP_AMOUNT)
+        if text[:2].lower() == 'rs':
+            text = text[2:].lstrip('.')
+        if not text or text.lower() in NA_STRINGS:
+            return None
+        try:
+            number = Decimal(text)
+        except InvalidOperation:
+            return None
+        return number if number.is_finite() else None
+    return None
+
+
+def to_count(value):
+    """Coerce a count such as number_of_items to an int, or None."""
+    number = to_number(value)
+    if number is None or number != number.to_integral_value():
+        return None
+    return int(number)
+
+
+def to_text(value):
+    """Coerce a text field, mapping "NA" and empty values to None."""
+    if is_na(value):
+        return None
+    return str(value).strip()
+
+
+def dump_number(value):
+    """Serialize a Decimal the way the frontend expects: a JSON number or "NA"."""
+    if value is None:
+        return NA
+    if value == value.to_integral_value():
+        return int(value)
+    return float(value)
+
+
+@dataclass(slots=True)
+class ReceiptItem:
+    """One line of a receipt; missing values are None."""
+
+    name: str | None = None
+    quantity: Decimal | None = None
+    price_per_item: Decimal | None = None
+    total_price: Decimal | None = None
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            return cls(name=to_text(data))
+        return cls(
+            to_text(data.get('name')),
+            to_number(data.get('quantity')),
+            to_number(data.get('price_per_item')),
+            to_number(data.get('total_price')),
+        )
+
+    def to_dict(self):
+        return {
+            'name': self.name if self.name is not None else NA,
+            'quantity': dump_number(self.quantity),
+            'price_per_item': dump_number(self.price_per_item),
+            'total_price': dump_number(self.total_price),
+        }
+
+
+@dataclass(slots=True)
+class Receipt:
+    """
+    A parsed receipt.
+
+    Amounts are Decimals and missing values None, so arithmetic on them is
+    exact; to_dict() turns them back into the JSON the frontend reads,
+    with numbers as JSON numbers and missing values as "NA".
+    """
+
+    name_of_establishment: str | None = None
+    currency: str | None = None
+    items: list = field(default_factory=list)
+    number_of_items: int | None = None
+    subtotal: Decimal | None = None
+    tax: Decimal | None = None
+    tip: Decimal | None = None
+    additional_charges: Decimal | None = None
+    total: Decimal | None = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Validate and coerce a receipt dict as returned by a model.
+
+        Raises:
+            ValueError: If `data` is not a JSON object
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f'Expected a receipt object, got {type(data).__name__}')
+        items = data.get('items')
+        return cls(
+            # Older prompts asked for "store_name"
+            to_text(data.get('name_of_establishment', data.get('store_name'))),
+            to_text(data.get('currency')),
+            [ReceiptItem.from_dict(item) for item in items] if isinstance(items, list) else [],
+            to_count(data.get('number_of_items')),
+            to_number(data.get('subtotal')),
+            to_number(data.get('tax')),
+            to_number(data.get('tip')),
+            to_number(data.get('additional_charges')),
+            to_number(data.get('total')),
+        )
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Parse a model reply into a Receipt.
+
+        Raises:
+            ValueError: If the reply holds no JSON receipt object
+        """
+        return cls.from_dict(extract_json(text))
+
+    @classmethod
+    def empty(cls):
+        """The receipt reported when nothing could be read."""
+        return cls(number_of_items=0)
+
+    def to_dict(self):
+        return {
+            'name_of_establishment': self.name_of_establishment if self.name_of_establishment is not None else NA,
+            'currency': self.currency if self.currency is not None else NA,
+            'items': [item.to_dict() for item in self.items],
+            'number_of_items': self.number_of_items if self.number_of_items is not None else NA,
+            'subtotal': dump_number(self.subtotal),
+            'tax': dump_number(self.tax),
+            'tip': dump_number(self.tip),
+            'additional_charges': dump_number(self.additional_charges),
+            'total': dump_number(self.total),
+        }
+
+
+def normalize_receipt(data):
+    """Validate a receipt dict and return it in the canonical JSON shape."""
+    return Receipt.from_dict(data).to_dict()
@@ -0,0 +1,234 @@
+import math
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from providers import ProviderError, Cancelled
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class ProviderStats:
+    """Rolling latency and error statistics of one provider."""
+
+    def __init__(self, window=100):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        # Time spent in hedged races the provider lost, kept out of the
+        # latency window since the real latency was longer still
+        self.losses = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self.lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(seconds)
+
+    def record_loss(self, seconds):
+        with self.lock:
+            self.losses.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            outcomes = list(self.outcomes)
+            losses = list(self.losses)
+        errors = outcomes.count(False)
+        return {
+            'requests': len(outcomes),
+            'lost': len(losses),
+            'slowest_loss': max(losses) if losses else None,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'error_rate': round(errors / len(outcomes), 4) if outcomes else 0.0,
+        }
+
+
+class Router:
+    """
+    Sends each request to the fastest healthy provider.
+
+    Providers are ranked by their rolling p50 latency; a provider whose
+    recent error rate exceeds `max_error_rate` drops to the back of the
+    queue. Failed calls fall through to the next provider. With
+    `hedge_after` set, a second provider is started when the first has not
+    answered within that many seconds, and whichever finishes first wins
+    while the other is cancelled.
+    """
+
+    def __init__(self, providers, hedge_after=None, window=100, max_error_rate=0.5, max_workers=32):
+        self.providers = {provider.name: provider for provider in providers}
+        self.stats = {provider.name: ProviderStats(window) for provider in providers}
+        self.hedge_after = hedge_after
+        self.max_error_rate = max_error_rate
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def ranked(self):
+        """Provider names ordered from most to least preferred."""
+        def key(name):
+            snapshot = self.stats[name].snapshot()
+            unhealthy = snapshot['requests'] >= 5 and snapshot['error_rate'] > self.max_error_rate
+            # Providers without samples yet sort first so they get measured,
+            # ones that have only ever failed sort last and ones that have
+            # only lost races rank as at least as slow as their longest loss
+            latency = snapshot['p50']
+            if latency is None:
+                if snapshot['requests'] == 0:
+                    latency = snapshot['slowest_loss'] or 0.0
+                else:
+                    latency = float('inf')
+            return (unhealthy, latency)
+        return sorted(self.providers, key=key)
+
+    def _call(self, name, image_data, cancel):
+        started = time.perf_counter()
+        try:
+            text = self.providers[name].complete(image_data, cancel)
+        except Cancelled:
+            # A lost race is not a latency sample: its cut short time would
+            # make a slow provider look fast
+            self.stats[name].record_loss(time.perf_counter() - started)
+            raise
+        except Exception:
+            self.stats[name].record(time.perf_counter() - started, False)
+            raise
+        self.stats[name].record(time.perf_counter() - started, True)
+        return text
+
+    def complete(self, image_data):
+        """
+        Get a reply for an image from the best available provider.
+
+        Returns:
+            tuple: (provider name, reply text)
+
+        Raises:
+            ProviderError: If every provider failed
+        """
+        queue = self.ranked()
+        running = {}
+        errors = []
+
+        def start_next():
+            name = queue.pop(0)
+            cancel = threading.Event()
+            # The call runs in a copy of this context, so its stages land in the request's trace
+            future = self.executor.submit(contextvars.copy_context().run, self._call, name, image_data, cancel)
+            running[future] = (name, cancel)
+
+        start_next()
+        hedge_at = time.monotonic() + self.hedge_after if self.hedge_after is not None else None
+        parallel = 1
+
+        while running:
+            timeout = None
+            if hedge_at is not None and queue:
+                timeout = max(0.0, hedge_at - time.monotonic())
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # Latency budget exceeded, hedge to the next provider
+                start_next()
+                hedge_at = None
+                parallel = 2
+                continue
+
+            for future in done:
+                name, _ = running.pop(future)
+                try:
+                    text = future.result()
+                except Exception as e:
+                    errors.append(f'{name}: {e}')
+                    continue
+                # Cancel the losers of the race
+                for _, cancel in running.values():
+                    cancel.set()
+                return name, text
+
+            # Replace failed calls with the next provider
+            while queue and len(running) < parallel:
+                start_next()
+
+        raise ProviderError('All providers failed: ' + '; '.join(errors), 502)
+
+    async def _acall(self, name, image_data):
+        started = time.perf_counter()
+        try:
+            text = await self.providers[name].acomplete(image_data)
+        except asyncio.CancelledError:
+            # Lost hedges are recorded by acomplete(), which knows whether
+            # the call lost a race or the client went away
+            raise
+        except Exception:
+            self.stats[name].record(time.perf_counter() - started, False)
+            raise
+        self.stats[name].record(time.perf_counter() - started, True)
+        return text
+
+    async def acomplete(self, image_data):
+        """Async variant of complete(); losing hedged calls are cancelled outright."""
+        queue = self.ranked()
+        running = {}
+        errors = []
+        won = False
+
+        def start_next():
+            name = queue.pop(0)
+            running[asyncio.ensure_future(self._acall(name, image_data))] = (name, time.perf_counter())
+
+        start_next()
+        hedge_at = time.monotonic() + self.hedge_after if self.hedge_after is not None else None
+        parallel = 1
+
+        try:
+            while running:
+                timeout = None
+                if hedge_at is not None and queue:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Latency budget exceeded, hedge to the next provider
+                    start_next()
+                    hedge_at = None
+                    parallel = 2
+                    continue
+
+                for task in done:
+                    name, _ = running.pop(task)
+                    try:
+                        text = task.result()
+                    except Exception as e:
+                        errors.append(f'{name}: {e}')
+                        continue
+                    won = True
+                    return name, text
+
+                # Replace failed calls with the next provider
+                while queue and len(running) < parallel:
+                    start_next()
+        finally:
+            # Cancel the losers of the race (or everything if we were cancelled)
+            for task, (name, started) in running.items():
+                task.cancel()
+                # Only a lost race says something about the provider, a
+                # client that went away does not; see _call()
+                if won:
+                    self.stats[name].record_loss(time.perf_counter() - started)
+
+        raise ProviderError('All providers failed: ' + '; '.join(errors), 502)
+
+    def snapshot(self):
+        """Per-provider latency and error statistics for /health."""
+        return {name: self.stats[name].snapshot() for name in self.providers}
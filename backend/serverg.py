@@ -1,89 +1,62 @@
-import json
-import re
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
-from PIL import Image
-import io
 from dotenv import load_dotenv
-import base64
-import google.generativeai as genai 
+from cache import cache_from_env, make_cache_key
+from fields import with_fields
+from providers import GeminiProvider, with_cassette
+from jobs import JobStore, validate_webhook
+from bulk import UploadError, collect_uploads, analyze_many, ndjson_response
+from sse import sse_response, receipt_event_stream, replay_receipt_events
+from json_extract import extract_json
+from receipt import RECEIPT_PROMPT
+from consistency import reconcile
+from metrics import PARSE_FAILURES, instrument, stage
+from profiler import profile_requests
+from warmup import add_readiness, warm_up
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+# Per-stage timings, GET /metrics and the X-Trace header
+instrument(app)
+# Sample PROFILE_RATE of the requests, and those sent with X-Profile: $PROFILE_TOKEN
+profile_requests(app)
 
 # Configure allowed extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
-# Get API key from environment variable
+# Get API key from environment variable; without one /ready reports the
+# error instead of the server failing to start
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable is not set")
-
-# Configure the Gemini API client
-genai.configure(api_key=GEMINI_API_KEY)
-
-model = genai.GenerativeModel('gemini-1.5-flash')
-
-initial_prompt = """
-Analyze this receipt and respond ONLY with these exact details in this format:
-{
-    "name_of_establishment": "name of store/restaurant",
-    "currency": "$" or "rupees" any other,
-    "items": [
-        {
-            "name": "item name",
-            "quantity": number,
-            "price_per_item": price,
-            "total_price": quantity * price
-        }
-    ],
-    "number_of_items": total count of unique items,
-    "subtotal": subtotal amount,
-    "tax": tax amount or "NA" if none,
-    "tip": tip amount or "NA" if none,
-    "additional_charges": additional charges or "NA" if none,
-    "total": final total amount
-}
-
-Only include information you can clearly see.
-Use "NA" for missing values.
-Format all prices as decimal numbers without currency symbols.
-Keep item names exactly as written on receipt.
-If a value does not exist or cannot be parsed, return "NA" for it.
-Maintain the exact order of fields in the JSON structure.
-Ensure that the total amount matches the sum of subtotal, tax, tip, and additional charges.
-Respond with only the JSON object, nothing else.
-"""
+
+MODEL_NAME = 'gemini-1.5-flash'
+
+# Cache parsed results of previously seen uploads
+result_cache = cache_from_env(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_cache.sqlite3'))
+
+# Persistent queue behind /jobs, drained by the workers of jobs.py
+job_store = JobStore()
+
+initial_prompt = RECEIPT_PROMPT
+
+# Ask per-part prompts when EXTRACTION_MODE=fields
+provider = with_fields(with_cassette(GeminiProvider(GEMINI_API_KEY, MODEL_NAME, initial_prompt)))
+
+# Load the provider on a thread, so /health answers at once and /ready
+# reports when requests can be served
+warmup = warm_up([provider])
+add_readiness(app, warmup)
 
 # Function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def extract_json(text):
-    # Find the first { and last }
-    start = text.find('{')
-    end = text.rfind('}')
-    
-    if start == -1 or end == -1:
-        raise ValueError("No JSON object found in response")
-        
-    # Extract everything between first { and last }
-    json_str = text[start:end + 1]
-    
-    # Validate it's valid JSON
-    return json.loads(json_str)
-
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({'status': 'healthy'}), 200
-
-@app.route('/analyze_receipt', methods=['POST'])
-def analyze_receipt():
+def validate_upload():
+    """Return an error response if the request has no usable image, else None."""
     # Check if image file is present in request
     if 'image' not in request.files:
         return jsonify({'error': 'No image file provided'}), 400
@@ -98,29 +71,106 @@ def analyze_receipt():
     if not allowed_file(file.filename):
         return jsonify({'error': 'File type not allowed'}), 400
 
+    return None
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    return jsonify({'status': 'healthy', 'cache': result_cache.stats(), 'jobs': job_store.stats()}), 200
+
+def analyze_image(image_data):
+    """Analyze one receipt image, returning (response body, status code)."""
+    # Serve repeated uploads straight from the cache
+    cache_key = make_cache_key(image_data, provider.prompt, MODEL_NAME)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached, 200
+
+    # Stream the reply from the Gemini API and stop reading as soon as
+    # the JSON object is complete
+    with stage('model'):
+        model_response = provider.complete(image_data)
+
     try:
-        image = Image.open(file) 
-      
-        # Send request to Gemini API
-        response = model.generate_content([
-            initial_prompt,
-            image
-        ])
-        # Check for successful response
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to get response from Gemini Pro API'}), response.status_code
+        # Check the arithmetic, repairing slips and re-reading the totals if needed
+        json_response, _ = reconcile(extract_json(model_response), image_data, provider)
+        result_cache.set(cache_key, json_response)
+        return json_response, 200
+    except ValueError:
+        PARSE_FAILURES.inc()
+        return {
+            'error' : 'Failed to parse response as json',
+            'raw_response': model_response
+        }, 500
 
-        try:
-            json_response = extract_json(response.text)
-            return jsonify(json_response)
-        except (json.JSONDecodeError, ValueError) as e:
-            return jsonify({
-                'error' : 'Failed to parse response as json',
-                'raw_response': response.text
-            }) , 500
+@app.route('/analyze_receipt', methods=['POST'])
+def analyze_receipt():
+    error = validate_upload()
+    if error is not None:
+        return error
 
+    try:
+        with stage('read'):
+            image_data = request.files['image'].read()
+        body, status = analyze_image(image_data)
+        with stage('serialize'):
+            return jsonify(body), status
     except Exception as e:
         return jsonify({'error': f'Error processing image: {str(e)}'}), 500
 
+@app.route('/analyze_receipts', methods=['POST'])
+def analyze_receipts():
+    try:
+        uploads = collect_uploads(request.files, ALLOWED_EXTENSIONS)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+
+    # One NDJSON line per receipt as soon as it is analyzed
+    return ndjson_response(analyze_many(uploads, analyze_image))
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    webhook = request.form.get('webhook')
+    if webhook:
+        try:
+            validate_webhook(webhook)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    # Retried uploads of the same image map to the same job
+    image_data = request.files['image'].read()
+    cache_key = make_cache_key(image_data, provider.prompt, MODEL_NAME)
+    job, created = job_store.submit(cache_key, MODEL_NAME, image_data, webhook)
+    return jsonify(job), 202 if created else 200, {'Location': f"/jobs/{job['id']}"}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
+
+@app.route('/analyze_receipt/stream', methods=['POST'])
+def analyze_receipt_stream():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    image_data = request.files['image'].read()
+
+    # Serve repeated uploads straight from the cache
+    cache_key = make_cache_key(image_data, provider.prompt, MODEL_NAME)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return sse_response(replay_receipt_events(cached))
+
+    # Forward tokens, completed fields and items as server-sent events
+    return sse_response(receipt_event_stream(
+        provider.stream(image_data), on_result=lambda result: result_cache.set(cache_key, result)
+    ))
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,70 +1,62 @@
-import json
-import re
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
-import requests
-from PIL import Image
-import io
 from dotenv import load_dotenv
-import base64
+from cache import cache_from_env, make_cache_key
+from fields import with_fields
+from providers import GroqProvider, ProviderError, with_cassette
+from jobs import JobStore, validate_webhook
+from bulk import UploadError, collect_uploads, analyze_many, ndjson_response
+from sse import sse_response, receipt_event_stream, replay_receipt_events
+from json_extract import extract_json
+from receipt import RECEIPT_PROMPT
+from consistency import reconcile
+from metrics import PARSE_FAILURES, instrument, stage
+from profiler import profile_requests
+from warmup import add_readiness, warm_up
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+# Per-stage timings, GET /metrics and the X-Trace header
+instrument(app)
+# Sample PROFILE_RATE of the requests, and those sent with X-Profile: $PROFILE_TOKEN
+profile_requests(app)
 
 # Configure allowed extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
-# Get API key from environment variable
+# Get API key from environment variable; without one /ready reports the
+# error instead of the server failing to start
 GROQ_API_KEY = os.getenv('GROQ_API_KEY')
-if not GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY environment variable is not set")
-
-
-initial_prompt = """
-Analyze this receipt and respond ONLY with these exact details in this format:
-{
-"name_of_establishment": "name of store/restaurant",
-"currency": "$" or any other,
-"items": [
-{
-"name": "item name",
-"quantity": number,
-"price_per_item": price,
-"total_price": quantity * price
-}
-],
-"number_of_items": total count of unique items,
-"subtotal": subtotal amount,
-"tax": tax amount or "NA" if none,
-"tip": tip amount or "NA" if none,
-"additional_charges": additional charges or "NA" if none,
-"total": final total amount
-}
-
-Only include information you can clearly see.
-Use "NA" for missing values.
-Format all prices as decimal numbers without currency symbols.
-Keep item names exactly as written on receipt.
-If a value does not exist or cannot be parsed, return "NA" for it.
-Maintain the exact order of fields in the JSON structure.
-Ensure that the total amount matches the sum of subtotal, tax, tip, and additional charges.
-Respond with only the JSON object, nothing else.
-"""
+
+MODEL_NAME = 'llama-3.2-90b-vision-preview'
+
+# Cache parsed results of previously seen uploads
+result_cache = cache_from_env(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_cache.sqlite3'))
+
+# Persistent queue behind /jobs, drained by the workers of jobs.py
+job_store = JobStore()
+
+
+initial_prompt = RECEIPT_PROMPT
+
+# Ask per-part prompts when EXTRACTION_MODE=fields
+provider = with_fields(with_cassette(GroqProvider(GROQ_API_KEY, MODEL_NAME, initial_prompt)))
+
+# Load the provider on a thread, so /health answers at once and /ready
+# reports when requests can be served
+warmup = warm_up([provider])
+add_readiness(app, warmup)
 
 # Function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({'status': 'healthy'}), 200
-
-@app.route('/analyze_receipt', methods=['POST'])
-def analyze_receipt():
+def validate_upload():
+    """Return an error response if the request has no usable image, else None."""
     # Check if image file is present in request
     if 'image' not in request.files:
         return jsonify({'error': 'No image file provided'}), 400
@@ -79,61 +71,107 @@ def analyze_receipt():
     if not allowed_file(file.filename):
         return jsonify({'error': 'File type not allowed'}), 400
 
+    return None
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    return jsonify({'status': 'healthy', 'cache': result_cache.stats(), 'jobs': job_store.stats()}), 200
+
+def analyze_image(image_data):
+    """Analyze one receipt image, returning (response body, status code)."""
+    # Serve repeated uploads straight from the cache
+    cache_key = make_cache_key(image_data, provider.prompt, MODEL_NAME)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached, 200
+
+    # Send request to Groq API
     try:
-        # Read image directly from request
-        image_data = file.read()
-        image = Image.open(io.BytesIO(image_data))
-
-        # Convert image to base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-        # Prepare the payload for Groq API
-        payload = {
-            "model": "llama-3.2-90b-vision-preview",
-            "messages": [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content":initial_prompt },
-                {"role": "user", "content": f"![receipt](data:image/jpeg;base64,{img_str})"}
-            ]
-        }
-
-        # Send request to Groq API
-        response = requests.post(
-            'https://api.groq.com/openai/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {GROQ_API_KEY}',
-                'Content-Type': 'application/json'
-            },
-            json=payload
-        )
-
-        # Check for successful response
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to get response from Groq API'}), response.status_code
-
-        # Parse the response
-        response_data = response.json()
-        if 'choices' in response_data and len(response_data['choices']) > 0:
-            model_response = response_data['choices'][0]['message']['content']
-
-            # Remove triple backticks and any text before or after the JSON
-            json_str = re.search(r'```(json)?\s*({.*})\s*```', model_response, re.DOTALL)
-            if json_str:
-                json_content = json_str.group(2)
-                try:
-                    json_response = json.loads(json_content)
-                    return jsonify(json_response)
-                except json.JSONDecodeError:
-                    return jsonify({'error': 'Failed to parse model response as JSON', 'raw_response': model_response}), 500
-            else:
-                return jsonify({'error': 'No JSON object found in model response', 'raw_response': model_response}), 500
-        else:
-            return jsonify({'error': 'Invalid response from Groq API'}), 500
+        with stage('model'):
+            model_response = provider.complete(image_data)
+    except ProviderError as e:
+        return {'error': str(e)}, e.status_code
 
+    # Pull the JSON object out of any fences or surrounding text
+    try:
+        # Check the arithmetic, repairing slips and re-reading the totals if needed
+        json_response, _ = reconcile(extract_json(model_response), image_data, provider)
+        result_cache.set(cache_key, json_response)
+        return json_response, 200
+    except ValueError:
+        PARSE_FAILURES.inc()
+        return {'error': 'Failed to parse model response as JSON', 'raw_response': model_response}, 500
+
+@app.route('/analyze_receipt', methods=['POST'])
+def analyze_receipt():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    try:
+        # Read image directly from request
+        with stage('read'):
+            image_data = request.files['image'].read()
+        body, status = analyze_image(image_data)
+        with stage('serialize'):
+            return jsonify(body), status
     except Exception as e:
         return jsonify({'error': f'Error processing image: {str(e)}'}), 500
 
+@app.route('/analyze_receipts', methods=['POST'])
+def analyze_receipts():
+    try:
+        uploads = collect_uploads(request.files, ALLOWED_EXTENSIONS)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+
+    # One NDJSON line per receipt as soon as it is analyzed
+    return ndjson_response(analyze_many(uploads, analyze_image))
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    webhook = request.form.get('webhook')
+    if webhook:
+        try:
+            validate_webhook(webhook)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    # Retried uploads of the same image map to the same job
+    image_data = request.files['image'].read()
+    cache_key = make_cache_key(image_data, provider.prompt, MODEL_NAME)
+    job, created = job_store.submit(cache_key, MODEL_NAME, image_data, webhook)
+    return jsonify(job), 202 if created else 200, {'Location': f"/jobs/{job['id']}"}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
+
+@app.route('/analyze_receipt/stream', methods=['POST'])
+def analyze_receipt_stream():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    image_data = request.files['image'].read()
+
+    # Serve repeated uploads straight from the cache
+    cache_key = make_cache_key(image_data, provider.prompt, MODEL_NAME)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return sse_response(replay_receipt_events(cached))
+
+    # Forward tokens, completed fields and items as server-sent events
+    return sse_response(receipt_event_stream(
+        provider.stream(image_data), on_result=lambda result: result_cache.set(cache_key, result)
+    ))
+
 if __name__ == '__main__':
     app.run(debug=True)
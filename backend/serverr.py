@@ -0,0 +1,188 @@
+from flask import Flask, request, jsonify
+from flask_cors import CORS
+import os
+from dotenv import load_dotenv
+from cache import cache_from_env, make_cache_key
+from providers import ProviderError, providers_from_env
+from router import Router
+from jobs import JobStore, validate_webhook
+from bulk import UploadError, collect_uploads, analyze_many, ndjson_response
+from sse import sse_response, receipt_event_stream, replay_receipt_events
+from json_extract import extract_json
+from consistency import reconcile
+from metrics import PARSE_FAILURES, instrument, stage
+from profiler import profile_requests
+from warmup import add_readiness, warm_up
+
+# Load environment variables
+load_dotenv()
+
+app = Flask(__name__)
+CORS(app)
+# Per-stage timings, GET /metrics and the X-Trace header
+instrument(app)
+# Sample PROFILE_RATE of the requests, and those sent with X-Profile: $PROFILE_TOKEN
+profile_requests(app)
+
+# Configure allowed extensions
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+
+
+PROVIDER_NAMES = [name.strip() for name in os.getenv('ROUTER_PROVIDERS', 'groq,gemini').split(',') if name.strip()]
+HEDGE_AFTER = os.getenv('ROUTER_HEDGE_AFTER')
+
+# Route requests over all configured providers
+router = Router(
+    providers_from_env(PROVIDER_NAMES),
+    hedge_after=float(HEDGE_AFTER) if HEDGE_AFTER else None,
+    max_error_rate=float(os.getenv('ROUTER_MAX_ERROR_RATE', '0.5'))
+)
+MODEL_NAME = 'router:' + ','.join(PROVIDER_NAMES)
+
+# Cache parsed results of previously seen uploads
+result_cache = cache_from_env(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_cache.sqlite3'))
+
+# Persistent queue behind /jobs, drained by the workers of jobs.py
+job_store = JobStore()
+
+# Every provider asks the same prompt(s), which key the cache
+initial_prompt = next(iter(router.providers.values())).prompt
+
+# Load the providers on a thread, so /health answers at once and /ready
+# reports when requests can be served
+warmup = warm_up(router.providers.values())
+add_readiness(app, warmup)
+
+# Function to check allowed file extensions
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def validate_upload():
+    """Return an error response if the request has no usable image, else None."""
+    # Check if image file is present in request
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image file provided'}), 400
+
+    file = request.files['image']
+
+    # Check if file is empty
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    # Check if file type is allowed
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+
+    return None
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    return jsonify({
+        'status': 'healthy',
+        'cache': result_cache.stats(), 'jobs': job_store.stats(),
+        'providers': router.snapshot()
+    }), 200
+
+def analyze_image(image_data):
+    """Analyze one receipt image, returning (response body, status code)."""
+    # Serve repeated uploads straight from the cache
+    cache_key = make_cache_key(image_data, initial_prompt, MODEL_NAME)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached, 200
+
+    # Ask the fastest healthy provider, hedging and falling back as configured
+    try:
+        with stage('model'):
+            provider_name, model_response = router.complete(image_data)
+    except ProviderError as e:
+        return {'error': str(e)}, e.status_code
+
+    try:
+        # Check the arithmetic, repairing slips and re-reading the totals if needed
+        json_response, _ = reconcile(extract_json(model_response), image_data, router.providers[provider_name])
+        result_cache.set(cache_key, json_response)
+        return json_response, 200
+    except ValueError:
+        PARSE_FAILURES.inc()
+        return {
+            'error': 'Failed to parse model response as JSON',
+            'provider': provider_name,
+            'raw_response': model_response
+        }, 500
+
+@app.route('/analyze_receipt', methods=['POST'])
+def analyze_receipt():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    try:
+        with stage('read'):
+            image_data = request.files['image'].read()
+        body, status = analyze_image(image_data)
+        with stage('serialize'):
+            return jsonify(body), status
+    except Exception as e:
+        return jsonify({'error': f'Error processing image: {str(e)}'}), 500
+
+@app.route('/analyze_receipts', methods=['POST'])
+def analyze_receipts():
+    try:
+        uploads = collect_uploads(request.files, ALLOWED_EXTENSIONS)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+
+    # One NDJSON line per receipt as soon as it is analyzed
+    return ndjson_response(analyze_many(uploads, analyze_image))
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    webhook = request.form.get('webhook')
+    if webhook:
+        try:
+            validate_webhook(webhook)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    # Retried uploads of the same image map to the same job
+    image_data = request.files['image'].read()
+    cache_key = make_cache_key(image_data, initial_prompt, MODEL_NAME)
+    job, created = job_store.submit(cache_key, MODEL_NAME, image_data, webhook)
+    return jsonify(job), 202 if created else 200, {'Location': f"/jobs/{job['id']}"}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
+
+@app.route('/analyze_receipt/stream', methods=['POST'])
+def analyze_receipt_stream():
+    error = validate_upload()
+    if error is not None:
+        return error
+
+    image_data = request.files['image'].read()
+
+    # Serve repeated uploads straight from the cache
+    cache_key = make_cache_key(image_data, initial_prompt, MODEL_NAME)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return sse_response(replay_receipt_events(cached))
+
+    # Streams are not hedged, they go to the currently preferred provider
+    provider = router.providers[router.ranked()[0]]
+
+    # Forward tokens, completed fields and items as server-sent events
+    return sse_response(receipt_event_stream(
+        provider.stream(image_data), on_result=lambda result: result_cache.set(cache_key, result)
+    ))
+
+if __name__ == '__main__':
+    app.run(debug=True)
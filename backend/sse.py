@@ -0,0 +1,88 @@
+import json
+
+from flask import Response, stream_with_context
+
+from json_extract import JSONStreamExtractor
+from consistency import reconcile
+from metrics import PARSE_FAILURES
+
+
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    """Wrap an iterator of formatted events in an unbuffered streaming response."""
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def receipt_event_stream(chunks, on_result=None):
+    """
+    Turn streamed model text into receipt events.
+
+    Emits `token` events with the raw text as it arrives, `field` events
+    for every completed top-level field, `item` events for every completed
+    line item, and finally `done` with the full receipt or `error`.
+
+    Args:
+        chunks (iterable): Text chunks from a streaming model call
+        on_result (callable): Called with the parsed receipt on success
+
+    Yields:
+        str: Formatted server-sent events
+    """
+    pending = []
+    extractor = JSONStreamExtractor(on_event=lambda kind, key, value: pending.append((kind, key, value)))
+    iterator = iter(chunks)
+
+    try:
+        for chunk in iterator:
+            if not chunk:
+                continue
+            yield sse_event('token', {'text': chunk})
+            extractor.feed(chunk)
+            for kind, key, value in pending:
+                yield sse_event(kind, {'key': key, 'value': value})
+            pending.clear()
+            # Stop the provider once the receipt is complete
+            if extractor.done:
+                break
+    except Exception as e:
+        yield sse_event('error', {'error': f'Error processing image: {str(e)}'})
+        return
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+    if not extractor.done:
+        PARSE_FAILURES.inc()
+        yield sse_event('error', {'error': 'Failed to parse model response as JSON', 'raw_response': extractor.text})
+        return
+
+    try:
+        # Validate and repair the arithmetic; streams are never re-queried
+        result, _ = reconcile(extractor.value())
+    except ValueError:
+        PARSE_FAILURES.inc()
+        yield sse_event('error', {'error': 'Failed to parse model response as JSON', 'raw_response': extractor.text})
+        return
+    if on_result is not None:
+        on_result(result)
+    yield sse_event('done', result)
+
+
+def replay_receipt_events(receipt):
+    """Emit the events of an already parsed (e.g. cached) receipt."""
+    for key, value in receipt.items():
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    yield sse_event('item', {'key': key, 'value': item})
+        yield sse_event('field', {'key': key, 'value': value})
+    yield sse_event('done', receipt)
@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+from pathlib import Path
+
+# "background" loads the providers on a thread as soon as the server starts,
+# "lazy" leaves it to the first request or readiness probe
+WARM_UP = os.getenv('WARM_UP', 'background')
+# Optional receipt sent through every model once it is loaded, so the first
+# real request does not pay for one-off allocations and cold caches
+WARM_UP_IMAGE = os.getenv('WARM_UP_IMAGE')
+
+
+def read_warm_up_image(path=WARM_UP_IMAGE):
+    """Bytes of the warm-up receipt, None when no warm-up image is configured."""
+    return Path(path).read_bytes() if path else None
+
+
+class Warmup:
+    """
+    Loads the providers of a server off the request path and tracks readiness.
+
+    The state goes from "cold" to "warming" to "ready", or to "failed" with
+    the error when a provider could not be loaded (a missing API key, a
+    model server that is not up yet). A failed warm-up is retried by the
+    next start(), which is what every readiness probe calls.
+    """
+
+    def __init__(self, providers, image_path=WARM_UP_IMAGE):
+        self.providers = list(providers)
+        self.image_path = image_path
+        self.state = 'cold'
+        self.error = None
+        self.seconds = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def start(self):
+        """Start warming up in the background, unless it is already under way or done."""
+        with self._lock:
+            # A warm-up inherited from the parent of a forked worker is not running here
+            if self.state == 'ready' or (self.state == 'warming' and self._pid == os.getpid()):
+                return self
+            # The last error is kept until a retry succeeds
+            self.state = 'warming'
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='warm-up', daemon=True).start()
+        return self
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            image_data = read_warm_up_image(self.image_path)
+            for provider in self.providers:
+                provider.load()
+                if image_data is not None:
+                    provider.complete(image_data)
+        except Exception as e:
+            print(f"Warm-up failed: {e}")
+            with self._lock:
+                self.state = 'failed'
+                self.error = str(e)
+            return
+        with self._lock:
+            self.state = 'ready'
+            self.error = None
+            self.seconds = round(time.perf_counter() - started, 3)
+
+    def status(self):
+        """Body of the /ready endpoint."""
+        with self._lock:
+            return {'status': self.state, 'seconds': self.seconds, 'error': self.error}
+
+
+def warm_up(providers, mode=WARM_UP):
+    """Create the Warmup of a server's providers, started right away in "background" mode."""
+    warmup = Warmup(providers)
+    if mode == 'background':
+        warmup.start()
+    return warmup
+
+
+def add_readiness(app, warmup):
+    """
+    Add GET /ready to a Flask app, next to the /health liveness check.
+
+    /health only says the process answers; /ready answers 200 once every
+    provider is loaded (and warmed with WARM_UP_IMAGE), 503 until then, so a
+    load balancer only routes traffic to replicas that can serve it.
+    """
+    from flask import jsonify
+
+    @app.route('/ready', methods=['GET'])
+    def ready():
+        # A lazy or failed warm-up is (re)started by the probe itself
+        warmup.start()
+        return jsonify(warmup.status()), 200 if warmup.ready else 503
+
+    return app
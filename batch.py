@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+from pathlib import Path
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from shards import ShardRecord, has_shards, open_split
+from labels import DATA_DIR, SPLITS, IMAGE_EXTENSIONS, split_image_dir
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from preprocess import preprocess_image
+from json_extract import read_json_stream
+from cassette import cassette_from_env
+from profiler import (PROFILE_BATCH, PROFILE_DIR, SamplingProfiler, format_summary, merge_folded,
+                      write_folded)
+
+# Per-process state, filled in by _init_worker
+_model = None
+_model_path = None
+_prompt = None
+_decoder = None
+_cassette = None
+_profile_dir = None
+
+
+def list_split_images(splits=SPLITS, data_dir=DATA_DIR, limit=None):
+    """
+    List the image files of the given dataset splits in a stable order.
+
+    `data_dir` may also be a directory written by shards.py, in which case
+    the images are read from the memory-mapped shards instead.
+
+    Args:
+        splits (iterable): Split names, any of "train", "val" and "test"
+        data_dir (str): Root of the dataset
+        limit (int): Optional cap on the number of images returned
+
+    Returns:
+        list: Paths (or ShardRecords) of the images to analyze
+    """
+    image_files = []
+    for split in splits:
+        if has_shards(split, data_dir):
+            image_files.extend(open_split(data_dir, split))
+            continue
+        image_dir = split_image_dir(split, data_dir)
+        if image_dir is None:
+            print(f"Warning: no image directory for split '{split}' in {data_dir}")
+            continue
+        image_files.extend(sorted(
+            p for p in image_dir.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS
+        ))
+    if limit is not None:
+        image_files = image_files[:limit]
+    return image_files
+
+
+def read_image_bytes(image_path):
+    """Raw bytes of an image, zero-copy when it comes from a shard."""
+    return image_path.data if isinstance(image_path, ShardRecord) else Path(image_path).read_bytes()
+
+
+def decode_image(image_path):
+    """Decode and preprocess an image so the model thread never waits on PIL."""
+    image = preprocess_image(Image.open(image_path.open() if isinstance(image_path, ShardRecord) else image_path))
+    image.load()
+    return image
+
+
+def _init_worker(model_path, prompt, decode_threads, profile_dir=None):
+    global _model_path, _prompt, _decoder, _cassette, _profile_dir
+    _model_path = model_path
+    _prompt = prompt
+    _profile_dir = profile_dir
+    _decoder = ThreadPoolExecutor(max_workers=decode_threads)
+    # Replies recorded in MODEL_CASSETTE are replayed without touching the model
+    _cassette = cassette_from_env()
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        import moondream as md
+
+        # Each worker loads the model at most once, and not at all when
+        # every reply comes from the cassette
+        _model = md.vl(model=_model_path)
+    return _model
+
+
+def _query_model(future):
+    encoded_image = _get_model().encode_image(future.result())
+    # Stream the answer and stop generating once the JSON object closes
+    chunks = _model.query(encoded_image, _prompt, stream=True)['answer']
+    return read_json_stream(chunks).text
+
+
+def _is_recorded(image_data):
+    try:
+        return _cassette.lookup(image_data, _prompt, _model_path)[1] is not None
+    except LookupError:
+        # Replay-only miss, reported when the image is processed
+        return True
+
+
+def _run_micro_batch(batch):
+    if _profile_dir is None:
+        return _analyze_micro_batch(batch)
+    # Sample every thread of this worker, decoders included, while it works
+    with SamplingProfiler() as profiler:
+        results = _analyze_micro_batch(batch)
+    write_folded(profiler.stacks, os.path.join(_profile_dir, f"worker-{os.getpid()}-{batch[0][0]}.folded"))
+    return results
+
+
+def _analyze_micro_batch(batch):
+    # Decode the whole micro-batch ahead of time on the thread pool, then
+    # feed the model as soon as each image is ready
+    decoded = []
+    for idx, path in batch:
+        image_data = read_image_bytes(path) if _cassette is not None else None
+        if _cassette is not None and _is_recorded(image_data):
+            future = None
+        else:
+            future = _decoder.submit(decode_image, path)
+        decoded.append((idx, path, image_data, future))
+
+    results = []
+    for idx, path, image_data, future in decoded:
+        started = time.perf_counter()
+        try:
+            if _cassette is None:
+                response = _query_model(future)
+            else:
+                response = _cassette.call(image_data, _prompt, _model_path, lambda: _query_model(future))
+            results.append((idx, path, response, None, time.perf_counter() - started))
+        except Exception as e:
+            results.append((idx, path, None, str(e), time.perf_counter() - started))
+    return results
+
+
+def run_batch(model_path, prompt, image_files, batch_size=4, workers=None, decode_threads=2, profile_dir=None):
+    """
+    Run the local moondream model over many images using all cores.
+
+    Images are split into micro-batches of `batch_size` and distributed to
+    `workers` processes (one per core by default). Every process holds one
+    copy of the model and decodes its next images on a small thread pool.
+
+    Args:
+        model_path (str): Path to the .mf model file
+        prompt (str): Prompt sent with each image
+        image_files (list): Image paths to analyze
+        batch_size (int): Number of images handed to a worker at a time
+        workers (int): Number of model processes, defaults to the CPU count
+        decode_threads (int): Decoder threads inside every worker
+        profile_dir (str): Optional folder the workers write a sampled
+            profile of every micro-batch to, see report_profile()
+
+    Yields:
+        tuple: (receipt_id, image_path, response_text, error, seconds) in
+        completion order, receipt ids start at 1
+    """
+    workers = workers or os.cpu_count() or 1
+    indexed = list(enumerate(image_files, 1))
+    batches = [indexed[i:i + batch_size] for i in range(0, len(indexed), batch_size)]
+    workers = max(1, min(workers, len(batches)))
+
+    with Pool(workers, initializer=_init_worker, initargs=(model_path, prompt, decode_threads, profile_dir)) as pool:
+        for results in pool.imap_unordered(_run_micro_batch, batches):
+            yield from results
+
+
+def add_batch_arguments(parser):
+    """Register the command line options shared by the batch scripts."""
+    parser.add_argument("--split", action="append", choices=SPLITS,
+                        help="Dataset split to analyze, can be repeated (default: all)")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Dataset root, or a directory packed by shards.py")
+    parser.add_argument("--limit", type=int, default=None, help="Only analyze the first N images")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images per micro-batch")
+    parser.add_argument("--workers", type=int, default=None, help="Model processes (default: CPU count)")
+    parser.add_argument("--decode-threads", type=int, default=2, help="Decoder threads per worker")
+    parser.add_argument("--output", default="receipt_analysis.json", help="Where to write the results")
+    parser.add_argument("--profile", action="store_true", default=PROFILE_BATCH,
+                        help="Sample the workers and print where the time went (also PROFILE_BATCH=1)")
+    return parser
+
+
+def new_profile_dir(name):
+    """Create the folder a profiled batch run writes its samples to, under PROFILE_DIR."""
+    path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def report_profile(profile_dir, top=15):
+    """
+    Merge the samples of every worker of a batch run and print the hottest functions.
+
+    The merged profile is written to `<profile_dir>/profile.folded`, ready for
+    flamegraph.pl or speedscope. Returns its path.
+    """
+    paths = sorted(str(path) for path in Path(profile_dir).glob("worker-*.folded"))
+    stacks = merge_folded(paths)
+    path = write_folded(stacks, os.path.join(profile_dir, "profile.folded"))
+    print(f"Profile of {len(paths)} micro-batches:")
+    print(format_summary(stacks, top))
+    print(f"Flamegraph input saved to: {path}")
+    return path
+
+
+def report_throughput(processed, elapsed):
+    """Print the images per second achieved by a batch run."""
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Throughput: {processed} images in {elapsed:.1f}s ({rate:.2f} images/sec)")
+    return rate
@@ -0,0 +1,427 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+from pathlib import Path
+
+from batch import DATA_DIR, SPLITS, list_split_images
+from shards import ShardRecord
+from labels import parse_label, read_label_text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from json_extract import extract_json
+from providers import ProviderError, StubProvider, providers_from_env, with_cassette
+from cassette import MODES, Cassette
+from receipt import Receipt, is_na, to_number
+from consistency import check_receipt, reconcile
+from cascade import CascadeProvider
+from fields import FieldsProvider, with_fields
+from router import percentile
+from profiler import PROFILE_BATCH, SamplingProfiler, format_summary, profile_path, write_folded
+
+# Top level fields scored against the labels, items are scored separately
+SCALAR_FIELDS = ("name_of_establishment", "currency", "number_of_items", "subtotal",
+                 "tax", "tip", "additional_charges", "total")
+PRICE_TOLERANCE = Decimal("0.01")
+NUMBER_PATTERN = re.compile(r"^\s*[-+]?[\d,]*\.?\d+\s*$")
+
+
+def load_label(image_path):
+    """Load the labelled receipt of an image, None if it is missing or empty."""
+    if isinstance(image_path, ShardRecord):
+        return image_path.label
+    # From the split's label store when it has one, else the JSON file
+    return parse_label(read_label_text(image_path))
+
+
+def _normalize_text(value):
+    return " ".join(str(value).split()).casefold()
+
+
+def values_match(predicted, expected):
+    """
+    Compare one predicted value with its label.
+
+    Missing values match "NA", numbers match within a cent and text
+    matches ignoring case and whitespace.
+    """
+    if is_na(expected) or is_na(predicted):
+        return is_na(expected) and is_na(predicted)
+    # Labels sometimes store amounts as strings, e.g. "1.06"
+    numeric = not isinstance(expected, str) or NUMBER_PATTERN.match(expected)
+    expected_number = to_number(expected) if numeric else None
+    if expected_number is not None:
+        predicted_number = to_number(predicted)
+        return predicted_number is not None and abs(predicted_number - expected_number) <= PRICE_TOLERANCE
+    return _normalize_text(predicted) == _normalize_text(expected)
+
+
+def score_items(predicted, expected):
+    """
+    Match predicted line items to labelled ones by name and total price.
+
+    Returns:
+        dict: precision, recall and f1 of the item list
+    """
+    predicted = [item for item in predicted or [] if isinstance(item, dict)]
+    expected = [item for item in expected or [] if isinstance(item, dict)]
+    if not expected and not predicted:
+        return {"precision": 1.0, "recall": 1.0, "f1": 1.0}
+
+    unmatched = list(predicted)
+    matched = 0
+    for item in expected:
+        for candidate in unmatched:
+            if (values_match(candidate.get("name"), item.get("name"))
+                    and values_match(candidate.get("total_price"), item.get("total_price"))):
+                unmatched.remove(candidate)
+                matched += 1
+                break
+
+    precision = matched / len(predicted) if predicted else 0.0
+    recall = matched / len(expected) if expected else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+def score_receipt(predicted, expected):
+    """
+    Field level comparison of an extracted receipt with its label.
+
+    Args:
+        predicted (dict): Parsed model output
+        expected (dict): Ground truth from receipt_json
+
+    Returns:
+        dict: field name -> bool for the scalar fields, plus "items" scores
+    """
+    predicted = dict(predicted)
+    # app.py's prompt asks for "store_name" instead
+    if "name_of_establishment" not in predicted and "store_name" in predicted:
+        predicted["name_of_establishment"] = predicted["store_name"]
+    scores = {field: values_match(predicted.get(field), expected.get(field)) for field in SCALAR_FIELDS}
+    scores["items"] = score_items(predicted.get("items"), expected.get("items"))
+    return scores
+
+
+def _image_hash(image_data):
+    return hashlib.sha256(image_data).hexdigest()
+
+
+class RecordedProvider(StubProvider):
+    """
+    Offline provider replaying known replies per image.
+
+    Replies are looked up by the hash of the uploaded bytes, so the same
+    provider works whichever path the image was read from.
+    """
+
+    def __init__(self, replies, name="recorded", **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.replies = replies
+
+    @classmethod
+    def from_files(cls, replies_by_path, **kwargs):
+        """Build from {image path: reply text}, hashing every image once."""
+        return cls({_image_hash(path.read_bytes()): text for path, text in replies_by_path.items()},
+                   **kwargs)
+
+    def reply_for(self, image_data):
+        try:
+            return self.replies[_image_hash(image_data)]
+        except KeyError:
+            raise ProviderError(f"{self.name}: no recorded reply for this image", 404)
+
+
+def load_recording(path, image_files):
+    """
+    Read recorded replies for the benchmark images.
+
+    Accepts either a JSON object mapping image file names (or stems) to the
+    raw reply text, or the list of receipts written by app.py / script.py.
+
+    Returns:
+        dict: image path -> reply text for the images that have one
+    """
+    with open(path) as f:
+        recording = json.load(f)
+
+    by_name = {}
+    if isinstance(recording, dict):
+        by_name = {Path(key).name: value for key, value in recording.items()}
+    else:
+        for receipt in recording:
+            receipt = dict(receipt)
+            name = Path(receipt.pop("image_path", "")).name
+            receipt.pop("receipt_id", None)
+            by_name[name] = receipt.pop("raw_response", None) or json.dumps(receipt)
+
+    replies = {}
+    for image_path in image_files:
+        reply = by_name.get(image_path.name, by_name.get(image_path.stem))
+        if reply is not None:
+            replies[image_path] = reply if isinstance(reply, str) else json.dumps(reply)
+    return replies
+
+
+def build_provider(name, image_files, recording=None, latency=0.0, jitter=0.0, seed=0, tiers=None):
+    """
+    Create the extractor under test.
+
+    "stub" answers every image with the same canned receipt, "labels" echoes
+    the ground truth (an accuracy ceiling that measures harness overhead) and
+    "recorded" replays a file of earlier replies and "cascade" chains the
+    comma separated `tiers`, each built by this function. Any other name is
+    passed to providers_from_env, e.g. "groq", "gemini" or "moondream".
+    """
+    if name == "cascade":
+        if not tiers:
+            raise ValueError("--cascade-tiers is required with --provider cascade")
+        return CascadeProvider([build_provider(tier.strip(), image_files, recording, latency, jitter, seed)
+                                for tier in tiers.split(",")])
+    if name == "stub":
+        return StubProvider(latency=latency, jitter=jitter, seed=seed)
+    if name == "labels":
+        replies = {path: json.dumps(label) for path in image_files
+                   if (label := load_label(path)) is not None}
+        return RecordedProvider.from_files(replies, name="labels", latency=latency, jitter=jitter, seed=seed)
+    if name == "recorded":
+        if recording is None:
+            raise ValueError("--recording is required with --provider recorded")
+        return RecordedProvider.from_files(load_recording(recording, image_files),
+                                           latency=latency, jitter=jitter, seed=seed)
+    return providers_from_env([name])[0]
+
+
+def _run_one(provider, image_path, repair=False):
+    image_data = image_path.read_bytes()
+    started = time.perf_counter()
+    predicted = report = None
+    try:
+        response = provider.complete(image_data)
+        error = None
+        try:
+            predicted = extract_json(response)
+            if repair:
+                # Count the repair stage and any re-query in the latency
+                predicted, report = reconcile(predicted, image_data, provider)
+            else:
+                report = {"fixes": [], "issues": check_receipt(Receipt.from_dict(predicted)), "requeried": False}
+        except ValueError:
+            predicted = None
+    except Exception as e:
+        response, error = None, str(e)
+    return image_path, response, predicted, report, error, time.perf_counter() - started
+
+
+def run_benchmark(provider, image_files, concurrency=4, repair=False):
+    """
+    Run an extractor over labelled images and score it.
+
+    Args:
+        provider (Provider): Extractor under test
+        image_files (list): Images to analyze
+        concurrency (int): Requests in flight at once
+        repair (bool): Run the consistency repair / re-query stage on every reply
+
+    Returns:
+        dict: Summary metrics and per-image results, ready to dump as JSON
+    """
+    results = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(_run_one, provider, path, repair) for path in image_files]
+        for future in as_completed(futures):
+            image_path, response, predicted, report, error, seconds = future.result()
+            expected = load_label(image_path)
+            record = {"image": str(image_path), "seconds": round(seconds, 4), "error": error,
+                      "parsed": isinstance(predicted, dict), "labelled": expected is not None}
+            if report is not None:
+                record["consistent"] = not report["issues"]
+                record["fixes"] = len(report["fixes"])
+                record["requeried"] = report["requeried"]
+            if expected is not None and record["parsed"]:
+                record["scores"] = score_receipt(predicted, expected)
+            results.append(record)
+    elapsed = time.perf_counter() - started
+    results.sort(key=lambda record: record["image"])
+    return {"summary": summarize(results, elapsed), "results": results}
+
+
+def summarize(results, elapsed):
+    """Aggregate throughput, latency percentiles, parse rate and accuracy."""
+    total = len(results)
+    latencies = [record["seconds"] for record in results if record["error"] is None]
+    labelled = [record for record in results if record["labelled"]]
+
+    # Failed calls and unparseable replies count as wrong on every field
+    field_accuracy = {}
+    for field in SCALAR_FIELDS:
+        correct = sum(1 for record in labelled if record.get("scores", {}).get(field))
+        field_accuracy[field] = round(correct / len(labelled), 4) if labelled else None
+    items_f1 = [record["scores"]["items"]["f1"] if "scores" in record else 0.0 for record in labelled]
+    scored = [value for value in field_accuracy.values() if value is not None]
+
+    def rate(key):
+        return round(sum(1 for record in results if record.get(key)) / total, 4) if total else 0.0
+
+    def rounded(value):
+        return round(value, 4) if value is not None else None
+
+    return {
+        "images": total,
+        "elapsed": round(elapsed, 4),
+        "throughput": round(total / elapsed, 4) if elapsed > 0 else 0.0,
+        "latency": {
+            "p50": rounded(percentile(latencies, 0.50)),
+            "p95": rounded(percentile(latencies, 0.95)),
+            "p99": rounded(percentile(latencies, 0.99)),
+        },
+        "error_rate": round(1 - len(latencies) / total, 4) if total else 0.0,
+        "parse_rate": round(sum(record["parsed"] for record in results) / total, 4) if total else 0.0,
+        "consistent_rate": rate("consistent"),
+        "repaired_rate": rate("fixes"),
+        "requery_rate": rate("requeried"),
+        "labelled": len(labelled),
+        "field_accuracy": field_accuracy,
+        "items_f1": round(sum(items_f1) / len(items_f1), 4) if items_f1 else None,
+        "accuracy": round(sum(scored) / len(scored), 4) if scored else None,
+    }
+
+
+def compare_modes(summaries):
+    """
+    Set the per-part prompting mode against the single prompt mode.
+
+    Returns:
+        dict: Change in p50/p95 latency (seconds), throughput, parse rate
+        and accuracy going from "single" to "fields"; positive means higher
+    """
+    single, fields = summaries["single"], summaries["fields"]
+
+    def delta(a, b):
+        return round(b - a, 4) if a is not None and b is not None else None
+
+    return {
+        "latency_p50": delta(single["latency"]["p50"], fields["latency"]["p50"]),
+        "latency_p95": delta(single["latency"]["p95"], fields["latency"]["p95"]),
+        "throughput": delta(single["throughput"], fields["throughput"]),
+        "parse_rate": delta(single["parse_rate"], fields["parse_rate"]),
+        "accuracy": delta(single["accuracy"], fields["accuracy"]),
+    }
+
+
+def print_summary(summary):
+    latency = summary["latency"]
+    print(f"Images: {summary['images']} ({summary['labelled']} labelled) in {summary['elapsed']:.2f}s "
+          f"({summary['throughput']:.2f} images/sec)")
+    if latency["p50"] is not None:
+        print(f"Latency: p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  p99 {latency['p99']:.3f}s")
+    print(f"Errors: {summary['error_rate']:.1%}  Parsed: {summary['parse_rate']:.1%}  "
+          f"Consistent: {summary['consistent_rate']:.1%}  Repaired: {summary['repaired_rate']:.1%}  "
+          f"Re-queried: {summary['requery_rate']:.1%}")
+    for field, accuracy in summary["field_accuracy"].items():
+        if accuracy is not None:
+            print(f"  {field:<22} {accuracy:.1%}")
+    if "fields" in summary:
+        print(f"Part failure rate: {summary['fields']['part_failure_rate']}")
+    if "cascade" in summary:
+        print(f"Escalation rate: {summary['cascade']['escalation_rate']:.1%}  Served: {summary['cascade']['served']}")
+    if summary["accuracy"] is not None:
+        print(f"Field accuracy: {summary['accuracy']:.1%}  Items F1: {summary['items_f1']:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a receipt extractor against the labelled dataset")
+    parser.add_argument("--provider", default="stub",
+                        help="stub, labels, recorded, or a backend provider such as groq, gemini, moondream")
+    parser.add_argument("--recording", default=None, help="Replies to replay with --provider recorded")
+    parser.add_argument("--cascade-tiers", default=None,
+                        help="Providers of --provider cascade from cheapest to most expensive, e.g. local:./moondream-0_5b-int8.mf,groq")
+    parser.add_argument("--split", action="append", choices=SPLITS,
+                        help="Dataset split to benchmark, can be repeated (default: test)")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Dataset root, or a directory packed by shards.py")
+    parser.add_argument("--limit", type=int, default=None, help="Only benchmark the first N images")
+    parser.add_argument("--include-unlabelled", action="store_true",
+                        help="Also run images without ground truth (latency only)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once")
+    parser.add_argument("--repair", action="store_true",
+                        help="Check and repair the arithmetic, re-querying receipts that stay inconsistent")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per reply for offline providers")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds added to --latency")
+    parser.add_argument("--cassette", default=None,
+                        help="Record the provider's replies to / replay them from this SQLite file")
+    parser.add_argument("--cassette-mode", choices=MODES, default="auto")
+    parser.add_argument("--cassette-latency", default=None,
+                        help='Replay delay: "recorded" or a number of seconds (default: instant)')
+    parser.add_argument("--mode", choices=("single", "fields", "compare"), default="single",
+                        help="One prompt for the whole receipt, per-part prompts, or both one after the other")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON report")
+    parser.add_argument("--profile", action="store_true", default=PROFILE_BATCH,
+                        help="Sample the run and print where the time went (also PROFILE_BATCH=1)")
+    args = parser.parse_args()
+
+    image_files = list_split_images(args.split or ["test"], args.data_dir)
+    if not args.include_unlabelled:
+        image_files = [path for path in image_files if load_label(path) is not None]
+    image_files = image_files[:args.limit]
+    provider = build_provider(args.provider, image_files, args.recording, args.latency, args.jitter,
+                              tiers=args.cascade_tiers)
+    if args.cassette:
+        provider = with_cassette(provider, Cassette(args.cassette, args.cassette_mode, args.cassette_latency))
+
+    modes = ("single", "fields") if args.mode == "compare" else (args.mode,)
+    reports = {}
+    profiler = SamplingProfiler().start() if args.profile else None
+    for mode in modes:
+        extractor = with_fields(provider, mode)
+        reports[mode] = run_benchmark(extractor, image_files, args.concurrency, args.repair)
+        if isinstance(provider, CascadeProvider):
+            reports[mode]["summary"]["cascade"] = provider.stats()
+        if isinstance(extractor, FieldsProvider):
+            reports[mode]["summary"]["fields"] = extractor.stats()
+    profile_file = write_folded(profiler.stop(), profile_path("benchmark")) if profiler is not None else None
+
+    if args.mode == "compare":
+        report = {"modes": reports,
+                  "comparison": compare_modes({mode: reports[mode]["summary"] for mode in modes})}
+    else:
+        report = reports[args.mode]
+    report["config"] = {
+        "provider": args.provider,
+        "mode": args.mode,
+        "model": provider.model_name,
+        "splits": args.split or ["test"],
+        "limit": args.limit,
+        "cascade_tiers": args.cascade_tiers,
+        "concurrency": args.concurrency,
+        "repair": args.repair,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "cassette": args.cassette,
+        "cassette_mode": args.cassette_mode if args.cassette else None,
+        "profile": profile_file,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for mode in modes:
+        if len(modes) > 1:
+            print(f"--- {mode} ---")
+        print_summary(reports[mode]["summary"])
+    if args.mode == "compare":
+        comparison = report["comparison"]
+        print("--- fields vs single ---")
+        print(f"p50 latency {comparison['latency_p50']:+.3f}s  p95 latency {comparison['latency_p95']:+.3f}s  "
+              f"parse rate {comparison['parse_rate']:+.1%}")
+    if profiler is not None:
+        print("--- profile ---")
+        print(format_summary(profiler.stacks))
+        print(f"Flamegraph input saved to: {profile_file}")
+    print(f"Report saved to: {args.output}")
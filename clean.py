@@ -1,70 +1,266 @@
 import os
+import sys
 import json
-import re
+import time
+import signal
+import argparse
+import itertools
+from collections import Counter
+from multiprocessing import Pool
 
-def clean_json_file(file_path):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from json_extract import JSONStreamExtractor
+from labels import LABEL_STORE
+
+# Bytes read at a time; most labels are cleaned after the first read
+CHUNK_SIZE = 64 * 1024
+
+def clean_json_file(file_path, dry_run=False):
     """
     Clean a file containing JSON by removing backticks and language indicators,
     keeping only the valid JSON content.
-    
+
+    The file is scanned once, in chunks, and reading stops as soon as the
+    first JSON value closes. It is only rewritten when that changes its
+    content, through a temporary file renamed over it, so an interrupted
+    run never leaves a half written label behind.
+
     Args:
         file_path (str): Path to the JSON file to clean
+        dry_run (bool): Report what would change without writing
+
+    Returns:
+        tuple: (file_path, status, error) where status is "cleaned",
+        "unchanged" or "failed"
     """
     try:
+        # Find the first complete JSON object or array, skipping markdown
+        # fences and any text around it
+        extractor = JSONStreamExtractor('{[')
         with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-        
-        # Remove markdown-style code blocks (```json and ```)
-        content = re.sub(r'```\s*json\s*', '', content)
-        content = re.sub(r'```', '', content)
-        
-        # Find the first { or [ and last } or ]
-        json_start = min(
-            content.find('{') if content.find('{') != -1 else float('inf'),
-            content.find('[') if content.find('[') != -1 else float('inf')
-        )
-        json_end = max(content.rfind('}'), content.rfind(']')) + 1
-        
-        if json_start == float('inf') or json_end <= 0:
-            print(f"No valid JSON found in {file_path}")
-            return
-        
-        # Extract just the JSON part
-        json_content = content[json_start:json_end]
-        
-        # Validate that it's valid JSON
-        json.loads(json_content)  # This will raise an exception if invalid
-        
-        # Write the cleaned content back to the file
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(json_content)
-        
-        print(f"Successfully cleaned {file_path}")
-        
-    except json.JSONDecodeError as e:
-        print(f"Error: Invalid JSON in {file_path}: {str(e)}")
+            while not extractor.done:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                extractor.feed(chunk)
+            trailing = file.read(1) if extractor.done else ''
+
+        if not extractor.done:
+            return file_path, 'failed', 'No valid JSON found'
+        json_content = extractor.json_text
+        if not trailing and json_content == extractor.text:
+            return file_path, 'unchanged', None
+
+        if not dry_run:
+            # Write the cleaned content next to the file, then swap it in
+            tmp_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.tmp")
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as file:
+                    file.write(json_content)
+                os.replace(tmp_path, file_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        return file_path, 'cleaned', None
+
     except Exception as e:
-        print(f"Error processing {file_path}: {str(e)}")
+        return file_path, 'failed', str(e)
+
+def clean_label_store(store_path, dry_run=False):
+    """
+    Clean every label in a split's label store (see labels.py) in one transaction.
+
+    Placeholders of unlabelled images are left alone. A label without any
+    JSON in it is reported as failed and reset to a placeholder, so the
+    dataset builder asks for it again.
+
+    Args:
+        store_path (str): Path to the labels.sqlite3 file
+        dry_run (bool): Report what would change without writing
+
+    Returns:
+        list: (store_path:stem, status, error) per label
+    """
+    from labels import PLACEHOLDERS, LabelStore, clean_label_text
+
+    results, cleaned = [], []
+    with LabelStore(store_path) as store:
+        for stem in store.stems():
+            text = store.get_text(stem)
+            if text.strip() in PLACEHOLDERS:
+                continue
+            name = f"{store_path}:{stem}"
+            label = clean_label_text(text)
+            if label is None:
+                cleaned.append((stem, "{}"))
+                results.append((name, 'failed', 'No valid JSON found, reset to be labelled again'))
+            elif label == text:
+                results.append((name, 'unchanged', None))
+            else:
+                cleaned.append((stem, label))
+                results.append((name, 'cleaned', None))
+        if cleaned and not dry_run:
+            store.put_many(cleaned)
+    return results
+
+def find_label_stores(paths):
+    """Collect the label stores among `paths` and below them."""
+    stores = []
+    for path in paths:
+        if os.path.isfile(path):
+            if os.path.basename(path) == LABEL_STORE:
+                stores.append(path)
+            continue
+        for root, _, filenames in os.walk(path):
+            if LABEL_STORE in filenames:
+                stores.append(os.path.join(root, LABEL_STORE))
+    return sorted(set(stores))
+
+def find_json_files(paths):
+    """
+    Collect the JSON files to clean.
+
+    Args:
+        paths (iterable): Folders of JSON files, roots to search for `*_json`
+            folders (e.g. the dataset directory) or single JSON files;
+            label stores are collected by find_label_stores()
 
-def process_directory(directory_path):
+    Returns:
+        list: Paths of the JSON files, in a stable order
+    """
+    files = []
+    # Folders given directly are cleaned whatever their name, below them
+    # only the `*_json` label folders are
+    pending = [(path, True) for path in paths]
+    while pending:
+        path, given = pending.pop()
+        if os.path.isfile(path):
+            if path.endswith('.json'):
+                files.append(path)
+            continue
+        take = given or os.path.basename(path.rstrip(os.sep)).endswith('_json')
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append((entry.path, False))
+                elif take and entry.name.endswith('.json'):
+                    files.append(entry.path)
+    return sorted(set(files))
+
+def _init_worker():
+    # Ctrl-C is handled by the parent, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _clean(args):
+    return clean_json_file(*args)
+
+def clean_files(files, workers=None, dry_run=False):
+    """
+    Clean many JSON files on a process pool.
+
+    Args:
+        files (list): Paths of the files to clean
+        workers (int): Worker processes, defaults to the CPU count
+        dry_run (bool): Report what would change without writing
+
+    Yields:
+        tuple: (file_path, status, error) in completion order
+    """
+    workers = max(1, min(workers or os.cpu_count() or 1, len(files)))
+    jobs = [(path, dry_run) for path in files]
+    if workers == 1:
+        yield from map(_clean, jobs)
+        return
+    # Labels are tiny, so hand them out in chunks to keep the pool busy
+    chunksize = max(1, min(256, len(jobs) // (workers * 4)))
+    with Pool(workers, initializer=_init_worker) as pool:
+        yield from pool.imap_unordered(_clean, jobs, chunksize)
+
+def process_directory(directory_path, workers=None, dry_run=False):
     """
     Process all JSON files in the given directory.
-    
+
     Args:
         directory_path (str): Path to the directory containing JSON files
+        workers (int): Worker processes, defaults to the CPU count
+        dry_run (bool): Report what would change without writing
+
+    Returns:
+        dict: Summary of the run, see summarize()
+    """
+    files = sorted(os.path.join(directory_path, filename) for filename in os.listdir(directory_path)
+                   if filename.endswith('.json'))
+    return summarize(clean_files(files, workers, dry_run))
+
+def summarize(results, verbose=False):
+    """
+    Tally cleaning results.
+
+    Returns:
+        dict: files, counts per status, failures as {path: error} and elapsed seconds
     """
-    for filename in os.listdir(directory_path):
-        if filename.endswith('.json'):
-            file_path = os.path.join(directory_path, filename)
-            print(f"Processing {filename}...")
-            clean_json_file(file_path)
+    started = time.perf_counter()
+    counts = Counter()
+    failures = {}
+    try:
+        for file_path, status, error in results:
+            counts[status] += 1
+            if status == 'failed':
+                failures[file_path] = error
+            if verbose or status == 'failed':
+                print(f"{status}: {file_path}" + (f" ({error})" if error else ""))
+    except KeyboardInterrupt:
+        # Every file is either untouched or fully rewritten, so stopping is safe
+        print("Interrupted, reporting the files processed so far")
+        counts['interrupted'] = 1
+    return {
+        'files': sum(counts[status] for status in ('cleaned', 'unchanged', 'failed')),
+        'cleaned': counts['cleaned'],
+        'unchanged': counts['unchanged'],
+        'failed': counts['failed'],
+        'interrupted': bool(counts['interrupted']),
+        'elapsed': round(time.perf_counter() - started, 3),
+        'failures': dict(sorted(failures.items())),
+    }
 
 if __name__ == "__main__":
-    # Get the directory path from user input
-    directory = input("Enter the directory path containing JSON files: ")
-    
-    
-    if os.path.isdir(directory):
-        process_directory(directory)
-    else:
-        print("Invalid directory path!")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Strip model chatter and markdown fences from JSON label files")
+    parser.add_argument("paths", nargs="*",
+                        help="*_json folders, directories to search for them and for label stores, "
+                             "JSON files or labels.sqlite3 stores (asked for interactively when omitted)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would change")
+    parser.add_argument("--report", default=None, help="Also write the summary as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="Print every file, not just failures")
+    args = parser.parse_args()
+
+    paths = args.paths
+    if not paths:
+        # Get the directory path from user input
+        directory = input("Enter the directory path containing JSON files: ")
+        if not os.path.isdir(directory):
+            print("Invalid directory path!")
+            sys.exit(1)
+        paths = [directory]
+
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        print(f"Invalid path: {', '.join(missing)}")
+        sys.exit(1)
+
+    files = find_json_files(paths)
+    stores = find_label_stores(paths)
+
+    # Stores are single files, each cleaned in one transaction by this process
+    results = itertools.chain(clean_files(files, args.workers, args.dry_run),
+                              itertools.chain.from_iterable(clean_label_store(store, args.dry_run)
+                                                            for store in stores))
+    summary = summarize(results, args.verbose)
+    print(f"{summary['files']} files in {summary['elapsed']:.2f}s: {summary['cleaned']} cleaned, "
+          f"{summary['unchanged']} unchanged, {summary['failed']} failed"
+          + (" (dry run)" if args.dry_run else ""))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Report saved to: {args.report}")
+    sys.exit(1 if summary['failed'] or summary['interrupted'] else 0)
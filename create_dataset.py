@@ -1,120 +1,273 @@
 import os
+import sys
 import base64
 import time
-from groq import Groq
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+import groq
+from groq import AsyncGroq
+
+from labels import (SPLITS, DATA_DIR, IMAGE_EXTENSIONS, LABEL_STORE, split_image_dir, clean_label_text,
+                    open_label_store)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from preprocess import preprocess_bytes
+from http_client import get_async_client
+from cassette import cassette_from_env
+from receipt import RECEIPT_PROMPT
 
 # Groq API configuration
-API_KEY = ""  # Replace with your Groq API key
+API_KEY = os.getenv("GROQ_API_KEY", "")  # Replace with your Groq API key
+MODEL = "llama-3.2-90b-vision-preview"
+MAX_COMPLETION_TOKENS = 1024
 
-# Updated Prompt Template
-PROMPT_TEMPLATE = """
- Analyze this receipt and respond ONLY with these exact details in this format:
-                {
-                    "name_of_establishment": "name of store/restaurant",
-                    "currency": "$" or any other,
-                    "items": [
-                        {
-                            "name": "item name",
-                            "quantity": number,
-                            "price_per_item": price,
-                            "total_price": quantity * price
-                        }
-                    ],
-                    "number_of_items": total count of unique items,
-                    "subtotal": subtotal amount,
-                    "tax": tax amount or "NA" if none,
-                    "tip": tip amount or "NA" if none,
-                    "additional_charges": additional charges or "NA" if none,
-                    "total": final total amount
-                }
-                
-                Only include information you can clearly see. Use "NA" for missing values.
-                Format all prices as decimal numbers without currency symbols.
-                Keep item names exactly as written on receipt. and give back json
-
-If a value does not exist or cannot be parsed, return "na" for it.
-Return **only** this JSON format with no additional text.
-only JSON nothing else
-only json(very very important)
-"""
+# Rate limits of the Groq account and the rough token cost of one image
+REQUESTS_PER_MINUTE = 15
+TOKENS_PER_MINUTE = 7000
+IMAGE_TOKEN_ESTIMATE = 1600
+MAX_RETRIES = 6
+
+# Prompt shared with the backends
+PROMPT_TEMPLATE = RECEIPT_PROMPT
+
+class TokenBucket:
+    """
+    Shared rate limiter for requests per minute and tokens per minute.
+
+    Both buckets start full and refill continuously, so requests go out as
+    soon as the budget allows instead of in bursts followed by a long sleep.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_capacity / 60)
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_capacity / 60)
+
+    async def acquire(self, tokens):
+        """Wait until one request and `tokens` tokens are available, then take them."""
+        tokens = min(tokens, self.token_capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.requests) * 60 / self.request_capacity,
+                    (tokens - self.tokens) * 60 / self.token_capacity,
+                )
+                await asyncio.sleep(wait)
+
+    def adjust(self, estimated, actual):
+        """Correct the token bucket once the real usage of a request is known."""
+        self._refill()
+        self.tokens = min(self.token_capacity, self.tokens + estimated - actual)
 
 def encode_image(image_path):
-    """Encode image to base64."""
+    """Downscale, recompress and encode image to base64."""
     with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-def process_receipt_images(image_folder, json_folder):
-    """Process receipt images and save extracted information as JSON."""
-    client = Groq(api_key=API_KEY)
-    
-    # Time tracking for rate-limiting
-    request_count = 0
-    start_time = time.time()
-
-    # Loop through all image files in the image folder
-    for filename in os.listdir(image_folder):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            image_path = os.path.join(image_folder, filename)
-            json_path = os.path.join(json_folder, f"{os.path.splitext(filename)[0]}.json")
-            
+        return base64.b64encode(preprocess_bytes(image_file.read())).decode('utf-8')
+
+def is_labelled(json_path):
+    """Return True if a receipt already has a non-placeholder label."""
+    try:
+        with open(json_path, 'r') as json_file:
+            return json_file.read().strip() not in ('', '{}')
+    except FileNotFoundError:
+        return False
+
+def retry_delay(attempt, error):
+    """Jittered exponential backoff, honouring Retry-After when the API sends it."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
             try:
-                # Check if 15 requests have been made in the last minute
-                if request_count >= 14:
-                    elapsed_time = time.time() - start_time
-                    if elapsed_time < 60:
-                        time.sleep(60 - elapsed_time)  # Sleep to stay within the rate limit
-                    start_time = time.time()  # Reset the timer
-                    request_count = 0  # Reset the request count
-                
-                # Encode the image to base64
-                base64_image = encode_image(image_path)
-                
-                # Prepare the request payload
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": PROMPT_TEMPLATE},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                },
-                            },
-                        ],
-                    }
-                ]
-                
-                # Send the request to Groq API
-                response = client.chat.completions.create(
-                    model="llama-3.2-90b-vision-preview",
-                    messages=messages,
-                    temperature=0.6,
-                    max_completion_tokens=1024,
-                    # top_p=1,
-                    stream=False,
-                    # response_format={"type": "json_object"},
-                    stop=None,
-                )
-                print(response)
-                # Check for successful response
-                if response and response.choices:
-                    # Save the returned JSON directly to the file in the correct format
-                    with open(json_path, 'w') as json_file:
-                        json_file.write(response.choices[0].message.content)
-                    
-                    request_count += 1  # Increment the request count
-                else:
-                    print(f"Error processing {filename}: No response or choices.")
-            
+                return float(retry_after) + random.uniform(0, 1)
+            except ValueError:
+                pass
+    return random.uniform(0, min(60, 2 ** attempt))
+
+def is_retryable(error):
+    if isinstance(error, (groq.RateLimitError, groq.APIConnectionError, groq.APITimeoutError)):
+        return True
+    return isinstance(error, groq.APIStatusError) and error.status_code >= 500
+
+async def request_label(client, bucket, image_path):
+    """Ask the Groq API for the label of one image, retrying transient errors."""
+    # Encode the image to base64
+    base64_image = await asyncio.to_thread(encode_image, image_path)
+
+    # Prepare the request payload
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": PROMPT_TEMPLATE},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{base64_image}",
+                    },
+                },
+            ],
+        }
+    ]
+    estimated_tokens = len(PROMPT_TEMPLATE) // 4 + IMAGE_TOKEN_ESTIMATE + MAX_COMPLETION_TOKENS
+
+    for attempt in range(MAX_RETRIES + 1):
+        await bucket.acquire(estimated_tokens)
+        try:
+            # Send the request to the Groq API
+            response = await client.chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                temperature=0.6,
+                max_completion_tokens=MAX_COMPLETION_TOKENS,
+                stream=False,
+                stop=None,
+            )
+        except Exception as e:
+            if attempt < MAX_RETRIES and is_retryable(e):
+                delay = retry_delay(attempt, e)
+                print(f"Retrying {image_path.name} in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            raise
+
+        if response.usage is not None:
+            bucket.adjust(estimated_tokens, response.usage.total_tokens)
+        break
+
+    # Check for successful response
+    if not (response and response.choices):
+        raise ValueError("No response or choices.")
+    return response.choices[0].message.content
+
+async def process_receipt(client, bucket, image_path, json_path, cassette=None, store=None):
+    """
+    Label a single receipt image, replaying recorded replies from `cassette` if given.
+
+    The label is upserted into `store` when the split has a label store,
+    written to `json_path` otherwise.
+    """
+    if cassette is None:
+        content = await request_label(client, bucket, image_path)
+    else:
+        # Recorded replies skip the API and the rate limiter entirely
+        image_data = await asyncio.to_thread(Path(image_path).read_bytes)
+        content = await cassette.acall(image_data, PROMPT_TEMPLATE, MODEL,
+                                       lambda: request_label(client, bucket, image_path))
+
+    if store is not None:
+        # Nothing cleans a label store afterwards, so only the JSON goes in;
+        # a reply without any is left unlabelled to be asked again
+        label = clean_label_text(content)
+        if label is None:
+            raise ValueError("Reply holds no JSON label")
+        store.put(Path(image_path).stem, label)
+        return
+
+    # Save the returned JSON directly to the file in the correct format
+    with open(json_path, 'w') as json_file:
+        json_file.write(content)
+
+async def process_receipt_images(jobs, concurrency=4, requests_per_minute=REQUESTS_PER_MINUTE,
+                                 tokens_per_minute=TOKENS_PER_MINUTE):
+    """
+    Label receipt images concurrently while staying inside the rate limits.
+
+    Args:
+        jobs (list): (image_path, json_path, label store or None) tuples to process
+        concurrency (int): Maximum number of requests in flight
+        requests_per_minute (int): Request budget of the account
+        tokens_per_minute (int): Token budget of the account
+    """
+    # Share one pooled keep-alive (HTTP/2 when available) connection pool
+    client = AsyncGroq(api_key=API_KEY, http_client=get_async_client("https://api.groq.com"))
+    bucket = TokenBucket(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    cassette = cassette_from_env()
+    done = 0
+    failed = 0
+
+    async def worker(image_path, json_path, store):
+        nonlocal done, failed
+        async with semaphore:
+            try:
+                await process_receipt(client, bucket, image_path, json_path, cassette, store)
+                done += 1
+                print(f"[{done + failed}/{len(jobs)}] Labelled {image_path.name}")
             except Exception as e:
-                print(f"Failed to process {filename}: {e}")
+                failed += 1
+                print(f"Failed to process {image_path.name}: {e}")
+
+    start_time = time.monotonic()
+    await asyncio.gather(*(worker(*job) for job in jobs))
+    elapsed = time.monotonic() - start_time
+
+    print(f"Processing complete. {done} labelled, {failed} failed in {elapsed:.1f}s.")
+
+def collect_jobs(image_folder, json_folder):
+    """
+    List (image, label file, label store) jobs for the images that still need a label.
+
+    Splits imported with labels.py are labelled into their label store,
+    others into one JSON file per image in `json_folder`.
+    """
+    image_folder, json_folder = Path(image_folder), Path(json_folder)
+    store_path = image_folder.parent / LABEL_STORE
+    store = open_label_store(store_path) if store_path.is_file() else None
+    if store is None:
+        json_folder.mkdir(parents=True, exist_ok=True)
+
+    jobs = []
+    skipped = 0
+    for image_path in sorted(image_folder.iterdir()):
+        if image_path.suffix.lower() in IMAGE_EXTENSIONS:
+            json_path = json_folder / f"{image_path.stem}.json"
+            if store.is_labelled(image_path.stem) if store is not None else is_labelled(json_path):
+                skipped += 1
+                continue
+            jobs.append((image_path, json_path, store))
+
+    print(f"{image_folder}: {len(jobs)} to label, {skipped} already done")
+    return jobs
 
-    print("Processing complete.")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Label receipt images with the Groq vision model")
+    parser.add_argument("--split", action="append", choices=SPLITS,
+                        help="Dataset split to label, can be repeated (default: all)")
+    parser.add_argument("--image-folder", help="Label a single image folder instead of the dataset splits")
+    parser.add_argument("--json-folder", help="Output folder used with --image-folder")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests kept in flight")
+    parser.add_argument("--rpm", type=int, default=REQUESTS_PER_MINUTE, help="Requests per minute limit")
+    parser.add_argument("--tpm", type=int, default=TOKENS_PER_MINUTE, help="Tokens per minute limit")
+    args = parser.parse_args()
 
-# Example usage:
-# Replace with the actual paths to your image and JSON folders
-image_folder_path = ""
-json_folder_path = ""
+    if args.image_folder:
+        # Labels go next to the images in a "<folder>_json" directory by default
+        json_folder = args.json_folder or args.image_folder.rstrip("/") + "_json"
+        jobs = collect_jobs(args.image_folder, json_folder)
+    else:
+        jobs = []
+        for split in args.split or SPLITS:
+            image_folder = split_image_dir(split, DATA_DIR)
+            if image_folder is not None:
+                jobs.extend(collect_jobs(image_folder, f"{image_folder}_json"))
 
-process_receipt_images(image_folder_path, json_folder_path)
+    asyncio.run(process_receipt_images(jobs, args.concurrency, args.rpm, args.tpm))
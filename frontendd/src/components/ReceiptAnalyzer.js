@@ -3,12 +3,41 @@ import { useDropzone } from 'react-dropzone';
 import axios from 'axios';
 import ReceiptSplitter from './ReceiptSplitter';
 
+// Read server-sent events from a streaming fetch response
+async function readEvents(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary = buffer.indexOf('\n\n');
+    while (boundary !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf('\n\n');
+
+      let event = 'message';
+      let data = '';
+      block.split('\n').forEach((line) => {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      });
+      if (data) onEvent(event, JSON.parse(data));
+    }
+  }
+}
+
 function ReceiptAnalyzer() {
   const [response, setResponse] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState(null);
   const [imagePreview, setImagePreview] = useState(null);
   const [showJson, setShowJson] = useState(false);
+  const [partial, setPartial] = useState(null);
 
   const backendUrl = process.env.REACT_APP_BACKEND_URL || 'http://localhost:5000';
 
@@ -23,10 +52,38 @@ function ReceiptAnalyzer() {
     formData.append('image', acceptedFiles[0]);
 
     try {
-      const result = await axios.post(`${backendUrl}/analyze_receipt`, formData, {
-        headers: { 'Content-Type': 'multipart/form-data' },
+      // Stream the analysis so fields show up as soon as they are read
+      const stream = await fetch(`${backendUrl}/analyze_receipt/stream`, {
+        method: 'POST',
+        body: formData,
+      });
+      if (!stream.ok || !stream.body) {
+        const body = await stream.json().catch(() => ({}));
+        throw Object.assign(new Error('Request failed'), { response: { data: body } });
+      }
+
+      let finished = false;
+      setPartial({ items: [] });
+      await readEvents(stream, (event, data) => {
+        if (event === 'field' && data.key !== 'items') {
+          setPartial((current) => ({ ...current, [data.key]: data.value }));
+        } else if (event === 'item') {
+          setPartial((current) => ({ ...current, items: [...(current.items || []), data.value] }));
+        } else if (event === 'done') {
+          finished = true;
+          setResponse(data);
+        } else if (event === 'error') {
+          finished = true;
+          setError(data.error);
+        }
       });
-      setResponse(result.data);
+      if (!finished) {
+        // The stream broke off, fall back to the regular endpoint
+        const result = await axios.post(`${backendUrl}/analyze_receipt`, formData, {
+          headers: { 'Content-Type': 'multipart/form-data' },
+        });
+        setResponse(result.data);
+      }
     } catch (err) {
       setError(
         err.response?.data?.error ||
@@ -34,6 +91,7 @@ function ReceiptAnalyzer() {
       );
       console.error(err);
     } finally {
+      setPartial(null);
       setIsLoading(false);
     }
   }, [backendUrl]);
@@ -45,6 +103,7 @@ function ReceiptAnalyzer() {
 
   const resetAnalysis = () => {
     setResponse(null);
+    setPartial(null);
     setImagePreview(null);
     setError(null);
   };
@@ -75,6 +134,11 @@ function ReceiptAnalyzer() {
       {isLoading && (
         <div style={styles.message}>
           <p>Analyzing receipt...</p>
+          {partial?.name_of_establishment && <p><strong>{partial.name_of_establishment}</strong></p>}
+          {partial?.items?.map((item, index) => (
+            <p key={index}>{item.name} {partial.currency || ''}{item.total_price}</p>
+          ))}
+          {partial?.total !== undefined && <p>Total: {partial.currency || ''}{partial.total}</p>}
         </div>
       )}
 
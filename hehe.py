@@ -1,5 +1,7 @@
 import os
 
+from labels import LABEL_STORE, LabelStore
+
 def create_empty_json_files(image_folder):
     # Get the parent directory of the image folder
     parent_dir = os.path.dirname(image_folder)
@@ -14,13 +16,31 @@ def create_empty_json_files(image_folder):
             # Create an empty JSON file path with the same name as the image
             json_path = os.path.join(json_folder, f"{os.path.splitext(filename)[0]}.json")
             
-            # Create an empty JSON file
-            with open(json_path, 'w') as json_file:
-                json_file.write("{}")  # Write empty JSON content
+            # Create an empty JSON file, keeping labels that already exist
+            try:
+                with open(json_path, 'x') as json_file:
+                    json_file.write("{}")  # Write empty JSON content
+            except FileExistsError:
+                pass
     
     print(f"Empty JSON files created in: {json_folder}")
 
+def create_empty_labels(image_folder):
+    # Splits imported with labels.py keep their labels in one store next to
+    # the image folder; only images without an entry get a placeholder there
+    store_path = os.path.join(os.path.dirname(image_folder), LABEL_STORE)
+    if not os.path.isfile(store_path):
+        create_empty_json_files(image_folder)
+        return
+
+    stems = [os.path.splitext(filename)[0] for filename in os.listdir(image_folder)
+             if filename.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    with LabelStore(store_path) as store:
+        added = store.add_placeholders(stems)
+
+    print(f"{added} empty labels added to: {store_path}")
+
 # Example usage:
 # Replace 'path_to_image_folder' with the path to your folder containing receipt images
 image_folder_path = "/home/kush/cooking/bill_read/images.cv_4javrql7ppkcofef7pzky/data/val/receipt"  # Update this path
-create_empty_json_files(image_folder_path)
+create_empty_labels(image_folder_path)
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from json_extract import JSONStreamExtractor
+
+DATA_DIR = "images.cv_4javrql7ppkcofef7pzky/data"
+SPLITS = ("train", "val", "test")
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Every split keeps its labels in one file next to its image folder
+LABEL_STORE = "labels.sqlite3"
+# Label text of an image that has not been labelled yet
+PLACEHOLDERS = ("", "{}")
+
+
+def split_image_dir(split, data_dir=DATA_DIR):
+    """
+    Return the image folder of a dataset split.
+
+    The train and val splits keep their images in `receipt/`, the test split
+    in `receipts/`, so both spellings are accepted.
+    """
+    for name in ("receipt", "receipts"):
+        path = Path(data_dir) / split / name
+        if path.is_dir():
+            return path
+    return None
+
+
+def label_path(image_path):
+    """Return the ground truth JSON of an image, e.g. receipt/X.jpg -> receipt_json/X.json."""
+    image_path = Path(image_path)
+    return image_path.parent.with_name(image_path.parent.name + "_json") / (image_path.stem + ".json")
+
+
+def label_store_path(split, data_dir=DATA_DIR):
+    return Path(data_dir) / split / LABEL_STORE
+
+
+def parse_label(text):
+    """Parse label text, None if it is missing, a placeholder or not JSON."""
+    if text is None:
+        return None
+    try:
+        return json.loads(text) or None
+    except ValueError:
+        return None
+
+
+def clean_label_text(text):
+    """The first JSON object or array of a model reply, without fences or chatter; None if it has none."""
+    extractor = JSONStreamExtractor('{[')
+    extractor.feed(text)
+    return extractor.json_text
+
+
+class LabelStore:
+    """
+    The labels of one dataset split in a single SQLite file, keyed by image stem.
+
+    Replaces the folder of one JSON file per image: a lookup is one indexed
+    query on an already open file instead of a directory walk and an open()
+    per label, and the dataset builder upserts labels as they come in.
+    Label text is stored as written, placeholders included.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS labels ('
+            ' stem TEXT PRIMARY KEY,'
+            ' label TEXT NOT NULL,'
+            ' updated REAL NOT NULL)'
+        )
+        self._db.commit()
+
+    def get_text(self, stem):
+        """Raw label text of an image, None if it has no entry."""
+        with self._lock:
+            row = self._db.execute('SELECT label FROM labels WHERE stem = ?', (stem,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get(self, stem):
+        """Parsed label of an image, None if it is missing, empty or invalid."""
+        return parse_label(self.get_text(stem))
+
+    def is_labelled(self, stem):
+        """True if an image has a label other than a placeholder."""
+        text = self.get_text(stem)
+        return text is not None and text.strip() not in PLACEHOLDERS
+
+    def put(self, stem, text):
+        """Insert or replace the label text of one image."""
+        self.put_many([(stem, text)])
+
+    def put_many(self, labels):
+        """Upsert (stem, label text) pairs in a single transaction."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'INSERT INTO labels (stem, label, updated) VALUES (?, ?, ?)'
+                ' ON CONFLICT (stem) DO UPDATE SET label = excluded.label, updated = excluded.updated',
+                ((stem, text, now) for stem, text in labels)
+            )
+            self._db.commit()
+
+    def put_missing(self, labels):
+        """
+        Add (stem, label text) pairs without overwriting real labels.
+
+        Stems with no entry, or only a placeholder, take the new text; a
+        label already in the store is kept, so a stale folder of "{}" files
+        cannot wipe labels the dataset builder wrote since.
+
+        Returns:
+            int: Number of labels added or filled in
+        """
+        now = time.time()
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT INTO labels (stem, label, updated) VALUES (?, ?, ?)'
+                ' ON CONFLICT (stem) DO UPDATE SET label = excluded.label, updated = excluded.updated'
+                " WHERE trim(labels.label) IN ('', '{}') AND trim(excluded.label) NOT IN ('', '{}')",
+                ((stem, text, now) for stem, text in labels)
+            )
+            self._db.commit()
+            return self._db.total_changes - before
+
+    def add_placeholders(self, stems):
+        """Give every stem without an entry an empty "{}" label; returns how many were added."""
+        now = time.time()
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany('INSERT OR IGNORE INTO labels (stem, label, updated) VALUES (?, ?, ?)',
+                                 ((stem, "{}", now) for stem in stems))
+            self._db.commit()
+            return self._db.total_changes - before
+
+    def load_all(self):
+        """Every parsed label at once, {stem: label or None}, for evaluation passes."""
+        with self._lock:
+            rows = self._db.execute('SELECT stem, label FROM labels ORDER BY stem').fetchall()
+        return {stem: parse_label(text) for stem, text in rows}
+
+    def stems(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT stem FROM labels ORDER BY stem')]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM labels').fetchone()[0]
+
+    def __contains__(self, stem):
+        return self.get_text(stem) is not None
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Stores opened by this process, by path
+_open_stores = {}
+
+
+def open_label_store(path):
+    """Return the LabelStore at `path`, opening it once per process."""
+    path = os.path.abspath(path)
+    store = _open_stores.get(path)
+    if store is None:
+        store = _open_stores[path] = LabelStore(path)
+    return store
+
+
+def read_label_text(image_path):
+    """
+    Raw label text of a loose image, None if it has none.
+
+    Reads the split's label store when there is one, the image's JSON file
+    from the `*_json` folder otherwise.
+    """
+    image_path = Path(image_path)
+    store_path = image_path.parent.parent / LABEL_STORE
+    if store_path.is_file():
+        return open_label_store(store_path).get_text(image_path.stem)
+    try:
+        return label_path(image_path).read_text()
+    except OSError:
+        return None
+
+
+def import_folder(store, json_folder):
+    """
+    Copy a folder of per-image JSON files into a label store in one transaction.
+
+    Labels already in the store win over the files, see put_missing().
+
+    Returns:
+        int: Number of labels added or filled in
+    """
+    labels = []
+    with os.scandir(json_folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file():
+                with open(entry.path) as f:
+                    labels.append((entry.name[:-len(".json")], f.read()))
+    return store.put_missing(labels)
+
+
+def import_split(split, data_dir=DATA_DIR):
+    """Import the `*_json` folder of a split into its label store, returning the label count."""
+    image_dir = split_image_dir(split, data_dir)
+    if image_dir is None:
+        return 0
+    json_folder = image_dir.with_name(image_dir.name + "_json")
+    if not json_folder.is_dir():
+        return 0
+    with LabelStore(label_store_path(split, data_dir)) as store:
+        return import_folder(store, json_folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import the per-image label folders into per-split label stores")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--split", action="append", choices=SPLITS,
+                        help="Split to import, can be repeated (default: all)")
+    args = parser.parse_args()
+
+    for split in args.split or SPLITS:
+        started = time.perf_counter()
+        count = import_split(split, args.data_dir)
+        print(f"{split}: {count} labels imported into {label_store_path(split, args.data_dir)} "
+              f"({time.perf_counter() - started:.2f}s)")
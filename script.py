@@ -1,137 +1,96 @@
-import moondream as md
-from PIL import Image
-from pathlib import Path
+import argparse
 import json
 import os
+import sys
+import time
 
-def analyze_receipts():
+from batch import (DATA_DIR, SPLITS, list_split_images, run_batch, add_batch_arguments, report_throughput,
+                   new_profile_dir, report_profile)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from receipt import RECEIPT_PROMPT, Receipt
+
+# Structured prompt shared with the backends
+PROMPT = RECEIPT_PROMPT
+
+def parse_receipt(idx, image_path, response_text):
+    try:
+        # Handle case where response is just "NA"
+        if response_text.strip().upper() == '"NA"' or response_text.strip().upper() == 'NA':
+            receipt_data = Receipt.empty().to_dict()
+        else:
+            # Parse and coerce the reply into the canonical receipt shape
+            receipt_data = Receipt.from_text(response_text).to_dict()
+        
+        # Add metadata
+        receipt_data["receipt_id"] = idx
+        receipt_data["image_path"] = str(image_path)
+        
+        print("\nStructured data extracted successfully")
+        print(json.dumps(receipt_data, indent=2))
+        
+    except ValueError as e:
+        print(f"\nFailed to parse JSON: {str(e)}")
+        # Create fallback structure
+        receipt_data = {
+            "receipt_id": idx,
+            "image_path": str(image_path),
+            **Receipt.empty().to_dict(),
+            "raw_response": response_text
+        }
+        print("\nFallback data created")
+
+    return receipt_data
+
+def analyze_receipts(splits=SPLITS, limit=None, batch_size=4, workers=None, decode_threads=2,
+                     output_file="receipt_analysis.json", data_dir=DATA_DIR, profile=False):
     # Paths
     model_path = "./moondream-2b-int8.mf"
-    image_dir = "images.cv_4javrql7ppkcofef7pzky/data/train/receipt"
-    num_images = 10  # Set to analyze first 10 images
     
     # Verify paths exist
     if not os.path.exists(model_path):
         print(f"Error: Model not found at {model_path}")
         return
-    if not os.path.exists(image_dir):
-        print(f"Error: Image directory not found at {image_dir}")
+    if not os.path.exists(data_dir):
+        print(f"Error: Image directory not found at {data_dir}")
         return
 
     try:
-        # Initialize model
-        print("Loading model...")
-        model = md.vl(model=model_path)
-        
         # Get list of image files
-        image_files = sorted(Path(image_dir).glob('*.[jp][pn][g]'))[:num_images]
+        image_files = list_split_images(splits, data_dir, limit)
+        num_images = len(image_files)
         all_receipts = []
+        profile_dir = new_profile_dir("script") if profile else None
 
-        # Process each image
-        for idx, image_path in enumerate(image_files, 1):
+        # Process the images on a pool of model workers
+        print(f"Loading model and analyzing {num_images} receipts...")
+        start_time = time.perf_counter()
+        for idx, image_path, response_text, error, seconds in run_batch(
+                model_path, PROMPT, image_files, batch_size, workers, decode_threads, profile_dir):
             print(f"\n{'='*50}")
-            print(f"Processing receipt {idx}/{num_images}: {image_path}")
+            print(f"Processed receipt {idx}/{num_images} in {seconds:.2f}s: {image_path}")
             print(f"{'='*50}")
-            
-            try:
-                # Load and encode image
-                image = Image.open(image_path)
-                encoded_image = model.encode_image(image)
-                
-                # Structured prompt
-                prompt = """
-                Analyze this receipt and provide the details in JSON format. If you cannot read or determine any value, use "NA". Format:
-                {
-                    "name_of_establishment": "name of store/restaurant",
-                    "currency": "$" or any other,
-                    "items": [
-                        {
-                            "name": "item name",
-                            "quantity": number,
-                            "price_per_item": price,
-                            "total_price": quantity * price
-                        }
-                    ],
-                    "number_of_items": total count of unique items,
-                    "subtotal": subtotal amount,
-                    "tax": tax amount or "NA" if none,
-                    "tip": tip amount or "NA" if none,
-                    "additional_charges": additional charges or "NA" if none,
-                    "total": final total amount
-                }
-                """
-                
-                # Get model's response
-                print("Analyzing receipt...")
-                response = model.query(encoded_image, prompt)
-                
-                # Check if response is a dictionary and has 'answer' key
-                if isinstance(response, dict) and 'answer' in response:
-                    response_text = response['answer']
-                else:
-                    print("Unexpected response format")
-                    response_text = str(response)
-                
-                print("\nRaw model response:")
-                print(response_text)
-                
-                try:
-                    # Handle case where response is just "NA"
-                    if response_text.strip().upper() == '"NA"' or response_text.strip().upper() == 'NA':
-                        receipt_data = {
-                            "name_of_establishment": "NA",
-                            "currency": "NA",
-                            "items": [],
-                            "number_of_items": 0,
-                            "subtotal": "NA",
-                            "tax": "NA",
-                            "tip": "NA",
-                            "additional_charges": "NA",
-                            "total": "NA"
-                        }
-                    else:
-                        # Try to parse as JSON
-                        receipt_data = json.loads(response_text)
-                    
-                    # Add metadata
-                    receipt_data["receipt_id"] = idx
-                    receipt_data["image_path"] = str(image_path)
-                    all_receipts.append(receipt_data)
-                    
-                    print("\nStructured data extracted successfully")
-                    print(json.dumps(receipt_data, indent=2))
-                    
-                except json.JSONDecodeError as e:
-                    print(f"\nFailed to parse JSON: {str(e)}")
-                    # Create fallback structure
-                    fallback_data = {
-                        "receipt_id": idx,
-                        "image_path": str(image_path),
-                        "name_of_establishment": "NA",
-                        "currency": "NA",
-                        "items": [],
-                        "number_of_items": 0,
-                        "subtotal": "NA",
-                        "tax": "NA",
-                        "tip": "NA",
-                        "additional_charges": "NA",
-                        "total": "NA",
-                        "raw_response": response_text
-                    }
-                    all_receipts.append(fallback_data)
-                    print("\nFallback data created")
-                    
-            except Exception as e:
-                print(f"Error processing image: {str(e)}")
+
+            if error is not None:
+                print(f"Error processing image: {error}")
                 continue
 
+            print("\nRaw model response:")
+            print(response_text)
+            all_receipts.append(parse_receipt(idx, image_path, response_text))
+
+        elapsed = time.perf_counter() - start_time
+        all_receipts.sort(key=lambda receipt: receipt["receipt_id"])
+
         # Save all results to JSON file
-        output_file = "receipt_analysis.json"
         with open(output_file, "w") as f:
             json.dump(all_receipts, f, indent=2)
         
         print(f"\n{'='*50}")
         print(f"Analysis complete. Processed {len(all_receipts)} receipts")
+        report_throughput(num_images, elapsed)
+        if profile_dir is not None:
+            report_profile(profile_dir)
         print(f"Results saved to: {output_file}")
         print(f"{'='*50}")
         
@@ -142,4 +101,7 @@ def analyze_receipts():
         return None
 
 if __name__ == "__main__":
-    receipts = analyze_receipts()
\ No newline at end of file
+    parser = add_batch_arguments(argparse.ArgumentParser(description="Analyze receipts with moondream 2B"))
+    args = parser.parse_args()
+    receipts = analyze_receipts(args.split or SPLITS, args.limit, args.batch_size, args.workers,
+                                args.decode_threads, args.output, args.data_dir, args.profile)
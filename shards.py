@@ -0,0 +1,297 @@
+import io
+import os
+import json
+import mmap
+import time
+import argparse
+from pathlib import Path
+
+# Layout of a packed split inside the output directory:
+#   <split>-00000.shard ...  image bytes followed by their label JSON, back to back
+#   <split>.index.json       where every image and label starts and ends
+SHARD_VERSION = 1
+SHARD_MB = 64
+
+
+def shard_index_path(split, root):
+    """Return the index file of a packed split."""
+    return Path(root) / f"{split}.index.json"
+
+
+def has_shards(split, root):
+    """True if `root` holds a packed copy of the split."""
+    return shard_index_path(split, root).is_file()
+
+
+def _write_atomic(path, data):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def pack_split(split, data_dir, out_dir, shard_mb=SHARD_MB):
+    """
+    Pack the images and labels of a dataset split into a few shard files.
+
+    Every image is stored with the raw bytes of its label right behind it
+    (read from the split's label store when it has one), and a new shard
+    is started once the current one passes `shard_mb` megabytes. The index
+    is written last, so readers never see a half written split.
+
+    Args:
+        split (str): "train", "val" or "test"
+        data_dir (str): Root of the loose dataset
+        out_dir (str): Where to write the shards and the index
+        shard_mb (float): Target size of a shard
+
+    Returns:
+        dict: The index of the packed split
+    """
+    from batch import list_split_images
+    from labels import read_label_text
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    shard_bytes = int(shard_mb * 1024 * 1024)
+
+    shards, records = [], []
+    shard = None
+    try:
+        for image_path in list_split_images([split], data_dir):
+            if shard is None or shard.tell() >= shard_bytes:
+                if shard is not None:
+                    shard.close()
+                shards.append(f"{split}-{len(shards):05d}.shard")
+                shard = open(out_dir / (shards[-1] + ".tmp"), "wb")
+
+            image_data = image_path.read_bytes()
+            label_data = (read_label_text(image_path) or "").encode("utf-8")
+            offset = shard.tell()
+            shard.write(image_data)
+            shard.write(label_data)
+            records.append({
+                "id": image_path.stem,
+                "name": image_path.name,
+                "shard": len(shards) - 1,
+                "offset": offset,
+                "length": len(image_data),
+                "label_length": len(label_data),
+            })
+    finally:
+        if shard is not None:
+            shard.close()
+
+    for name in shards:
+        os.replace(out_dir / (name + ".tmp"), out_dir / name)
+    index = {"version": SHARD_VERSION, "split": split, "shards": shards, "records": records}
+    _write_atomic(shard_index_path(split, out_dir), index)
+    return index
+
+
+class ShardRecord:
+    """
+    One image of a packed split.
+
+    Quacks enough like the Path of a loose image (name, stem, read_bytes())
+    for the batch and benchmark scripts to take either. Pickles by
+    reference, so worker processes reopen the shards instead of receiving
+    the image bytes.
+    """
+
+    __slots__ = ("dataset", "id", "name", "_entry")
+
+    def __init__(self, dataset, entry):
+        self.dataset = dataset
+        self.id = entry["id"]
+        self.name = entry["name"]
+        self._entry = entry
+
+    @property
+    def stem(self):
+        return self.id
+
+    @property
+    def data(self):
+        """The image bytes as a zero-copy memoryview into the shard."""
+        entry = self._entry
+        return self.dataset.view(entry["shard"], entry["offset"], entry["length"])
+
+    @property
+    def label(self):
+        """The labelled receipt, None if it is missing or empty."""
+        entry = self._entry
+        if not entry["label_length"]:
+            return None
+        raw = self.dataset.view(entry["shard"], entry["offset"] + entry["length"], entry["label_length"])
+        try:
+            return json.loads(bytes(raw)) or None
+        except ValueError:
+            return None
+
+    def read_bytes(self):
+        return bytes(self.data)
+
+    def open(self):
+        """A file object over the image, e.g. for Image.open()."""
+        return io.BytesIO(self.data)
+
+    def __reduce__(self):
+        return _load_record, (str(self.dataset.root), self.dataset.split, self.id)
+
+    def __str__(self):
+        return os.path.join(str(self.dataset.root), self.dataset.split, self.name)
+
+    def __repr__(self):
+        return f"ShardRecord({str(self)!r})"
+
+
+class ShardedDataset:
+    """
+    Read-only view of a packed split.
+
+    Shards are memory-mapped, so opening a split costs one small index read
+    whatever its size, images are sliced out of the page cache without
+    copies, and any image is reachable by id or position in O(1).
+    """
+
+    def __init__(self, root, split):
+        self.root = Path(root)
+        self.split = split
+        with open(shard_index_path(split, root)) as f:
+            index = json.load(f)
+        if index.get("version") != SHARD_VERSION:
+            raise ValueError(f"Unsupported shard index version {index.get('version')} in {root}")
+
+        self._maps = []
+        for name in index["shards"]:
+            with open(self.root / name, "rb") as f:
+                # Zero-length files cannot be mapped
+                self._maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size
+                                  else None)
+        self._views = [memoryview(shard_map) if shard_map is not None else memoryview(b"")
+                       for shard_map in self._maps]
+        self.records = [ShardRecord(self, entry) for entry in index["records"]]
+        self._by_id = {record.id: record for record in self.records}
+
+    def view(self, shard, offset, length):
+        return self._views[shard][offset:offset + length]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __contains__(self, record_id):
+        return record_id in self._by_id
+
+    def __getitem__(self, key):
+        """Look a record up by id (file stem) or by position."""
+        if isinstance(key, int):
+            return self.records[key]
+        return self._by_id[key]
+
+    def ids(self):
+        return list(self._by_id)
+
+    def image(self, record_id):
+        """Zero-copy image bytes of a record."""
+        return self._by_id[record_id].data
+
+    def label(self, record_id):
+        return self._by_id[record_id].label
+
+    def close(self):
+        """
+        Unmap the shards.
+
+        Raises:
+            BufferError: While image views handed out are still alive
+        """
+        for view in self._views:
+            view.release()
+        for shard_map in self._maps:
+            if shard_map is not None:
+                shard_map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Splits opened by this process, shared by all records and reused after unpickling
+_open_splits = {}
+
+
+def open_split(root, split):
+    """Return the ShardedDataset of a split, opening it once per process."""
+    key = (os.path.abspath(root), split)
+    dataset = _open_splits.get(key)
+    if dataset is None:
+        dataset = _open_splits[key] = ShardedDataset(root, split)
+    return dataset
+
+
+def _load_record(root, split, record_id):
+    return open_split(root, split)[record_id]
+
+
+def read_loose(image_files):
+    """
+    Read every loose image and parse its label the way the scripts used to, for comparison.
+
+    Returns:
+        tuple: (image bytes read, labels found)
+    """
+    from labels import label_path, parse_label
+
+    total = labels = 0
+    for image_path in image_files:
+        total += len(image_path.read_bytes())
+        try:
+            labels += parse_label(label_path(image_path).read_text()) is not None
+        except OSError:
+            pass
+    return total, labels
+
+
+def read_packed(records):
+    """The packed counterpart of read_loose()."""
+    total = labels = 0
+    for record in records:
+        total += len(record.data)
+        labels += record.label is not None
+    return total, labels
+
+
+if __name__ == "__main__":
+    from batch import DATA_DIR, SPLITS, list_split_images
+
+    parser = argparse.ArgumentParser(description="Pack the receipt dataset into memory-mapped shards")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Root of the loose dataset")
+    parser.add_argument("--out", default="packed", help="Where to write the shards")
+    parser.add_argument("--split", action="append", choices=SPLITS,
+                        help="Split to pack, can be repeated (default: all)")
+    parser.add_argument("--shard-mb", type=float, default=SHARD_MB, help="Target size of one shard file")
+    parser.add_argument("--compare", action="store_true",
+                        help="Time reading every image and label from the loose files and from the shards")
+    args = parser.parse_args()
+
+    for split in args.split or SPLITS:
+        started = time.perf_counter()
+        index = pack_split(split, args.data_dir, args.out, args.shard_mb)
+        size = sum(record["length"] + record["label_length"] for record in index["records"])
+        print(f"{split}: {len(index['records'])} images, {size / 1e6:.1f} MB in {len(index['shards'])} shards "
+              f"({time.perf_counter() - started:.2f}s)")
+
+        if args.compare:
+            started = time.perf_counter()
+            read_loose(list_split_images([split], args.data_dir))
+            loose = time.perf_counter() - started
+            started = time.perf_counter()
+            read_packed(ShardedDataset(args.out, split))
+            packed = time.perf_counter() - started
+            print(f"  read loose {loose * 1000:.1f} ms, packed {packed * 1000:.1f} ms")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The backend modules import each other by name, like the servers run them
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,21 @@
+import json
+
+from cascade import CascadeProvider
+from consistency import TOTALS_PROMPT
+from providers import StubProvider
+
+TOTALS_REPLY = json.dumps({'subtotal': 8.25, 'tax': 0.66, 'tip': 'NA', 'additional_charges': 'NA', 'total': 8.91})
+
+
+def test_totals_reply_from_first_tier_is_accepted():
+    cascade = CascadeProvider([StubProvider('cheap', response=TOTALS_REPLY, latency=0),
+                               StubProvider('expensive', latency=0)])
+    assert cascade.with_prompt(TOTALS_PROMPT).complete(b'image') == TOTALS_REPLY
+    assert cascade.stats()['served'] == {'cheap': 1}
+
+
+def test_totals_reply_to_full_prompt_escalates():
+    cascade = CascadeProvider([StubProvider('cheap', response=TOTALS_REPLY, latency=0),
+                               StubProvider('expensive', latency=0)])
+    assert cascade.complete(b'image') != TOTALS_REPLY
+    assert cascade.stats()['served'] == {'expensive': 1}
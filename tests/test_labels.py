@@ -0,0 +1,26 @@
+from labels import LabelStore, import_folder
+
+
+def test_reimport_keeps_stored_labels(tmp_path):
+    json_folder = tmp_path / 'receipt_json'
+    json_folder.mkdir()
+    (json_folder / 'a.json').write_text('{}')
+    (json_folder / 'b.json').write_text('{"total": 2}')
+
+    with LabelStore(tmp_path / 'labels.sqlite3') as store:
+        assert import_folder(store, json_folder) == 2
+        store.put('a', '{"total": 1}')
+        assert import_folder(store, json_folder) == 0
+        assert store.get('a') == {'total': 1}
+        assert store.get('b') == {'total': 2}
+
+
+def test_import_fills_placeholders(tmp_path):
+    json_folder = tmp_path / 'receipt_json'
+    json_folder.mkdir()
+    (json_folder / 'a.json').write_text('{"total": 1}')
+
+    with LabelStore(tmp_path / 'labels.sqlite3') as store:
+        store.add_placeholders(['a'])
+        assert import_folder(store, json_folder) == 1
+        assert store.get('a') == {'total': 1}
@@ -0,0 +1,51 @@
+import time
+import asyncio
+
+from providers import StubProvider
+from router import Router
+
+
+def hedged_router():
+    return Router([StubProvider('slow', latency=1.0), StubProvider('fast', latency=0.05)], hedge_after=0.1)
+
+
+def wait_for_loss(router, name, timeout=2.0):
+    # The losing thread records its loss once it notices the cancel
+    deadline = time.monotonic() + timeout
+    while router.snapshot()[name]['lost'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_lost_hedges_demote_slow_provider():
+    router = hedged_router()
+    assert router.complete(b'image')[0] == 'fast'
+    wait_for_loss(router, 'slow')
+    assert router.ranked() == ['fast', 'slow']
+    assert router.snapshot()['slow']['lost'] == 1
+
+
+def test_lost_async_hedges_demote_slow_provider():
+    router = hedged_router()
+
+    async def run():
+        return await router.acomplete(b'image')
+
+    assert asyncio.run(run())[0] == 'fast'
+    assert router.ranked() == ['fast', 'slow']
+    assert router.snapshot()['slow']['lost'] == 1
+
+
+def test_cancelled_async_request_is_not_a_loss():
+    router = hedged_router()
+
+    async def run():
+        task = asyncio.ensure_future(router.acomplete(b'image'))
+        await asyncio.sleep(0.02)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert router.snapshot()['slow']['lost'] == 0